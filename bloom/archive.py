@@ -0,0 +1,344 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2013, Open Source Robotics Foundation, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Open Source Robotics Foundation, Inc. nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Implements the archive formats upstream repositories can be exported to.
+
+Besides ``.tar.gz``, upstreams can be exported to ``.tar.xz``, ``.tar.zst``,
+and ``.zip`` archives.  Compression is done by ``pigz``, ``xz``, or ``zstd``
+when they are available, so that all cores can be used, and falls back to the
+Python standard library otherwise.
+"""
+
+from __future__ import print_function
+
+import gzip
+import os
+import shutil
+import stat
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+
+try:
+    import lzma
+except ImportError:
+    lzma = None
+
+from bloom.logging import debug
+from bloom.logging import error
+
+ARCHIVE_FORMATS = ['tar.gz', 'tar.xz', 'tar.zst', 'zip']
+
+DEFAULT_ARCHIVE_FORMAT = 'tar.gz'
+
+
+def get_default_archive_format():
+    """
+    Returns the archive format set with ``BLOOM_ARCHIVE_FORMAT``, or the default.
+
+    :returns: one of :py:data:`ARCHIVE_FORMATS`
+    """
+    archive_format = os.environ.get('BLOOM_ARCHIVE_FORMAT', DEFAULT_ARCHIVE_FORMAT)
+    if archive_format not in ARCHIVE_FORMATS:
+        error("Invalid BLOOM_ARCHIVE_FORMAT '{0}', expected one of: {1}"
+              .format(archive_format, ', '.join(ARCHIVE_FORMATS)), exit=True)
+    return archive_format
+
+
+def split_archive_path(path):
+    """
+    Splits the archive format extension off of an archive path.
+
+    :param path: path or file name of an archive
+    :returns: tuple of the path without the extension and the archive
+        format, or of the path and None if it is not a known format
+    """
+    for archive_format in ARCHIVE_FORMATS:
+        if path.endswith('.' + archive_format):
+            return path[:-len(archive_format) - 1], archive_format
+    return path, None
+
+
+def find_executable(name):
+    """Returns the full path of an executable on the PATH, or None."""
+    for path in os.environ.get('PATH', '').split(os.pathsep):
+        full_path = os.path.join(path, name)
+        if os.path.isfile(full_path) and os.access(full_path, os.X_OK):
+            return full_path
+    return None
+
+
+def get_compressor_command(archive_format, level=None, threads=0):
+    """
+    Returns the command compressing a tar stream from stdin to stdout.
+
+    :param archive_format: one of the ``tar.*`` archive formats
+    :param level: compression level, or None for the compressor's default
+    :param threads: number of compression threads, 0 to use all cores
+    :returns: the command as a list, or None if no suitable compressor is installed
+    """
+    level_args = ['-{0}'.format(level)] if level is not None else []
+    if archive_format == 'tar.gz' and find_executable('pigz'):
+        return ['pigz', '-c'] + level_args + (['-p', str(threads)] if threads else [])
+    if archive_format == 'tar.xz' and find_executable('xz'):
+        return ['xz', '-c', '-T{0}'.format(threads)] + level_args
+    if archive_format == 'tar.zst' and find_executable('zstd'):
+        ultra = ['--ultra'] if level is not None and level > 19 else []
+        return ['zstd', '-q', '-c', '-T{0}'.format(threads)] + ultra + level_args
+    return None
+
+
+def compress_tar_stream(stream, path, archive_format, level=None, threads=0):
+    """
+    Compresses an uncompressed tar stream into an archive.
+
+    :param stream: file like object the tar stream is read from
+    :param path: path of the archive to write
+    :param archive_format: one of the ``tar.*`` archive formats
+    :param level: compression level, or None for the default
+    :param threads: number of compression threads, 0 to use all cores
+    :raises: subprocess.CalledProcessError if the compressor fails
+    :raises: RuntimeError if no compressor for the format is available
+    """
+    cmd = get_compressor_command(archive_format, level, threads)
+    with open(path, 'wb') as f:
+        if cmd is not None:
+            debug("Compressing '{0}' with: {1}".format(path, ' '.join(cmd)))
+            p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=f)
+            try:
+                shutil.copyfileobj(stream, p.stdin, 2 ** 20)
+            finally:
+                p.stdin.close()
+                if p.wait() != 0:
+                    raise subprocess.CalledProcessError(p.returncode, cmd)
+            return
+        if archive_format == 'tar.gz':
+            out = gzip.GzipFile(fileobj=f, mode='wb', compresslevel=level if level is not None else 6)
+        elif archive_format == 'tar.xz' and lzma is not None:
+            out = lzma.LZMAFile(f, mode='wb', preset=level if level is not None else 6)
+        else:
+            raise RuntimeError("Creating '.{0}' archives requires '{1}' to be installed"
+                               .format(archive_format, archive_format.split('.')[-1].replace('zst', 'zstd')))
+        with out:
+            shutil.copyfileobj(stream, out, 2 ** 20)
+
+
+def convert_tarball(tarball_path, path, archive_format, level=None, threads=0):
+    """
+    Converts a ``.tar.gz`` archive into another archive format.
+
+    :param tarball_path: path of the ``.tar.gz`` archive
+    :param path: path of the archive to write
+    :param archive_format: one of :py:data:`ARCHIVE_FORMATS`
+    :param level: compression level, or None for the default
+    :param threads: number of compression threads, 0 to use all cores
+    """
+    if archive_format != 'zip':
+        with gzip.open(tarball_path, 'rb') as stream:
+            compress_tar_stream(stream, path, archive_format, level, threads)
+        return
+    compression = zipfile.ZIP_STORED if level == 0 else zipfile.ZIP_DEFLATED
+    with tarfile.open(tarball_path, 'r|gz') as tar:
+        with zipfile.ZipFile(path, 'w', compression) as z:
+            for member in tar:
+                # Zip files can not represent dates before 1980
+                date_time = time.gmtime(max(member.mtime, 315532800))[:6]
+                info = zipfile.ZipInfo(member.name + ('/' if member.isdir() else ''), date_time=date_time)
+                info.compress_type = compression
+                if member.issym():
+                    info.external_attr = (stat.S_IFLNK | 0o777) << 16
+                    z.writestr(info, member.linkname)
+                elif member.isdir():
+                    info.external_attr = (stat.S_IFDIR | member.mode) << 16
+                    z.writestr(info, b'')
+                elif member.isfile():
+                    info.external_attr = (stat.S_IFREG | member.mode) << 16
+                    z.writestr(info, tar.extractfile(member).read())
+
+
+class open_tar_stream(object):
+    """
+    Context manager which opens a tar archive as a stream for :py:mod:`tarfile`.
+
+    ``.tar.zst`` archives are decompressed by ``zstd`` in a subprocess,
+    other compressions are handled by :py:mod:`tarfile` itself when opened
+    with mode ``r|*``.
+
+    :param path: path of the archive
+    """
+    def __init__(self, path):
+        self.path = path
+        self.process = None
+        self.file = None
+
+    def __enter__(self):
+        if split_archive_path(self.path)[1] == 'tar.zst':
+            if not find_executable('zstd'):
+                raise RuntimeError("Reading '.tar.zst' archives requires 'zstd' to be installed")
+            self.process = subprocess.Popen(['zstd', '-q', '-d', '-c', self.path], stdout=subprocess.PIPE)
+            return self.process.stdout
+        self.file = open(self.path, 'rb')
+        return self.file
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.file is not None:
+            self.file.close()
+        if self.process is not None:
+            self.process.stdout.close()
+            if self.process.wait() != 0 and exc_type is None:
+                raise subprocess.CalledProcessError(self.process.returncode, 'zstd')
+
+
+def iter_zip_members(z):
+    """
+    Yields the entries of a zip file as :py:class:`tarfile.TarInfo` members.
+
+    :param z: an open :py:class:`zipfile.ZipFile`
+    :returns: generator of tuples of a member and a callable opening its data
+    """
+    for info in z.infolist():
+        mode = info.external_attr >> 16
+        member = tarfile.TarInfo(info.filename.rstrip('/'))
+        member.mode = stat.S_IMODE(mode) or 0o644
+        if info.filename.endswith('/') or stat.S_ISDIR(mode):
+            member.type = tarfile.DIRTYPE
+        elif stat.S_ISLNK(mode):
+            member.type = tarfile.SYMTYPE
+            member.linkname = z.read(info).decode('utf-8')
+        else:
+            member.type = tarfile.REGTYPE
+            member.size = info.file_size
+        yield member, (lambda info=info: z.open(info))
+
+
+def get_member_path(member):
+    """
+    Returns the normalized path of an archive member.
+
+    :param member: a :py:class:`tarfile.TarInfo`
+    :returns: the path relative to the archive root, or None if the path is
+        absolute or contains a ``..`` component
+    """
+    parts = [p for p in member.name.split('/') if p not in ['', '.']]
+    if member.name.startswith('/') or '..' in parts:
+        return None
+    return '/'.join(parts)
+
+
+def is_member_link_safe(member):
+    """
+    Checks that a symbolic or hard link member points inside the archive.
+
+    :param member: a :py:class:`tarfile.TarInfo` with a safe path
+    :returns: False if the link target is absolute or leaves the archive root
+    """
+    if not (member.issym() or member.islnk()):
+        return True
+    if member.linkname.startswith('/'):
+        return False
+    # Symbolic links are relative to their folder, hard links to the root
+    parts = get_member_path(member).split('/')[:-1] if member.issym() else []
+    for part in member.linkname.split('/'):
+        if part in ['', '.']:
+            continue
+        if part != '..':
+            parts.append(part)
+        elif not parts:
+            return False
+        else:
+            parts.pop()
+    return True
+
+
+def _check_member(member):
+    if get_member_path(member) is None:
+        raise RuntimeError("Unsafe path '{0}' in archive".format(member.name))
+    if not is_member_link_safe(member):
+        raise RuntimeError("Link '{0}' in archive points outside of it: '{1}'"
+                           .format(member.name, member.linkname))
+
+
+def extract_archive(path, directory, ignores=()):
+    """
+    Extracts an archive of any of the :py:data:`ARCHIVE_FORMATS`.
+
+    :param path: path of the archive
+    :param directory: directory to extract into
+    :param ignores: file names which are not extracted
+    :raises: RuntimeError if a member would be written outside of ``directory``
+    """
+    if split_archive_path(path)[1] == 'zip':
+        with zipfile.ZipFile(path) as z:
+            for member, open_member in iter_zip_members(z):
+                _check_member(member)
+                member_path = get_member_path(member)
+                if not member_path or member_path.split('/')[-1] in ignores:
+                    continue
+                target = os.path.join(directory, *member_path.split('/'))
+                if member.isdir():
+                    if not os.path.isdir(target):
+                        os.makedirs(target)
+                    continue
+                if not os.path.isdir(os.path.dirname(target)):
+                    os.makedirs(os.path.dirname(target))
+                if member.issym():
+                    os.symlink(member.linkname, target)
+                    continue
+                with open_member() as src:
+                    with open(target, 'wb') as dst:
+                        shutil.copyfileobj(src, dst)
+                os.chmod(target, member.mode)
+        return
+    tmp_dir = None
+    try:
+        if split_archive_path(path)[1] == 'tar.zst':
+            # Extraction needs a seekable archive
+            tmp_dir = tempfile.mkdtemp()
+            tar_path = os.path.join(tmp_dir, 'archive.tar')
+            with open_tar_stream(path) as stream:
+                with open(tar_path, 'wb') as f:
+                    shutil.copyfileobj(stream, f, 2 ** 20)
+            path = tar_path
+        with tarfile.open(path, 'r:*') as tar:
+            members = [m for m in tar.getmembers() if m.name.split('/')[-1] not in ignores]
+            for member in members:
+                _check_member(member)
+            if hasattr(tarfile, 'data_filter'):
+                tar.extractall(directory, members, filter='data')
+            else:
+                tar.extractall(directory, members)
+    finally:
+        if tmp_dir is not None:
+            shutil.rmtree(tmp_dir)
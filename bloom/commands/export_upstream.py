@@ -36,6 +36,7 @@ import argparse
 import binascii
 import hashlib
 import os
+import subprocess
 import sys
 import traceback
 
@@ -44,6 +45,12 @@ try:
 except ImportError:
     from urlparse import urlparse
 
+from bloom.archive import ARCHIVE_FORMATS
+from bloom.archive import compress_tar_stream
+from bloom.archive import convert_tarball
+from bloom.archive import DEFAULT_ARCHIVE_FORMAT
+from bloom.archive import get_default_archive_format
+
 from bloom.logging import debug
 from bloom.logging import error
 from bloom.logging import info
@@ -53,8 +60,15 @@ from bloom.git import branch_exists
 from bloom.git import get_root
 from bloom.git import tag_exists
 
+from bloom.upstream_cache import get_archive_commit
+from bloom.upstream_cache import mirror_has_submodules
+from bloom.upstream_cache import restore_cached_archive
+from bloom.upstream_cache import store_cached_archive
+from bloom.upstream_cache import upstream_mirror
+
 from bloom.util import add_global_arguments
 from bloom.util import change_directory
+from bloom.util import execute_command
 from bloom.util import handle_global_arguments
 from bloom.util import temporary_directory
 
@@ -81,6 +95,15 @@ git-bloom-import-upstream to be imported into the release repository.
     add('--display-uri', help="uri to use in messages (original upstream)")
     add('--name', '-n',
         help="name of the repository being exported (used in tarball name)")
+    add('--archive-format', '-f', choices=ARCHIVE_FORMATS, default=None,
+        help="format of the archive (defaults to $BLOOM_ARCHIVE_FORMAT or '{0}')"
+             .format(DEFAULT_ARCHIVE_FORMAT))
+    add('--compression-level', type=int, default=None,
+        help="compression level, e.g. 1-9 for gzip, 1-19 for zstd "
+             "(defaults to the compressor's default)")
+    add('--compression-threads', type=int, default=0, metavar='N',
+        help="number of threads used to compress the archive, "
+             "if the compressor supports it (defaults to all cores)")
     return parser
 
 
@@ -98,7 +121,46 @@ def calculate_file_md5(path, block_size=2 ** 20):
     return digest
 
 
-def export_upstream(uri, tag, vcs_type, output_dir, show_uri, name):
+def export_git_archive(repo_path, commit, path, archive_format, level=None, threads=0):
+    """
+    Exports a commit of a git repository with ``git archive``.
+
+    Unlike the vcstools export this does not include submodules.
+
+    :param repo_path: path of the git repository
+    :param commit: commit to export
+    :param path: path of the archive to write
+    :param archive_format: one of :py:data:`bloom.archive.ARCHIVE_FORMATS`
+    :param level: compression level, or None for the default
+    :param threads: number of compression threads, 0 to use all cores
+    :returns: True if the archive was created, False otherwise
+    """
+    try:
+        if archive_format == 'zip':
+            cmd = ['git', 'archive', '--format=zip', '-o', path] + \
+                (['-{0}'.format(level)] if level is not None else []) + [commit]
+            execute_command(cmd, shell=False, cwd=repo_path)
+            return True
+        cmd = ['git', 'archive', '--format=tar', commit]
+        debug(repo_path + ":$ " + ' '.join(cmd))
+        p = subprocess.Popen(cmd, cwd=repo_path, stdout=subprocess.PIPE)
+        try:
+            compress_tar_stream(p.stdout, path, archive_format, level, threads)
+        finally:
+            p.stdout.close()
+            if p.wait() != 0:
+                raise subprocess.CalledProcessError(p.returncode, cmd)
+    except (subprocess.CalledProcessError, OSError, RuntimeError) as exc:
+        warning("Failed to export '{0}' with git archive: {1}".format(commit, exc))
+        if os.path.exists(path):
+            os.remove(path)
+        return False
+    return True
+
+
+def export_upstream(uri, tag, vcs_type, output_dir, show_uri, name,
+                    archive_format=None, compression_level=None, compression_threads=0):
+    archive_format = archive_format or get_default_archive_format()
     tag = tag if tag != ':{none}' else None
     output_dir = output_dir or os.getcwd()
     if uri.startswith('git@'):
@@ -108,36 +170,66 @@ def export_upstream(uri, tag, vcs_type, output_dir, show_uri, name):
         uri = uri if uri_parsed.scheme else uri_parsed.path
         uri_is_path = False if uri_parsed.scheme else True
     name = name or 'upstream'
+    tarball_prefix = '{0}-{1}'.format(name, tag) if tag else name
+    tarball_path = os.path.join(output_dir, tarball_prefix)
+    full_tarball_path = tarball_path + '.' + archive_format
+    md5 = None
     with temporary_directory() as tmp_dir:
         info("Checking out repository at '{0}'".format(show_uri or uri) +
              (" to reference '{0}'.".format(tag) if tag else '.'))
         if uri_is_path:
             upstream_repo = get_vcs_client(vcs_type, uri)
+            commit = get_archive_commit(vcs_type, tag, uri)
+            md5 = restore_cached_archive(commit, tarball_prefix, full_tarball_path, compression_level)
         else:
             repo_path = os.path.join(tmp_dir, 'upstream')
             upstream_repo = get_vcs_client(vcs_type, repo_path)
-            if not upstream_repo.checkout(uri, tag or ''):
+            with upstream_mirror(uri, vcs_type) as mirror:
+                if mirror is not None and mirror_has_submodules(mirror, tag):
+                    mirror = None
+                commit = get_archive_commit(vcs_type, tag, mirror) if mirror else None
+                md5 = restore_cached_archive(commit, tarball_prefix, full_tarball_path, compression_level)
+                # With a cached archive the upstream need not be checked out at all
+                checked_out = md5 is not None or upstream_repo.checkout(mirror or uri, tag or '')
+            if not checked_out:
                 error("Failed to clone repository at '{0}'".format(uri) +
                       (" to reference '{0}'.".format(tag) if tag else '.'),
                       exit=True)
-        tarball_prefix = '{0}-{1}'.format(name, tag) if tag else name
-        tarball_path = os.path.join(output_dir, tarball_prefix)
-        full_tarball_path = tarball_path + '.tar.gz'
-        info("Exporting to archive: '{0}'".format(full_tarball_path))
-        if not upstream_repo.export_repository(tag or '', tarball_path):
-            error("Failed to create archive of upstream repository at '{0}'"
-                  .format(show_uri))
-            if tag and vcs_type == 'git':  # can only check for git repos
-                with change_directory(upstream_repo.get_path()):
-                    if not tag_exists(tag):
-                        warning("'{0}' is not a tag in the upstream repository..."
-                                .format(tag))
-                    if not branch_exists(tag):
-                        warning("'{0}' is not a branch in the upstream repository..."
-                                .format(tag))
-        if not os.path.exists(full_tarball_path):
-            error("Tarball was not created.", exit=True)
-        info("md5: {0}".format(calculate_file_md5(full_tarball_path)))
+            if commit is None:
+                commit = get_archive_commit(vcs_type, tag, repo_path)
+                md5 = restore_cached_archive(commit, tarball_prefix, full_tarball_path, compression_level)
+        if md5 is None:
+            info("Exporting to archive: '{0}'".format(full_tarball_path))
+            if commit is not None and not mirror_has_submodules(upstream_repo.get_path(), commit):
+                exported = export_git_archive(upstream_repo.get_path(), commit, full_tarball_path,
+                                              archive_format, compression_level, compression_threads)
+            else:
+                exported = upstream_repo.export_repository(tag or '', tarball_path)
+                if exported and archive_format != 'tar.gz':
+                    info("Converting the archive to '.{0}'".format(archive_format))
+                    try:
+                        convert_tarball(tarball_path + '.tar.gz', full_tarball_path, archive_format,
+                                        compression_level, compression_threads)
+                    except (subprocess.CalledProcessError, OSError, RuntimeError) as exc:
+                        error("Failed to convert the archive: {0}".format(exc), exit=True)
+                    finally:
+                        os.remove(tarball_path + '.tar.gz')
+            if not exported:
+                error("Failed to create archive of upstream repository at '{0}'"
+                      .format(show_uri))
+                if tag and vcs_type == 'git':  # can only check for git repos
+                    with change_directory(upstream_repo.get_path()):
+                        if not tag_exists(tag):
+                            warning("'{0}' is not a tag in the upstream repository..."
+                                    .format(tag))
+                        if not branch_exists(tag):
+                            warning("'{0}' is not a branch in the upstream repository..."
+                                    .format(tag))
+            if not os.path.exists(full_tarball_path):
+                error("Tarball was not created.", exit=True)
+            md5 = calculate_file_md5(full_tarball_path)
+            store_cached_archive(commit, tarball_prefix, full_tarball_path, md5, compression_level)
+        info("md5: {0}".format(md5))
 
 
 def main(sysargs=None):
@@ -147,4 +239,5 @@ def main(sysargs=None):
     handle_global_arguments(args)
 
     export_upstream(args.uri, args.tag, args.type, args.output_dir,
-                    args.display_uri, args.name)
+                    args.display_uri, args.name, args.archive_format,
+                    args.compression_level, args.compression_threads)
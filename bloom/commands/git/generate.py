@@ -33,9 +33,19 @@
 from __future__ import print_function
 
 import argparse
+import collections
+import multiprocessing
+import os
+import shutil
 import sys
+import tempfile
+import time
 import traceback
 
+from concurrent.futures import FIRST_COMPLETED
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import wait
+
 from subprocess import CalledProcessError
 
 from bloom.commands.git.branch import execute_branch
@@ -44,13 +54,22 @@ from bloom.generators import GeneratorError
 from bloom.generators import list_generators
 from bloom.generators import load_generator
 
+from bloom.generators.common import clear_base_substitutions
+
+from bloom.git import cat_files
+from bloom.git import clone_with_branches
 from bloom.git import ensure_clean_working_env
 from bloom.git import ensure_git_root
+from bloom.git import fetch_refs
+from bloom.git import get_current_branch
+from bloom.git import get_object_hash
+from bloom.git import get_refs
+from bloom.git import get_root
 from bloom.git import GitClone
 
 from bloom.logging import debug
 from bloom.logging import error
-# from bloom.logging import info
+from bloom.logging import info
 from bloom.logging import log_prefix
 from bloom.logging import warning
 
@@ -113,6 +132,222 @@ def try_execute(msg, err_msg, func, *args, **kwargs):
     return retcode
 
 
+def run_branch_pipeline(gen, destination, source, interactive):
+    # Summarize branch command
+    msg = summarize_branch_cmd(destination, source, interactive)
+
+    # Skip branches whose generation inputs did not change
+    if gen.is_branch_up_to_date(destination, source):
+        info("Skipping '{0}', its generation inputs have not changed.".format(destination))
+        return
+
+    # Run pre - branch - post
+    # Pre branch
+    try_execute('generator pre_branch', msg,
+                gen.pre_branch, destination, source)
+    # Branch
+    try_execute('git-bloom-branch', msg,
+                execute_branch, source, destination, interactive)
+    # Post branch
+    try_execute('generator post_branch', msg,
+                gen.post_branch, destination, source)
+
+    # Run pre - export patches - post
+    # Pre patch
+    try_execute('generator pre_export_patches', msg,
+                gen.pre_export_patches, destination)
+    # Export patches
+    try_execute('git-bloom-patch export', msg, export_patches)
+    # Post branch
+    try_execute('generator post_export_patches', msg,
+                gen.post_export_patches, destination)
+
+    # Run pre - rebase - post
+    # Pre rebase
+    try_execute('generator pre_rebase', msg,
+                gen.pre_rebase, destination)
+    # Rebase
+    ret = try_execute('git-bloom-patch rebase', msg, rebase_patches)
+    # Post rebase
+    try_execute('generator post_rebase', msg,
+                gen.post_rebase, destination)
+
+    # Run pre - import patches - post
+    # Pre patch
+    try_execute('generator pre_patch', msg,
+                gen.pre_patch, destination)
+    if ret == 0:
+        # Import patches
+        try_execute('git-bloom-patch import', msg, import_patches)
+    elif ret < 0:
+        debug("Skipping patching because rebase did not run.")
+    # Post branch
+    try_execute('generator post_patch', msg,
+                gen.post_patch, destination)
+
+
+def get_branching_parents(branching_args):
+    """
+    Returns the dependency graph of the parsed branching arguments.
+
+    A branching argument depends on an earlier branching argument when its
+    source is that argument's destination, e.g. ``debian/<distro>/foo`` from
+    ``debian/foo`` depends on ``debian/foo`` from ``release/foo``.
+
+    :param branching_args: list of ``(destination, source, interactive)``
+    :returns: list with the index of the parent of each branching argument,
+        or None for branching arguments which do not depend on another one
+    """
+    parents = []
+    index_by_destination = {}
+    for index, (destination, source, interactive) in enumerate(branching_args):
+        parents.append(index_by_destination.get(source))
+        index_by_destination[destination] = index
+    return parents
+
+
+# Generator used by the forked parallel workers, see run_branching_dag
+_parallel_generator = None
+
+
+def _run_branch_node(job):
+    """Runs the pipeline for one branching argument in its own clone of origin"""
+    index, (destination, source, interactive), origin = job
+    gen = _parallel_generator
+    start = time.time()
+    orig_cwd = os.getcwd()
+    tmp_dir = tempfile.mkdtemp()
+    clone_dir = os.path.join(tmp_dir, 'clone')
+    retcode = 0
+    changed_refs = {}
+    with log_prefix('[{0}]: '.format(destination)):
+        try:
+            clone_with_branches(origin, clone_dir)
+            os.chdir(clone_dir)
+            refs_before = get_refs()
+            run_branch_pipeline(gen, destination, source, interactive)
+            for ref, sha in get_refs().items():
+                if refs_before.get(ref) != sha:
+                    changed_refs[ref] = sha
+        except CommandFailed as err:
+            retcode = err.returncode or 1
+        except GeneratorError as err:
+            retcode = err.returncode or 1
+        except SystemExit as err:
+            retcode = err.code if isinstance(err.code, int) else 1
+        except Exception:
+            print_exc(traceback.format_exc())
+            retcode = 1
+        finally:
+            os.chdir(orig_cwd)
+    return index, retcode, changed_refs, clone_dir, tmp_dir, time.time() - start
+
+
+def summarize_branching_dag(branching_args, results):
+    info("Branch generation summary:")
+    for index, (destination, source, interactive) in enumerate(branching_args):
+        status, elapsed = results.get(index, ('not run', None))
+        timing = ' ({0:.1f}s)'.format(elapsed) if elapsed is not None else ''
+        msg = "  {0} <- {1}: {2}{3}".format(destination, source, status, timing)
+        if status == 'ok':
+            info(msg)
+        else:
+            warning(msg)
+
+
+def run_branching_dag(gen, branching_args, jobs):
+    """
+    Runs the branching arguments as a dependency graph with concurrent jobs.
+
+    Each branching argument runs in a forked worker process inside its own
+    clone of the current repository, so every worker has its own working
+    tree and index.  A branching argument is started once the branching
+    argument which creates its source branch has finished, so each parent
+    branch is generated once and its children (e.g. one per distro) then fan
+    out concurrently.  The branches and tags changed by a worker are fetched
+    back into the current repository by this process, one worker at a time,
+    so ref updates never race with each other.
+
+    A failing branching argument only prevents the branching arguments which
+    depend on it from running; everything else is finished and a summary
+    with the timing of each node is printed before the failure is reported.
+    """
+    global _parallel_generator
+    origin = get_root()
+    current_branch = get_current_branch()
+    parents = get_branching_parents(branching_args)
+    children = dict((index, []) for index in range(len(branching_args)))
+    for index, parent in enumerate(parents):
+        if parent is not None:
+            children[parent].append(index)
+    info("Running {0} branching arguments with {1} jobs"
+         .format(len(branching_args), jobs))
+    results = {}
+    updated_refs = {}
+    failures = []
+
+    def skip_descendants(index):
+        for child in children[index]:
+            results[child] = ('skipped, {0} failed'.format(branching_args[index][0]), None)
+            skip_descendants(child)
+
+    _parallel_generator = gen
+    executor = ProcessPoolExecutor(max_workers=jobs, mp_context=multiprocessing.get_context('fork'))
+    try:
+        pending = set()
+        indexes = {}
+
+        def submit(index):
+            future = executor.submit(_run_branch_node, (index, branching_args[index], origin))
+            indexes[future] = index
+            pending.add(future)
+
+        for index, parent in enumerate(parents):
+            if parent is None:
+                submit(index)
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in sorted(done, key=lambda f: indexes[f]):
+                index = indexes.pop(future)
+                destination = branching_args[index][0]
+                if future.exception() is not None:
+                    # The worker itself failed, e.g. it was killed
+                    error("Generating '{0}' failed: {1}".format(destination, future.exception()))
+                    results[index] = ('failed (1)', None)
+                    failures.append(1)
+                    skip_descendants(index)
+                    continue
+                index, retcode, changed_refs, clone_dir, tmp_dir, elapsed = future.result()
+                try:
+                    if retcode <= 0:
+                        conflicts = [r for r in changed_refs if r in updated_refs or
+                                     r == 'refs/heads/' + str(current_branch)]
+                        if conflicts:
+                            error("Generating '{0}' changed refs which were already updated: {1}"
+                                  .format(destination, ', '.join(sorted(conflicts))))
+                            retcode = code.INVALID_BRANCH_ARGS
+                        else:
+                            fetch_refs(clone_dir, list(changed_refs))
+                            updated_refs.update(dict.fromkeys(changed_refs, destination))
+                finally:
+                    shutil.rmtree(tmp_dir, ignore_errors=True)
+                if retcode > 0:
+                    error("Generating '{0}' failed with exit code ({1})".format(destination, retcode))
+                    results[index] = ('failed ({0})'.format(retcode), elapsed)
+                    failures.append(retcode)
+                    skip_descendants(index)
+                    continue
+                results[index] = ('ok', elapsed)
+                for child in children[index]:
+                    submit(child)
+    finally:
+        executor.shutdown()
+        _parallel_generator = None
+    summarize_branching_dag(branching_args, results)
+    if failures:
+        raise CommandFailed(failures[0])
+
+
 def run_generator(generator, arguments):
     try:
         gen = generator
@@ -125,56 +360,69 @@ def run_generator(generator, arguments):
                 error("Answered no to continue, aborting.", exit=True)
         try_execute('generator pre_modify', '',
                     gen.pre_modify)
+        branching_args = [parse_branch_args(branch_args, arguments.interactive)
+                          for branch_args in generator.get_branching_arguments()]
+        jobs = getattr(arguments, 'jobs', 1) or 1
+        if jobs > 1 and any(interactive for _, _, interactive in branching_args):
+            warning("Interactive branching cannot be run in parallel, ignoring '--jobs'.")
+            jobs = 1
+        if jobs > 1:
+            run_branching_dag(gen, branching_args, jobs)
+            return
+        for destination, source, interactive in branching_args:
+            run_branch_pipeline(gen, destination, source, interactive)
+    except CommandFailed as err:
+        sys.exit(err.returncode or 1)
+
+
+def plan_branch(gen, destination, source):
+    files = gen.plan_branch(destination, source)
+    if files is None:
+        return "not planned, branched from '{0}'".format(source)
+    if not files:
+        return "up to date"
+    if get_object_hash(destination) is None:
+        return "new branch with {0} generated files".format(len(files))
+    current = cat_files('{0}:{1}'.format(destination, path) for path in files)
+    changed = []
+    for path, content in sorted(files.items()):
+        old = current['{0}:{1}'.format(destination, path)]
+        if old is None or old.decode('utf-8') != content:
+            changed.append(path)
+    if not changed:
+        return "would be regenerated, generated files are unchanged"
+    return "would change: " + ', '.join(changed)
+
+
+def plan_generator(generator, arguments):
+    """
+    Reports what a generator run would change without running it.
+
+    Argument handling, package discovery and key validation run as usual,
+    then each branch's packaging files are rendered in memory and compared
+    to the files on the existing branches.  No branches, tags or files are
+    modified.
+    """
+    try:
+        gen = generator
+        try_execute('generator handle arguments', '',
+                    gen.handle_arguments, arguments)
+        try_execute('generator summarize', '',
+                    gen.summarize)
+        try_execute('generator pre_modify', '',
+                    gen.pre_modify)
+        timings = collections.OrderedDict()
+        info("Planned branches:")
         for branch_args in generator.get_branching_arguments():
-            parsed_branch_args = parse_branch_args(branch_args,
-                                                   arguments.interactive)
-            destination, source, interactive = parsed_branch_args
-            # Summarize branch command
-            msg = summarize_branch_cmd(destination, source, interactive)
-
-            # Run pre - branch - post
-            # Pre branch
-            try_execute('generator pre_branch', msg,
-                        gen.pre_branch, destination, source)
-            # Branch
-            try_execute('git-bloom-branch', msg,
-                        execute_branch, source, destination, interactive)
-            # Post branch
-            try_execute('generator post_branch', msg,
-                        gen.post_branch, destination, source)
-
-            # Run pre - export patches - post
-            # Pre patch
-            try_execute('generator pre_export_patches', msg,
-                        gen.pre_export_patches, destination)
-            # Export patches
-            try_execute('git-bloom-patch export', msg, export_patches)
-            # Post branch
-            try_execute('generator post_export_patches', msg,
-                        gen.post_export_patches, destination)
-
-            # Run pre - rebase - post
-            # Pre rebase
-            try_execute('generator pre_rebase', msg,
-                        gen.pre_rebase, destination)
-            # Rebase
-            ret = try_execute('git-bloom-patch rebase', msg, rebase_patches)
-            # Post rebase
-            try_execute('generator post_rebase', msg,
-                        gen.post_rebase, destination)
-
-            # Run pre - import patches - post
-            # Pre patch
-            try_execute('generator pre_patch', msg,
-                        gen.pre_patch, destination)
-            if ret == 0:
-                # Import patches
-                try_execute('git-bloom-patch import', msg, import_patches)
-            elif ret < 0:
-                debug("Skipping patching because rebase did not run.")
-            # Post branch
-            try_execute('generator post_patch', msg,
-                        gen.post_patch, destination)
+            destination, source, _ = parse_branch_args(branch_args, False)
+            start = time.time()
+            summary = plan_branch(gen, destination, source)
+            package = destination.split('/')[-1]
+            timings[package] = timings.get(package, 0.0) + time.time() - start
+            info("  {0}: {1}".format(destination, summary))
+        info("Planning time per package:")
+        for package, elapsed in timings.items():
+            info("  {0}: {1:.2f}s".format(package, elapsed))
     except CommandFailed as err:
         sys.exit(err.returncode or 1)
 
@@ -211,10 +459,60 @@ def get_parser():
     add = group.add_argument
     add('-y', '--non-interactive', default=True, action='store_false',
         help="runs without user interaction", dest='interactive')
+    add('-j', '--jobs', type=int, default=1, metavar='N',
+        help="number of branches to generate concurrently, branches are "
+             "started once the branch they are created from is done")
+    add('--plan', default=False, action='store_true',
+        help="report which branches would change, without modifying the repository")
+    add('--generators', default=None, metavar='GENERATOR[,GENERATOR...]',
+        help="run several generators in one clone, e.g. 'agirosdebian,agirosrpm', "
+             "the arguments after this option are given to each generator and "
+             "package data, rosdep resolutions and condition evaluations are shared")
 
     return parser
 
 
+def split_generators_argument(sysargs):
+    """
+    Splits the --generators option out of the command line arguments.
+
+    :param sysargs: list of command line arguments
+    :returns: tuple of the generator names (None if the option is not given),
+        the arguments before the option and the arguments after it
+    """
+    for index, arg in enumerate(sysargs):
+        if arg == '--generators' and index + 1 < len(sysargs):
+            names, after = sysargs[index + 1], sysargs[index + 2:]
+        elif arg.startswith('--generators='):
+            names, after = arg.split('=', 1)[1], sysargs[index + 1:]
+        else:
+            continue
+        names = [n.strip() for n in names.split(',') if n.strip()]
+        # Preserve the order, but run each generator only once
+        names = [n for i, n in enumerate(names) if n not in names[:i]]
+        return names, sysargs[:index], after
+    return None, sysargs, []
+
+
+def run_generators(runs):
+    """
+    Runs generators one after another, stopping at the first failing one.
+
+    Generators exit with 0 when there is nothing to do, which only ends the
+    run if a single generator was selected.
+
+    :param runs: list of ``(generator, arguments)``
+    :raises: SystemExit if a generator fails
+    """
+    for generator, generator_args in runs:
+        with log_prefix('[git-bloom-generate {0}]: '.format(generator.title)):
+            try:
+                run_generator(generator, generator_args)
+            except SystemExit as exc:
+                if len(runs) == 1 or exc.code not in [0, None]:
+                    raise
+
+
 def main(sysargs=None):
     from bloom.config import upconvert_bloom_to_config_branch
     upconvert_bloom_to_config_branch()
@@ -231,11 +529,26 @@ def main(sysargs=None):
     # Setup a subparser for each generator
     create_subparsers(parser, generators.values())
 
-    args = parser.parse_args(sysargs)
+    sysargs = sys.argv[1:] if sysargs is None else list(sysargs)
+    names, before, after = split_generators_argument(sysargs)
+    if names is None:
+        args = parser.parse_args(sysargs)
+        runs = [(generators[args.generator], args)]
+    else:
+        if not names:
+            parser.error("--generators requires at least one generator name")
+        runs = []
+        for name in names:
+            if name not in generators:
+                parser.error("unknown generator '{0}', choose from: {1}"
+                             .format(name, ', '.join(sorted(generators))))
+            generator_args, unknown = parser.parse_known_args(before + [name] + after)
+            if unknown:
+                warning("Generator '{0}' ignores the arguments: {1}".format(name, ' '.join(unknown)))
+            runs.append((generators[name], generator_args))
+        args = runs[0][1]
     handle_global_arguments(args)
 
-    generator = generators[args.generator]
-
     # Check that the current directory is a serviceable git/bloom repo
     try:
         ensure_clean_working_env()
@@ -244,10 +557,19 @@ def main(sysargs=None):
         parser.print_usage()
         raise
 
-    # Run the generator that was selected in a clone
-    # The clone protects the release repo state from mid change errors
-    with log_prefix('[git-bloom-generate {0}]: '.format(generator.title)):
+    try:
+        if args.plan:
+            for generator, generator_args in runs:
+                with log_prefix('[git-bloom-generate {0} --plan]: '.format(generator.title)):
+                    plan_generator(generator, generator_args)
+            return
+
+        # Run the generators that were selected in a single clone
+        # The clone protects the release repo state from mid change errors
         git_clone = GitClone()
         with git_clone:
-            run_generator(generator, args)
+            run_generators(runs)
         git_clone.commit()
+    finally:
+        # Releases run in-process must not see the substitutions of this one
+        clear_base_substitutions()
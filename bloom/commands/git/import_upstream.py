@@ -33,11 +33,14 @@
 from __future__ import print_function
 
 import argparse
+import hashlib
 import os
 import shutil
+import subprocess
 import sys
 import tarfile
 import tempfile
+import zipfile
 
 from packaging.version import parse as parse_version
 
@@ -46,19 +49,29 @@ try:
 except ImportError:
     from urllib.parse import urlparse
 
+from bloom.archive import extract_archive
+from bloom.archive import get_member_path
+from bloom.archive import iter_zip_members
+from bloom.archive import open_tar_stream
+from bloom.archive import split_archive_path
+
 from bloom.config import BLOOM_CONFIG_BRANCH
 
 from bloom.git import branch_exists
+from bloom.git import cat_files
 from bloom.git import create_branch
 from bloom.git import create_tag
 from bloom.git import delete_remote_tag
 from bloom.git import delete_tag
 from bloom.git import ensure_clean_working_env
 from bloom.git import ensure_git_root
+from bloom.git import get_current_branch
 from bloom.git import get_last_tag_by_version
+from bloom.git import get_object_hash
 from bloom.git import GitClone
 from bloom.git import has_changes
 from bloom.git import inbranch
+from bloom.git import list_tree_files
 from bloom.git import ls_tree
 from bloom.git import show
 from bloom.git import tag_exists
@@ -73,6 +86,7 @@ from bloom.logging import warning
 from bloom.packages import get_package_data
 
 from bloom.util import add_global_arguments
+from bloom.util import check_output
 from bloom.util import execute_command
 from bloom.util import get_git_clone_state
 from bloom.util import handle_global_arguments
@@ -94,16 +108,167 @@ The upstream version '{0}' isn't newer than upstream version '{1}'.
 """.format(version, last_tag_version))
 
 
+# Temporary ref the streaming importer commits to before updating the branch
+FAST_IMPORT_REF = 'refs/bloom/import-upstream'
+
+
+def _quote_fast_import_path(path):
+    path = path.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '"{0}"'.format(path)
+
+
+def fast_import_tarball(tarball_path, target_branch, version, name):
+    """
+    Imports an archive into a branch without extracting it to the worktree.
+
+    :param tarball_path: path to the archive, in any of the
+        :py:data:`bloom.archive.ARCHIVE_FORMATS`
+    :param target_branch: branch to import into, which must not be checked out
+    :param version: version being imported, used in the commit message
+    :param name: name of the repository being imported
+    :returns: True if the archive was imported, False if the caller should
+        fall back to :py:func:`import_tarball`
+    """
+    tarball_prefix, archive_format = split_archive_path(os.path.basename(tarball_path))
+    try:
+        if archive_format == 'zip':
+            with zipfile.ZipFile(tarball_path) as z:
+                return _fast_import_members(iter_zip_members(z), tarball_prefix, target_branch, version, name)
+        with open_tar_stream(tarball_path) as stream:
+            return fast_import_tar_stream(stream, tarball_prefix, target_branch, version, name)
+    except (zipfile.BadZipfile, subprocess.CalledProcessError, RuntimeError) as exc:
+        warning("Failed to read the archive: {0}".format(exc))
+        return False
+
+
+def fast_import_tar_stream(fileobj, tarball_prefix, target_branch, version, name):
+    """
+    Imports a (possibly compressed) tar stream into a branch.
+
+    The members of the tar stream are written to ``git fast-import`` as
+    blobs, and a single commit with the resulting tree is made on top of the
+    target branch, dropping the nested tarball folder if there is one.  The
+    commit is made to a temporary ref first and the branch is only updated
+    if the tree changed.  The worktree is not touched.
+
+    :param fileobj: file like object the tar stream is read from
+    :param tarball_prefix: name of the nested tarball folder to drop
+    :param target_branch: branch to import into, which must not be checked out
+    :param version: version being imported, used in the commit message
+    :param name: name of the repository being imported
+    :returns: True if the stream was imported, False otherwise
+    """
+    def iter_members():
+        with tarfile.open(fileobj=fileobj, mode='r|*') as tar:
+            for member in tar:
+                yield member, (lambda member=member: tar.extractfile(member))
+    return _fast_import_members(iter_members(), tarball_prefix, target_branch, version, name)
+
+
+def _fast_import_members(members, tarball_prefix, target_branch, version, name):
+    """Imports tar members, given with a callable opening their data, see :py:func:`fast_import_tar_stream`."""
+    if get_current_branch() == target_branch:
+        debug("Not streaming the import, '{0}' is checked out".format(target_branch))
+        return False
+    target_ref = 'refs/heads/' + target_branch
+    parent = get_object_hash(target_ref + '^{commit}')
+    ignores = ('.git', '.gitignore', '.svn', '.hgignore', '.hg', 'CVS')
+    # Paths map to (mode, mark), top level items are tracked for the nesting check
+    entries = {}
+    top_level = set()
+    marks = {}
+    author = check_output(['git', 'var', 'GIT_AUTHOR_IDENT']).strip()
+    committer = check_output(['git', 'var', 'GIT_COMMITTER_IDENT']).strip()
+    cmd = ['git', 'fast-import', '--quiet', '--date-format=raw']
+    debug(os.getcwd() + ":$ " + ' '.join(cmd))
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    try:
+        stream = p.stdin
+        for member, open_member in members:
+            path = get_member_path(member)
+            if path is None:
+                error("Unsafe path '{0}' in archive, aborting.".format(member.name), exit=True)
+            if not path or path.split('/')[-1] in ignores or '.git' in path.split('/'):
+                continue
+            top_level.add(path.split('/')[0])
+            if member.issym():
+                data = member.linkname.encode('utf-8', 'surrogateescape') \
+                    if sys.version_info[0] >= 3 else member.linkname
+                marks[path] = len(marks) + 1
+                stream.write('blob\nmark :{0}\ndata {1}\n'.format(marks[path], len(data)).encode('utf-8'))
+                stream.write(data + b'\n')
+                entries[path] = ('120000', marks[path])
+            elif member.islnk():
+                target = get_member_path(tarfile.TarInfo(member.linkname))
+                if target is None:
+                    error("Unsafe hard link target '{0}' in archive, aborting.".format(member.linkname), exit=True)
+                if target not in marks:
+                    # Hard links to files which are not in the archive (yet)
+                    return False
+                marks[path] = marks[target]
+                entries[path] = (entries[target][0], marks[path])
+            elif member.isfile():
+                marks[path] = len(marks) + 1
+                stream.write('blob\nmark :{0}\ndata {1}\n'.format(marks[path], member.size).encode('utf-8'))
+                f = open_member()
+                while True:
+                    chunk = f.read(2 ** 20)
+                    if not chunk:
+                        break
+                    stream.write(chunk)
+                stream.write(b'\n')
+                entries[path] = ('100755' if member.mode & 0o100 else '100644', marks[path])
+        # Check for folder nesting (mostly hg)
+        if [tarball_prefix] == [i for i in top_level if not i.startswith('.')]:
+            debug('Removing nested tarball folder: ' + str(tarball_prefix))
+            nested = tarball_prefix + '/'
+            entries = dict((k[len(nested):] if k.startswith(nested) else k, v) for k, v in entries.items())
+        msg = "Imported upstream version '{0}' of '{1}'".format(version, name or 'upstream').encode('utf-8')
+        commit = 'reset {0}\ncommit {0}\nauthor {1}\ncommitter {2}\ndata {3}\n'.format(
+            FAST_IMPORT_REF, author, committer, len(msg)).encode('utf-8') + msg + b'\n'
+        if parent:
+            commit += 'from {0}\n'.format(parent).encode('utf-8')
+        commit += b'deleteall\n'
+        stream.write(commit)
+        for path in sorted(entries):
+            mode, mark = entries[path]
+            line = 'M {0} :{1} {2}\n'.format(mode, mark, _quote_fast_import_path(path))
+            stream.write(line.encode('utf-8', 'surrogateescape') if sys.version_info[0] >= 3 else line)
+        stream.write(b'\n')
+        stream.close()
+        if p.wait() != 0:
+            warning("git fast-import failed to import the archive")
+            return False
+    except (tarfile.TarError, zipfile.BadZipfile, IOError, OSError) as exc:
+        warning("Failed to stream the archive into git: {0}".format(exc))
+        return False
+    finally:
+        if p.returncode is None:
+            p.stdin.close()
+            p.wait()
+        if get_object_hash(FAST_IMPORT_REF) is not None and p.returncode != 0:
+            execute_command(['git', 'update-ref', '-d', FAST_IMPORT_REF], shell=False)
+    new_commit = get_object_hash(FAST_IMPORT_REF)
+    try:
+        # Only if the upstream changed any files commit
+        if parent and get_object_hash(parent + '^{tree}') == get_object_hash(new_commit + '^{tree}'):
+            debug("The imported archive did not change the '{0}' branch".format(target_branch))
+        else:
+            execute_command(['git', 'update-ref', '-m', 'bloom: import upstream', target_ref,
+                             new_commit, parent or ''], shell=False)
+    finally:
+        execute_command(['git', 'update-ref', '-d', FAST_IMPORT_REF], shell=False)
+    return True
+
+
 def import_tarball(tarball_path, target_branch, version, name):
-    if tarball_path.endswith('.zip'):
-        error("Zip archives are not yet supported.", exit=True)
-    # Create the tarfile handle
-    targz = tarfile.open(tarball_path, 'r:gz')
+    if 'BLOOM_NO_FAST_IMPORT' not in os.environ:
+        if fast_import_tarball(tarball_path, target_branch, version, name):
+            return
+        info("Falling back to extracting the archive into the '{0}' branch".format(target_branch))
     with inbranch(target_branch):
-        # Prepare list of members to extract, ignoring some
+        # Ignore some members when extracting
         ignores = ('.git', '.gitignore', '.svn', '.hgignore', '.hg', 'CVS')
-        members = targz.getmembers()
-        members = [m for m in members if m.name.split('/')[-1] not in ignores]
 
         # Clear out the local branch
         items = []
@@ -117,14 +282,17 @@ def import_tarball(tarball_path, target_branch, version, name):
         execute_command('git clean -fdx')
 
         # Extract the tarball into the clean branch
-        targz.extractall(os.getcwd(), members)
+        try:
+            extract_archive(tarball_path, os.getcwd(), ignores)
+        except RuntimeError as exc:
+            error("Failed to extract '{0}': {1}".format(tarball_path, exc), exit=True)
 
         # Check for folder nesting (mostly hg)
         items = []
         for item in os.listdir(os.getcwd()):
             if not item.startswith('.'):
                 items.append(item)
-        tarball_prefix = os.path.basename(tarball_path)[:-len('.tag.gz')]
+        tarball_prefix = split_archive_path(os.path.basename(tarball_path))[0]
         if [tarball_prefix] == items:
             debug('Removing nested tarball folder: ' + str(tarball_prefix))
             tarball_prefix_path = os.path.join(os.getcwd(), tarball_prefix)
@@ -217,9 +385,95 @@ def handle_tree(tree, directory, root_path, version):
             execute_command('git add {0}'.format(rel_path), shell=True)
 
 
+def _run_git(args, env, input_data=None):
+    cmd = ['git'] + args
+    debug(os.getcwd() + ":$ " + ' '.join(cmd))
+    p = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.PIPE, env=env)
+    out, _ = p.communicate(input_data)
+    if p.returncode != 0:
+        raise subprocess.CalledProcessError(p.returncode, cmd)
+    return out.decode('utf-8').strip()
+
+
+def overlay_patches(patches_path, target_branch, version):
+    """
+    Overlays the patches path of the bloom branch onto a branch in one commit.
+
+    The overlay is read with a single recursive ``git ls-tree``, only the
+    package.xml files are read (in one batch) to template ``:{version}``, and
+    all files are staged into a temporary index with one
+    ``git update-index``, from which the commit is made, so neither the
+    worktree nor the real index are touched.
+
+    :param patches_path: path in the bloom branch to overlay
+    :param target_branch: branch to overlay onto, which must not be checked out
+    :param version: version to template into package.xml files
+    :returns: True if the patches were overlaid, False if the caller should
+        fall back to :py:func:`handle_tree`
+    """
+    if get_current_branch() == target_branch:
+        return False
+    patches_path = patches_path.strip('/')
+    files = list_tree_files(BLOOM_CONFIG_BRANCH, patches_path, types=('blob',))
+    target_files = list_tree_files(target_branch)
+    if files is None or target_files is None:
+        return False
+    target_dirs = set()
+    for path in target_files:
+        parts = path.split('/')
+        target_dirs.update('/'.join(parts[:i]) for i in range(1, len(parts)))
+    overlay = {}
+    for path, (mode, sha) in sorted(files.items()):
+        # An empty prefix (e.g. '/') overlays the whole bloom branch
+        rel_path = path[len(patches_path) + 1:] if patches_path else path
+        parts = rel_path.split('/')
+        for i in range(1, len(parts)):
+            if '/'.join(parts[:i]) in target_files:
+                error("In patches path '{0}' is a directory".format('/'.join(parts[:i])) +
+                      ", but it exists in the upstream branch as a file.",
+                      exit=True)
+        if rel_path in target_dirs:
+            error("In patches path '{0}' is a file, ".format(rel_path) +
+                  "but it exists in the upstream branch as a directory.",
+                  exit=True)
+        if rel_path in target_files:
+            warning("  File '{0}' already exists, overwriting...".format(rel_path))
+        if parts[-1] in ['stack.xml']:
+            warning("  Skipping '{0}' templating, fuerte not supported".format(rel_path))
+        if parts[-1] in ['package.xml']:
+            info("  Templating '{0}' into upstream branch...".format(rel_path))
+        else:
+            info("  Overlaying '{0}' into upstream branch...".format(rel_path))
+        overlay[rel_path] = (mode, sha)
+    # Template the version into the package.xml files
+    templates = [p for p in overlay if p.split('/')[-1] == 'package.xml']
+    contents = cat_files([overlay[p][1] for p in templates])
+    env = dict(os.environ)
+    for path in templates:
+        mode, sha = overlay[path]
+        data = contents[sha].replace(b':{version}', version.encode('utf-8'))
+        overlay[path] = (mode, _run_git(['hash-object', '-w', '--stdin'], env, data))
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        env['GIT_INDEX_FILE'] = os.path.join(tmp_dir, 'index')
+        _run_git(['read-tree', target_branch], env)
+        index_info = ''.join('{0} {1}\t{2}\0'.format(mode, sha, path) for path, (mode, sha) in overlay.items())
+        _run_git(['update-index', '-z', '--index-info'], env, index_info.encode('utf-8'))
+        tree = _run_git(['write-tree'], env)
+        parent = get_object_hash('refs/heads/' + target_branch)
+        msg = "Overlaid patches from '{0}'".format(patches_path)
+        commit = _run_git(['commit-tree', tree, '-p', parent, '-m', msg], env)
+        _run_git(['update-ref', '-m', 'bloom: ' + msg, 'refs/heads/' + target_branch, commit, parent], env)
+    finally:
+        shutil.rmtree(tmp_dir)
+    return True
+
+
 def import_patches(patches_path, patches_path_dict, target_branch, version):
     info("Overlaying files from patched folder '{0}' on the '{2}' branch into the '{1}' branch..."
          .format(patches_path, target_branch, BLOOM_CONFIG_BRANCH))
+    if overlay_patches(patches_path, target_branch, version):
+        return
     with inbranch(target_branch):
         handle_tree(patches_path_dict, '', patches_path, version)
         cmd = ('git commit --allow-empty -m "Overlaid patches from \'{0}\'"'
@@ -255,16 +509,10 @@ def import_upstream(tarball_path, patches_path, version, name, replace):
     # If either version or name are not provided, guess from archive name
     if not version or not name:
         # Parse tarball name
-        tarball_file = os.path.basename(tarball_path)
-        ending = None
-        if tarball_file.endswith('.tar.gz'):
-            ending = '.tar.gz'
-        elif tarball_file.endswith('.zip'):
-            ending = '.zip'
-        else:
+        tarball_file, archive_format = split_archive_path(os.path.basename(tarball_path))
+        if archive_format is None:
             error("Cannot detect type of archive: '{0}'"
                   .format(tarball_file), exit=True)
-        tarball_file = tarball_file[:-len(ending)]
         split_tarball_file = tarball_file.split('-')
         if len(split_tarball_file) < 2 and not version or len(split_tarball_file) < 1:
             error("Cannot detect name and/or version from archive: '{0}'"
@@ -279,6 +527,27 @@ def import_upstream(tarball_path, patches_path, version, name, replace):
               exit=True)
     version = version if version else split_tarball_file[-1]
 
+    md5 = []
+
+    def import_archive(target_branch):
+        import_tarball(tarball_path, target_branch, version, name)
+        return True
+    import_upstream_archive(import_archive, patches_path, version, name, replace)
+
+
+def import_upstream_archive(import_archive, patches_path, version, name, replace):
+    """
+    Imports an upstream archive into the upstream branch, overlays the
+    patches, and creates the upstream tags.
+
+    :param import_archive: callable taking the target branch, which imports
+        the archive into it and returns False if it failed to do so
+    :param patches_path: path in the bloom branch to overlay, or empty
+    :param version: version being imported
+    :param name: name of the repository being imported
+    :param replace: if True existing tags of this version are replaced
+    :returns: True if the archive was imported, False otherwise
+    """
     # Check if the patches_path (if given) exists
     patches_path_dict = None
     if patches_path:
@@ -319,7 +588,8 @@ def import_upstream(tarball_path, patches_path, version, name, replace):
 
     # Import the given tarball
     info("Importing archive into upstream branch...")
-    import_tarball(tarball_path, 'upstream', version, name)
+    if not import_archive('upstream'):
+        return False
 
     # Handle patches_path
     if patches_path:
@@ -338,6 +608,76 @@ def import_upstream(tarball_path, patches_path, version, name, replace):
         if name_tag != upstream_tag:
             info("Creating tag: '{0}'".format(name_tag))
             create_tag(name_tag)
+    return True
+
+
+class _HashingReader(object):
+    """File like object which computes the md5 of the data read through it."""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.md5.update(data)
+        return data
+
+    def drain(self):
+        while self.read(2 ** 20):
+            pass
+
+
+def import_upstream_from_repository(repo_path, reference, tarball_prefix, patches_path, version, name, replace):
+    """
+    Imports a reference of a local git repository into the upstream branch.
+
+    This does what ``bloom-export-upstream`` followed by
+    ``git-bloom-import-upstream`` do, but the output of ``git archive`` is
+    piped straight into :py:func:`fast_import_tar_stream`, so no archive is
+    written, compressed, or decompressed on the way.
+
+    :param repo_path: path of the local git repository to export from
+    :param reference: branch or tag to export
+    :param tarball_prefix: name of the folder the archive would be nested in
+    :param patches_path: path in the bloom branch to overlay, or empty
+    :param version: version being imported
+    :param name: name of the repository being imported
+    :param replace: if True existing tags of this version are replaced
+    :returns: md5 of the uncompressed tar stream ``git archive`` wrote, which
+        is not the checksum of any archive file, or None if it was not imported
+    """
+    from bloom.config import upconvert_bloom_to_config_branch
+    upconvert_bloom_to_config_branch()
+    ensure_clean_working_env()
+    ensure_git_root()
+
+    md5 = []
+
+    def import_archive(target_branch):
+        cmd = ['git', 'archive', '--format=tar', '--prefix=' + tarball_prefix + '/', reference + '^{commit}']
+        debug(repo_path + ":$ " + ' '.join(cmd))
+        p = subprocess.Popen(cmd, cwd=repo_path, stdout=subprocess.PIPE)
+        reader = _HashingReader(p.stdout)
+        imported = False
+        try:
+            imported = fast_import_tar_stream(reader, tarball_prefix, target_branch, version, name)
+            if imported:
+                # Hash the end of archive padding too, so git archive exits cleanly
+                reader.drain()
+        finally:
+            p.stdout.close()
+            if p.wait() != 0:
+                imported = False
+        if imported:
+            md5.append(reader.md5.hexdigest())
+        return imported
+
+    git_clone = GitClone()
+    with git_clone:
+        if not import_upstream_archive(import_archive, patches_path, version, name, replace):
+            return None
+    git_clone.commit()
+    return md5[0]
 
 
 def get_argument_parser():
@@ -34,6 +34,9 @@ from __future__ import print_function
 
 import argparse
 import atexit
+import copy
+import json
+import multiprocessing
 import os
 import shutil
 import subprocess
@@ -41,16 +44,26 @@ import sys
 import tempfile
 import traceback
 
+from concurrent.futures import ProcessPoolExecutor
+
+from bloom.archive import get_default_archive_format
+
+from bloom.config import BLOOM_CONFIG_BRANCH
 from bloom.config import DEFAULT_TEMPLATE
 from bloom.config import get_tracks_dict_raw
 from bloom.config import template_str
 from bloom.config import verify_track
 from bloom.config import write_tracks_dict_raw
 
+from bloom.git import clone_with_branches
 from bloom.git import ensure_clean_working_env
 from bloom.git import ensure_git_root
+from bloom.git import fetch_refs
 from bloom.git import get_current_branch
+from bloom.git import get_object_hash
+from bloom.git import get_refs
 from bloom.git import get_root
+from bloom.git import list_tree_files
 from bloom.git import GitClone
 
 from bloom.logging import debug
@@ -61,13 +74,20 @@ from bloom.logging import info
 from bloom.logging import sanitize
 from bloom.logging import warning
 
+from bloom.packages import find_package_paths_in_tree
 from bloom.packages import get_package_data
+from bloom.packages import PACKAGE_MANIFEST_FILENAME
+
+from bloom.upstream_cache import mirror_has_submodules
+from bloom.upstream_cache import upstream_mirror
 
 import bloom.util
 from bloom.util import add_global_arguments
 from bloom.util import change_directory
+from bloom.util import check_output
 from bloom.util import code
 from bloom.util import disable_git_clone
+from bloom.util import execute_command
 from bloom.util import handle_global_arguments
 from bloom.util import maybe_continue
 from bloom.util import quiet_git_clone_warning
@@ -126,6 +146,54 @@ def get_upstream_meta(upstream_dir, ros_distro):
     return meta
 
 
+def checkout_upstream_manifests(vcs_uri, devel_branch, directory):
+    """
+    Checks out only the package.xml files of a git upstream's devel branch.
+
+    The branch is resolved with ``git ls-remote``, then a shallow clone
+    without blobs (``--depth 1 --filter=blob:none``) fetches the commit and
+    its trees only.  The package folders are found from the tree listing
+    and a sparse checkout of just their package.xml files fetches those
+    blobs in one batch.  Servers which do not support filters send all of
+    the blobs of the one commit instead, which is still a shallow clone.
+
+    :param vcs_uri: uri of the upstream git repository
+    :param devel_branch: branch to check out, or None for the default branch
+    :param directory: directory to create the checkout in
+    :returns: True if the manifests were checked out, False if the full
+        clone should be used instead, e.g. for submodules or an old git
+    """
+    try:
+        if devel_branch is None:
+            output = check_output(['git', 'ls-remote', '--symref', vcs_uri, 'HEAD'], stderr=subprocess.PIPE)
+            for line in output.splitlines():
+                if line.startswith('ref: refs/heads/') and line.endswith('\tHEAD'):
+                    devel_branch = line[len('ref: refs/heads/'):-len('\tHEAD')]
+        else:
+            output = check_output(['git', 'ls-remote', vcs_uri, 'refs/heads/' + devel_branch],
+                                  stderr=subprocess.PIPE)
+            if not output.strip():
+                # Not a branch, e.g. a tag or a commit
+                devel_branch = None
+        if devel_branch is None:
+            return False
+        check_output(['git', 'clone', '--quiet', '--depth', '1', '--filter=blob:none', '--no-checkout',
+                      '--branch', devel_branch, vcs_uri, directory], stderr=subprocess.PIPE)
+        files = list_tree_files('HEAD', directory=directory, types=('blob', 'commit'))
+        if files is None or any(mode == '160000' for mode, sha in files.values()):
+            # Packages in submodules need the full clone
+            return False
+        manifests = ['/' + (path + '/' if path != '.' else '') + PACKAGE_MANIFEST_FILENAME
+                     for path in find_package_paths_in_tree(files)]
+        check_output(['git', 'sparse-checkout', 'set', '--no-cone'] + manifests,
+                     cwd=directory, stderr=subprocess.PIPE)
+        check_output(['git', 'checkout', '--quiet', devel_branch], cwd=directory, stderr=subprocess.PIPE)
+    except (subprocess.CalledProcessError, OSError) as exc:
+        debug("Shallow checkout of the upstream repository failed: {0}".format(exc))
+        return False
+    return True
+
+
 def find_version_from_upstream(vcs_uri, vcs_type, devel_branch=None, ros_distro='indigo'):
     # Check for github.com
     # if vcs_uri.startswith('http') and 'github.com' in vcs_uri:
@@ -137,8 +205,25 @@ def find_version_from_upstream(vcs_uri, vcs_type, devel_branch=None, ros_distro=
     #     warning("  Failed to find the version using raw.github.com.")
     # Try to clone the upstream repository
     info("Checking upstream devel branch '{0}' for package.xml(s)".format(devel_branch or '<default>'))
+    if vcs_type == 'git' and 'BLOOM_NO_SHALLOW_UPSTREAM_PROBE' not in os.environ:
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            probe_dir = os.path.join(tmp_dir, 'upstream')
+            if checkout_upstream_manifests(vcs_uri, devel_branch, probe_dir):
+                meta = get_upstream_meta(probe_dir, ros_distro)
+                info("Detected version '{0}' from package(s): {1}"
+                     .format(meta['version'], meta['name']))
+                # The export action clones the release tag itself
+                return meta['version'], None
+        finally:
+            shutil.rmtree(tmp_dir)
+        info("Falling back to a full clone of the upstream repository")
     upstream_repo = get_upstream_repo(vcs_uri, vcs_type)
-    if not upstream_repo.checkout(vcs_uri, devel_branch or ''):
+    with upstream_mirror(vcs_uri, vcs_type) as mirror:
+        if mirror is not None and mirror_has_submodules(mirror, devel_branch):
+            mirror = None
+        checked_out = upstream_repo.checkout(mirror or vcs_uri, devel_branch or '')
+    if not checked_out:
         error("Failed to checkout to the upstream branch "
               "'{0}' in the repository from '{1}'"
               .format(devel_branch or '<default>', vcs_uri), exit=True)
@@ -248,64 +333,660 @@ def find_full_path(cmd):
     raise OSError("[Errno 2] No such file or directory")
 
 
-def execute_track(track, track_dict, release_inc, pretend=True, debug=False, fast=False, interactive=True):
+# Actions which can be run by calling their main function directly
+_in_process_actions = {
+    'bloom-export-upstream': 'bloom.commands.export_upstream',
+    'git-bloom-branch': 'bloom.commands.git.branch',
+    'git-bloom-config': 'bloom.commands.git.config',
+    'git-bloom-generate': 'bloom.commands.git.generate',
+    'git-bloom-import-upstream': 'bloom.commands.git.import_upstream',
+    'git-bloom-patch': 'bloom.commands.git.patch.patch_main',
+    'git-bloom-release': 'bloom.commands.git.release',
+}
+
+
+def can_run_action_in_process(action):
+    """Returns True if the given action can be run without a subprocess.
+
+    Actions are run in a subprocess when their command is not a known bloom
+    command, when the output is being captured because of quiet mode, or when
+    BLOOM_NO_IN_PROCESS_ACTIONS is set in the environment.
+
+    :param action: the templated action, split into a list of arguments
+    :returns: True if :py:func:`run_action_in_process` can be used
+    """
+    if 'BLOOM_NO_IN_PROCESS_ACTIONS' in os.environ or bloom.util._quiet:
+        return False
+    return bool(action) and action[0] in _in_process_actions
+
+
+def _get_action_return_code(value):
+    # Mirrors how the interpreter turns a sys.exit argument into a return code
+    if value is None:
+        return 0
+    if isinstance(value, int):
+        return value
+    print(value, file=sys.stderr)
+    return 1
+
+
+def _save_global_state():
+    import bloom.logging
+    state = {
+        'cwd': os.getcwd(),
+        'environ': dict(os.environ),
+        'argv': list(sys.argv),
+        'util': dict((k, getattr(bloom.util, k)) for k in
+                     ['_pdb', '_quiet', '_disable_git_clone', '_disable_git_clone_quiet']),
+        'logging': dict((k, copy.copy(getattr(bloom.logging, k))) for k in
+                        ['_ansi', '_quiet', '_debug', '_log_prefix', '_log_prefix_stack',
+                         '_log_indent', '_drop_first_log_prefix']),
+    }
+    return state
+
+
+def _restore_global_state(state):
+    import bloom.logging
+    os.chdir(state['cwd'])
+    os.environ.clear()
+    os.environ.update(state['environ'])
+    sys.argv[:] = state['argv']
+    for key, value in state['util'].items():
+        setattr(bloom.util, key, value)
+    for key, value in state['logging'].items():
+        setattr(bloom.logging, key, value)
+
+
+def run_action_in_process(action):
+    """Runs a known bloom action by calling its main function directly.
+
+    This avoids starting a new interpreter, and re-importing bloom and its
+    dependencies, for every action in a release track.
+    The working directory, the environment, and bloom's logging and global
+    argument state are restored after the action, so that it behaves like it
+    was run in a subprocess.
+
+    :param action: the templated action, split into a list of arguments
+    :returns: the return code of the action
+    """
+    module = __import__(_in_process_actions[action[0]], fromlist=['main'])
+    state = _save_global_state()
+    sys.argv[:] = list(action)
+    try:
+        ret = _get_action_return_code(module.main(list(action[1:])))
+    except SystemExit as exc:
+        ret = _get_action_return_code(exc.code)
+    except Exception:
+        bloom.util.print_exc(traceback.format_exception(*sys.exc_info()))
+        ret = 1
+    finally:
+        _restore_global_state(state)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return ret
+
+
+def _parse_action_args(module_name, action):
+    module = __import__(module_name, fromlist=['get_argument_parser'])
+    parser = add_global_arguments(module.get_argument_parser())
+    try:
+        return parser.parse_args(action[1:])
+    except SystemExit:
+        return None
+
+
+def get_streamed_upstream_import(export_action, import_action, later_actions=()):
+    """Checks if an export and the following import can be streamed.
+
+    This is the case when the import action imports the archive written by
+    the export action, no later action uses that archive, the upstream is a
+    git repository which is available locally, either directly or as a
+    mirror in the upstream cache, and both actions could be run in-process.
+
+    :param export_action: the templated bloom-export-upstream action, split
+    :param import_action: the templated git-bloom-import-upstream action, split
+    :param later_actions: the templated actions after the import, split
+    :returns: a tuple of the export and import arguments, or None
+    """
+    if 'BLOOM_NO_STREAMED_IMPORT' in os.environ:
+        return None
+    if export_action[0] != 'bloom-export-upstream' or import_action[0] != 'git-bloom-import-upstream':
+        return None
+    if not can_run_action_in_process(export_action) or not can_run_action_in_process(import_action):
+        return None
+    export_args = _parse_action_args(_in_process_actions[export_action[0]], export_action)
+    import_args = _parse_action_args(_in_process_actions[import_action[0]], import_action)
+    if export_args is None or import_args is None or export_args.type != 'git':
+        return None
+    if not export_args.tag or export_args.tag == ':{none}' or not import_args.release_version:
+        return None
+    tarball_prefix = '{0}-{1}'.format(export_args.name or 'upstream', export_args.tag)
+    archive_format = export_args.archive_format or get_default_archive_format()
+    archive_path = os.path.join(export_args.output_dir or os.getcwd(), tarball_prefix + '.' + archive_format)
+    if os.path.abspath(import_args.archive_path) != os.path.abspath(archive_path):
+        return None
+    # Streaming never writes the archive, so nothing else may need it
+    for action in later_actions:
+        for arg in action:
+            if import_args.archive_path in arg or os.path.abspath(arg) == os.path.abspath(archive_path):
+                return None
+    return export_args, import_args
+
+
+def run_streamed_upstream_import(export_args, import_args):
+    """Runs an export and import action pair without an intermediate archive.
+
+    The upstream reference is piped from ``git archive`` into the upstream
+    branch, see
+    :py:func:`bloom.commands.git.import_upstream.import_upstream_from_repository`.
+
+    :param export_args: parsed arguments of the bloom-export-upstream action
+    :param import_args: parsed arguments of the git-bloom-import-upstream action
+    :returns: the return code, or None if the actions have to be run instead
+    """
+    from bloom.commands.git.import_upstream import import_upstream_from_repository
+    tarball_prefix = '{0}-{1}'.format(export_args.name or 'upstream', export_args.tag)
+    state = _save_global_state()
+    handle_global_arguments(import_args)
+    try:
+        is_path = os.path.isdir(export_args.uri)
+        with upstream_mirror(export_args.uri, vcs_type=None if is_path else 'git') as mirror:
+            repo_path = export_args.uri if is_path else mirror
+            if repo_path is None or get_object_hash(export_args.tag + '^{commit}', directory=repo_path) is None \
+               or mirror_has_submodules(repo_path, export_args.tag):
+                return None
+            info("Streaming '{0}' from '{1}' into the upstream branch"
+                 .format(export_args.tag, export_args.display_uri or export_args.uri))
+            md5 = import_upstream_from_repository(
+                repo_path, export_args.tag, tarball_prefix, import_args.patches_path,
+                import_args.release_version, import_args.name, import_args.replace)
+        if md5 is None:
+            return None
+        # No archive is written, so this is not comparable to an archive's md5
+        info("md5 (uncompressed 'git archive' tar stream, not an archive checksum): {0}".format(md5))
+        ret = 0
+    except SystemExit as exc:
+        ret = _get_action_return_code(exc.code)
+    except Exception:
+        bloom.util.print_exc(traceback.format_exception(*sys.exc_info()))
+        ret = 1
+    finally:
+        _restore_global_state(state)
+    sys.stdout.flush()
+    sys.stderr.flush()
+    return ret
+
+
+def handle_action_failure(templated_action, ret, interactive):
+    """Reports a failed action, exiting unless the user chooses to skip it.
+
+    :param templated_action: the failed action, split into a list of arguments
+    :param ret: the return code of the failed action
+    :param interactive: if False the user is never asked to skip the action
+    :raises: SystemExit if the action is not skipped
+    """
+    if 'bloom-generate' in templated_action[0] and ret == code.GENERATOR_NO_ROSDEP_KEY_FOR_DISTRO:
+        error(fmt(_error + "The following generator action reported that it is missing one or more"))
+        error(fmt("    @|rosdep keys, but that the key exists in other platforms:"))
+        error(fmt("@|'@!{0}'@|").format(templated_action))
+        info('', use_prefix=False)
+        error(fmt("@|If you are @!@_@{rf}absolutely@| sure that this key is unavailable for the platform in"))
+        error(fmt("@|question, the generator can be skipped and you can proceed with the release."))
+        if interactive and maybe_continue('n', 'Skip generator action and continue with release'):
+            info("\nAction skipped, continuing with release.\n")
+            return
+
+        info('', use_prefix=False)
+
+    error(fmt(_error + "Error running command '@!{0}'@|")
+          .format(templated_action), exit=True)
+
+
+# The branches written by each platform generator, generators writing
+# different branches can run at the same time
+_generator_branch_families = {
+    'agirosdebian': 'debian',
+    'agirosrpm': 'rpm',
+    'debian': 'debian',
+    'rosdebian': 'debian',
+    'rosrpm': 'rpm',
+    'rpm': 'rpm',
+}
+
+
+def get_action_branch_families(action):
+    """Returns the families of branches written by a generate action.
+
+    Only non-interactive ``git-bloom-generate`` actions of the platform
+    generators are considered, every other action (including the release
+    generators, whose branches the platform generators read) returns None.
+
+    :param action: the templated action, split into a list of arguments
+    :returns: set of branch families, e.g. ``set(['debian'])``, or None
+    """
+    if not action or os.path.basename(action[0]) != 'git-bloom-generate':
+        return None
+    if '-y' not in action and '--non-interactive' not in action:
+        return None
+    generators = []
+    args = iter(action[1:])
+    for arg in args:
+        if arg in ['-j', '--jobs']:
+            next(args, None)
+        elif arg == '--generators':
+            generators.extend(next(args, '').split(','))
+        elif arg.startswith('--generators='):
+            generators.extend(arg.split('=', 1)[1].split(','))
+        elif not arg.startswith('-'):
+            if not generators:
+                generators.append(arg)
+            break
+    families = set(_generator_branch_families.get(g) for g in generators)
+    if not families or None in families:
+        return None
+    return families
+
+
+def get_concurrent_action_groups(templated_actions, jobs):
+    """Groups consecutive actions which can run at the same time.
+
+    Actions are grouped when they are platform generators writing disjoint
+    branch families, e.g. a debian and an rpm generator for the same distro.
+    Every other action is in a group of its own, so the order of dependent
+    actions, like importing upstream before generating, is kept.
+
+    :param templated_actions: list of ``(action, templated_action)``, where
+        the templated action is a string or None if it is skipped
+    :param jobs: maximum number of actions in a group
+    :returns: list of lists of ``(action, templated_action)``
+    """
+    groups = []
+    group_families = set()
+    for action, templated_action in templated_actions:
+        families = None
+        if jobs > 1 and templated_action is not None:
+            families = get_action_branch_families(templated_action.split())
+        if families is not None and groups and group_families and \
+           len(groups[-1]) < jobs and not (families & group_families):
+            groups[-1].append((action, templated_action))
+            group_families |= families
+            continue
+        groups.append([(action, templated_action)])
+        group_families = families or set()
+    return groups
+
+
+def _run_action_in_clone(job):
+    """Runs an action in its own clone of origin, in a forked worker"""
+    index, templated_action, origin = job
+    action = templated_action.split()
+    tmp_dir = tempfile.mkdtemp()
+    clone_dir = os.path.join(tmp_dir, 'clone')
+    output_path = os.path.join(tmp_dir, 'output.log')
+    changed_refs = {}
+    orig_cwd = os.getcwd()
+    sys.stdout.flush()
+    sys.stderr.flush()
+    orig_fds = os.dup(1), os.dup(2)
+    with open(output_path, 'w') as output:
+        os.dup2(output.fileno(), 1)
+        os.dup2(output.fileno(), 2)
+        try:
+            clone_with_branches(origin, clone_dir)
+            os.chdir(clone_dir)
+            refs_before = get_refs()
+            if can_run_action_in_process(action):
+                ret = run_action_in_process(action)
+            else:
+                action[0] = find_full_path(action[0])
+                ret = subprocess.call(action, shell=False, env=os.environ.copy())
+            for ref, sha in get_refs().items():
+                if refs_before.get(ref) != sha:
+                    changed_refs[ref] = sha
+        except Exception:
+            bloom.util.print_exc(traceback.format_exception(*sys.exc_info()))
+            ret = 1
+        finally:
+            os.chdir(orig_cwd)
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(orig_fds[0], 1)
+            os.dup2(orig_fds[1], 2)
+            os.close(orig_fds[0])
+            os.close(orig_fds[1])
+    return index, ret, changed_refs, clone_dir, tmp_dir, output_path
+
+
+def execute_actions_concurrently(templated_actions, interactive):
+    """Runs independent actions at the same time, each in its own clone.
+
+    Each action runs in a forked worker process inside its own clone of the
+    current repository, so the actions share what bloom has already loaded,
+    like the rosdistro index, but not a working tree.  The output of each
+    action is captured and printed once all of them are done, in the order
+    of the track.  The branches and tags changed by each action are then
+    fetched back into the current repository one action at a time, so ref
+    updates never race with each other.
+
+    :param templated_actions: list of templated action strings
+    :param interactive: if False the user is never asked to skip a failed
+        action
+    :returns: list with the refs changed by each action, a skipped action
+        did not change any refs
+    :raises: SystemExit if an action fails and is not skipped
+    """
+    origin = get_root()
+    current_branch = get_current_branch()
+    info(fmt("@{bf}@!==> @|@!Running {0} actions concurrently:").format(len(templated_actions)))
+    for templated_action in templated_actions:
+        info(fmt("@{bf}@!    ==> @|@!" + sanitize(str(templated_action))))
+    jobs = [(index, templated_action, origin) for index, templated_action in enumerate(templated_actions)]
+    executor = ProcessPoolExecutor(max_workers=len(jobs), mp_context=multiprocessing.get_context('fork'))
+    try:
+        results = sorted(executor.map(_run_action_in_clone, jobs))
+    finally:
+        executor.shutdown()
+    all_changed_refs = []
+    try:
+        updated_refs = set()
+        for index, ret, changed_refs, clone_dir, tmp_dir, output_path in results:
+            action = templated_actions[index].split()
+            info('', use_prefix=False)
+            info(fmt("@{bf}@!==> @|@!" + sanitize(str(action))))
+            with open(output_path, 'r') as output:
+                info(output.read(), use_prefix=False, end='')
+            if ret > 0:
+                handle_action_failure(action, ret, interactive)
+                all_changed_refs.append({})
+                continue
+            conflicts = [r for r in changed_refs if r in updated_refs or
+                         r == 'refs/heads/' + str(current_branch)]
+            if conflicts:
+                error("Action '{0}' changed refs which were already updated: {1}"
+                      .format(' '.join(action), ', '.join(sorted(conflicts))), exit=True)
+            fetch_refs(clone_dir, list(changed_refs))
+            updated_refs.update(changed_refs)
+            all_changed_refs.append(changed_refs)
+    finally:
+        for index, ret, changed_refs, clone_dir, tmp_dir, output_path in results:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+    info('', use_prefix=False)
+    return all_changed_refs
+
+
+class ActionJournal(object):
+    """Records the completed actions of a release track.
+
+    The journal is kept in ``<git-dir>/bloom/journal-<track>.json`` of the
+    release repository, and the refs written by each action are preserved
+    under ``refs/bloom/journal/<track>/``, so that they survive the
+    transactional clone being thrown away when a later action fails.
+    A release run with ``--resume`` can then restore the refs of the
+    completed actions instead of running them again.
+    """
+    # Settings which point to temporary directories of a single run
+    volatile_settings = ['archive_dir_path', 'archive_path', 'vcs_local_uri']
+
+    def __init__(self, track, directory):
+        self.track = track
+        self.directory = directory
+        git_dir = check_output(['git', 'rev-parse', '--absolute-git-dir'], cwd=directory).strip()
+        self.path = os.path.join(git_dir, 'bloom', 'journal-' + track + '.json')
+        self.ref_prefix = 'refs/bloom/journal/' + track + '/'
+        self.data = None
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def _save(self):
+        if not os.path.isdir(os.path.dirname(self.path)):
+            os.makedirs(os.path.dirname(self.path))
+        with open(self.path, 'w') as f:
+            json.dump(self.data, f, indent=2, sort_keys=True)
+
+    def _load(self):
+        try:
+            with open(self.path, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError) as exc:
+            warning("Could not read the release journal '{0}': {1}".format(self.path, exc))
+            return None
+
+    def _get_journal_ref(self, index, ref):
+        return '{0}{1}/{2}'.format(self.ref_prefix, index, ref[len('refs/'):])
+
+    def _get_completed_actions(self, data, settings, actions):
+        if data.get('settings') != settings:
+            warning("The track settings changed since the journaled release, starting over.")
+            return 0
+        # Refs not written by the journaled actions must not have changed,
+        # the config branch is covered by comparing the settings and actions
+        journaled_refs = set(['refs/heads/' + BLOOM_CONFIG_BRANCH])
+        for entry in data['actions']:
+            journaled_refs.update(entry['refs'])
+        current_refs = get_refs(directory=self.directory)
+        for ref in set(current_refs) | set(data['base_refs']):
+            if ref not in journaled_refs and current_refs.get(ref) != data['base_refs'].get(ref):
+                warning("The release repository changed since the journaled release, starting over.")
+                return 0
+        preserved_refs = get_refs([self.ref_prefix], directory=self.directory)
+        completed = 0
+        for index, entry in enumerate(data['actions']):
+            if index >= len(actions) or entry['action'] != actions[index]:
+                break
+            if any(sha is not None and preserved_refs.get(self._get_journal_ref(index, ref)) != sha
+                   for ref, sha in entry['refs'].items()):
+                break
+            completed = index + 1
+        # Actions which did not write any refs, like exporting the upstream
+        # archive, have outputs which do not outlive the run they were in
+        while completed and not data['actions'][completed - 1]['refs']:
+            completed -= 1
+        return completed
+
+    def start(self, settings, actions, resume=False):
+        """Starts the journal of a release, resuming a previous one if possible.
+
+        :param settings: the track settings of the release
+        :param actions: list of the (not templated) actions of the track
+        :param resume: if True the completed actions of a previous release
+            of the same track with the same settings are kept
+        :returns: the number of leading actions which are already completed
+        """
+        settings = dict((k, v) for k, v in settings.items() if k not in self.volatile_settings)
+        completed = 0
+        data = self._load() if self.exists() else None
+        if data is not None and not resume:
+            warning("Discarding the journal of an unfinished release of track '{0}', "
+                    "use '--resume' to continue it instead.".format(self.track))
+        if data is not None and resume:
+            completed = self._get_completed_actions(data, settings, actions)
+            base_refs = data['base_refs']
+            entries = data['actions'][:completed]
+        else:
+            if resume:
+                warning("There is no journal of an unfinished release of track '{0}' to resume."
+                        .format(self.track))
+            self._delete_refs()
+            base_refs = get_refs(directory=self.directory)
+            entries = []
+        self.data = {'settings': settings, 'base_refs': base_refs, 'actions': entries}
+        self._save()
+        return completed
+
+    def restore(self, completed):
+        """Restores the refs of the completed actions in the current repository.
+
+        :param completed: the number of leading actions which are completed
+        """
+        refs = {}
+        for index, entry in enumerate(self.data['actions'][:completed]):
+            for ref, sha in entry['refs'].items():
+                refs[ref] = (self._get_journal_ref(index, ref), sha)
+        fetched = [(journal_ref, ref) for ref, (journal_ref, sha) in refs.items() if sha is not None]
+        if fetched:
+            refspecs = ['+{0}:{1}'.format(journal_ref, ref) for journal_ref, ref in sorted(fetched)]
+            cmd = ['git', 'fetch', '--quiet', '--no-tags', self.directory] + refspecs
+            execute_command(cmd, shell=False)
+        for ref, (journal_ref, sha) in sorted(refs.items()):
+            if sha is None and ref in get_refs([ref]):
+                execute_command(['git', 'update-ref', '-d', ref], shell=False)
+
+    def record(self, action, changed_refs):
+        """Records a completed action and preserves the refs it wrote.
+
+        :param action: the (not templated) action which completed
+        :param changed_refs: dict of the full ref names changed by the action
+            in the current repository to their new hashes, or None if the
+            ref was deleted
+        """
+        index = len(self.data['actions'])
+        refspecs = ['+{0}:{1}'.format(ref, self._get_journal_ref(index, ref))
+                    for ref, sha in sorted(changed_refs.items()) if sha is not None]
+        if refspecs:
+            cmd = ['git', 'fetch', '--quiet', '--no-tags', os.getcwd()] + refspecs
+            execute_command(cmd, shell=False, cwd=self.directory)
+        self.data['actions'].append({'action': action, 'refs': changed_refs})
+        self._save()
+
+    def _delete_refs(self):
+        refs = get_refs([self.ref_prefix], directory=self.directory)
+        if refs:
+            updates = ''.join('delete {0}\n'.format(ref) for ref in sorted(refs))
+            p = subprocess.Popen(['git', 'update-ref', '--stdin'], cwd=self.directory,
+                                 stdin=subprocess.PIPE)
+            p.communicate(updates.encode('utf-8'))
+
+    def clear(self):
+        """Removes the journal and the refs it preserved, after a successful release"""
+        self._delete_refs()
+        if self.exists():
+            os.remove(self.path)
+
+
+def get_changed_refs(refs_before, refs_after):
+    """Returns the refs which differ, with None for the deleted refs"""
+    changed_refs = dict((ref, sha) for ref, sha in refs_after.items() if refs_before.get(ref) != sha)
+    changed_refs.update((ref, None) for ref in refs_before if ref not in refs_after)
+    return changed_refs
+
+
+def execute_track(track, track_dict, release_inc, pretend=True, debug=False, fast=False, interactive=True,
+                  plan=False, jobs=1, journal=None, resume=False):
     info("Processing release track settings for '{0}'".format(track))
     settings = process_track_settings(track_dict, release_inc, interactive=interactive)
     # setup extra settings
     archive_dir_path = tempfile.mkdtemp()
     settings['archive_dir_path'] = archive_dir_path
+    # The export action writes archives in this format as well
+    archive_format = get_default_archive_format()
     if settings['release_tag'] != ':{none}':
-        archive_file = '{name}-{release_tag}.tar.gz'.format(**settings)
+        archive_file = '{name}-{release_tag}.'.format(**settings) + archive_format
     else:
-        archive_file = '{name}.tar.gz'.format(**settings)
+        archive_file = '{name}.'.format(**settings) + archive_format
     settings['archive_path'] = os.path.join(archive_dir_path, archive_file)
     # execute actions
     info("", use_prefix=False)
     info("Executing release track '{0}'".format(track))
+    templated_actions = []
     for action in track_dict['actions']:
         if 'bloom-export-upstream' in action and settings['vcs_type'] == 'tar':
-            warning("Explicitly skipping bloom-export-upstream for tar.")
+            templated_actions.append((action, None))
             settings['archive_path'] = settings['vcs_uri']
             continue
-        templated_action = template_str(action, settings)
+        templated_actions.append((action, template_str(action, settings)))
+    if pretend or plan:
+        jobs = 1
+        journal = None
+    if plan:
+        warning("Planning against the current release branches, the upstream is not "
+                "imported, so changes from a new upstream version are not reported.")
+    completed = 0
+    if journal is not None:
+        completed = journal.start(settings, track_dict['actions'], resume)
+        if completed:
+            info(fmt("@{bf}@!==> @|@!Resuming release, restoring the results of {0} completed actions:")
+                 .format(completed))
+            for action, templated_action in templated_actions[:completed]:
+                info(fmt("@{bf}@!    ==> @|") + sanitize(str(templated_action or action)))
+            journal.restore(completed)
+            info('', use_prefix=False)
+    if not pretend:
+        if debug and 'DEBUG' not in os.environ:
+            os.environ['DEBUG'] = '1'
+        if fast and 'BLOOM_UNSAFE' not in os.environ:
+            os.environ['BLOOM_UNSAFE'] = '1'
+    groups = get_concurrent_action_groups(templated_actions[completed:], jobs)
+    streamed = False
+    for index, group in enumerate(groups):
+        if streamed:
+            # This import was streamed together with the preceding export
+            streamed = False
+            continue
+        if len(group) > 1:
+            all_changed_refs = execute_actions_concurrently([t for a, t in group], interactive)
+            if journal is not None:
+                for (action, templated_action), changed_refs in zip(group, all_changed_refs):
+                    journal.record(action, changed_refs)
+            continue
+        action, templated_action = group[0]
+        if templated_action is None:
+            warning("Explicitly skipping bloom-export-upstream for tar.")
+            if journal is not None:
+                journal.record(action, {})
+            continue
         info(fmt("@{bf}@!==> @|@!" + sanitize(str(templated_action))))
         if pretend:
             continue
+        templated_action = templated_action.split()
+        if plan:
+            if 'bloom-generate' not in templated_action[0]:
+                info("Not planned, this action modifies the release repository.")
+                continue
+            # Generators can report their changes without making them
+            templated_action.insert(1, '--plan')
         stdout = None
         stderr = None
         if bloom.util._quiet:
             stdout = subprocess.PIPE
             stderr = subprocess.STDOUT
-        if debug and 'DEBUG' not in os.environ:
-            os.environ['DEBUG'] = '1'
-        if fast and 'BLOOM_UNSAFE' not in os.environ:
-            os.environ['BLOOM_UNSAFE'] = '1'
-        templated_action = templated_action.split()
-        templated_action[0] = find_full_path(templated_action[0])
-        p = subprocess.Popen(templated_action, stdout=stdout, stderr=stderr,
-                             shell=False, env=os.environ.copy())
-        out, err = p.communicate()
-        if bloom.util._quiet:
-            info(out, use_prefix=False)
-        ret = p.returncode
+        if journal is not None:
+            refs_before = get_refs()
+        next_action, next_templated_action = groups[index + 1][0] if index + 1 < len(groups) else (None, None)
+        stream_args = None
+        if not plan and next_templated_action is not None:
+            later_actions = [t.split() for g in groups[index + 2:] for a, t in g if t is not None]
+            stream_args = get_streamed_upstream_import(
+                templated_action, next_templated_action.split(), later_actions)
+        ret = None
+        if stream_args is not None:
+            ret = run_streamed_upstream_import(*stream_args)
+            if ret is None:
+                info("Could not stream the upstream into the upstream branch, exporting an archive instead")
+            else:
+                info(fmt("@{bf}@!==> @|@!" + sanitize(str(next_templated_action))) + " (streamed)")
+                streamed = True
+                templated_action = next_templated_action.split()
+        if ret is None and can_run_action_in_process(templated_action):
+            ret = run_action_in_process(templated_action)
+        elif ret is None:
+            templated_action[0] = find_full_path(templated_action[0])
+            p = subprocess.Popen(templated_action, stdout=stdout, stderr=stderr,
+                                 shell=False, env=os.environ.copy())
+            out, err = p.communicate()
+            if bloom.util._quiet:
+                info(out, use_prefix=False)
+            ret = p.returncode
         if ret > 0:
-            if 'bloom-generate' in templated_action[0] and ret == code.GENERATOR_NO_ROSDEP_KEY_FOR_DISTRO:
-                error(fmt(_error + "The following generator action reported that it is missing one or more"))
-                error(fmt("    @|rosdep keys, but that the key exists in other platforms:"))
-                error(fmt("@|'@!{0}'@|").format(templated_action))
-                info('', use_prefix=False)
-                error(fmt("@|If you are @!@_@{rf}absolutely@| sure that this key is unavailable for the platform in"))
-                error(fmt("@|question, the generator can be skipped and you can proceed with the release."))
-                if interactive and maybe_continue('n', 'Skip generator action and continue with release'):
-                    info("\nAction skipped, continuing with release.\n")
-                    continue
-
-                info('', use_prefix=False)
-
-            error(fmt(_error + "Error running command '@!{0}'@|")
-                  .format(templated_action), exit=True)
+            handle_action_failure(templated_action, ret, interactive)
+        if journal is not None:
+            if streamed:
+                journal.record(action, {})
+                action = next_action
+            journal.record(action, get_changed_refs(refs_before, get_refs()))
         info('', use_prefix=False)
-    if not pretend:
+    if not pretend and not plan:
         # Update the release_inc
         tracks_dict = get_tracks_dict_raw()
         tracks_dict['tracks'][track]['release_inc'] = settings['release_inc']
@@ -326,8 +1007,19 @@ def get_argument_parser(tracks):
         help="overrides the automatic release increment number")
     add('--pretend', '-p', action="store_true", default=False,
         help="does everything but actually run the commands")
+    add('--plan', action="store_true", default=False,
+        help="reports what the generator actions would change in the "
+             "current release branches, without modifying the repository; "
+             "the upstream is not exported or imported, so a new upstream "
+             "version is not reflected in the plan")
     add('--non-interactive', '-y', action="store_false", default=True,
         help="runs without user interaction", dest='interactive')
+    add('--resume', action="store_true", default=False,
+        help="continues an unfinished release of the track, restoring the "
+             "results of the actions which completed instead of running them again")
+    add('-j', '--jobs', type=int, default=1, metavar='N',
+        help="number of independent generator actions to run concurrently, "
+             "e.g. the debian and rpm generators of a track")
     return parser
 
 
@@ -355,16 +1047,35 @@ def main(sysargs=None):
 
     verify_track(args.track, tracks_dict['tracks'][args.track])
 
+    if args.plan:
+        # Nothing is modified, so no clone is needed
+        execute_track(args.track, tracks_dict['tracks'][args.track],
+                      args.release_increment, False, args.debug,
+                      args.unsafe, interactive=args.interactive, plan=True)
+        return
+
+    journal = None
+    if not args.pretend and 'BLOOM_NO_RELEASE_JOURNAL' not in os.environ:
+        journal = ActionJournal(args.track, get_root())
     git_clone = GitClone()
     with git_clone:
         quiet_git_clone_warning(True)
         disable_git_clone(True)
-        execute_track(args.track, tracks_dict['tracks'][args.track],
-                      args.release_increment, args.pretend, args.debug,
-                      args.unsafe, interactive=args.interactive)
+        try:
+            execute_track(args.track, tracks_dict['tracks'][args.track],
+                          args.release_increment, args.pretend, args.debug,
+                          args.unsafe, interactive=args.interactive, jobs=args.jobs,
+                          journal=journal, resume=args.resume)
+        except SystemExit:
+            if journal is not None and journal.data and journal.data['actions']:
+                warning("The completed actions were journaled, run 'git-bloom-release --resume {0}' "
+                        "to continue the release.".format(args.track))
+            raise
         disable_git_clone(False)
         quiet_git_clone_warning(False)
     git_clone.commit()
+    if journal is not None:
+        journal.clear()
 
     # Notify the user of success and next action suggestions
     info('\n\n', use_prefix=False)
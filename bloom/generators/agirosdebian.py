@@ -71,7 +71,7 @@ class AgirosDebianGenerator(DebianGenerator):
             return default_fallback_resolver(key, peer_packages)
 
         subs = generate_substitutions_from_package(
-            package, self.os_name, debian_distro, self.rosdistro,
+            package, self.get_os_name(debian_distro), debian_distro, self.rosdistro,
             self.install_prefix, self.debian_inc,
             [p.name for p in self.packages.values()],
             releaser_history=releaser_history,
@@ -54,7 +54,7 @@ class AgirosRpmGenerator(RpmGenerator):
         # Generate base substitutions using the parent logic
         subs = generate_substitutions_from_package(
             package,
-            self.os_name,
+            self.get_os_name(rpm_distro),
             rpm_distro,
             self.rosdistro,
             self.install_prefix,
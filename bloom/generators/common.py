@@ -1,16 +1,33 @@
+import copy
+import functools
+import hashlib
+import json
+import os
 import pkg_resources
+import shutil
 import sys
+import tempfile
 import traceback
 import subprocess
 
+import bloom
+
+from bloom.git import cat_files
+from bloom.git import get_object_hash
+from bloom.git import has_changes
+from bloom.git import inbranch
+from bloom.git import list_tree_files
+from bloom.git import show
 from bloom.logging import debug, error, info
+from bloom.packages import get_package_data
 from bloom.rosdistro_api import (
+    get_distribution_file,
     get_distribution_type,
     get_index,
     get_python_version,
     get_sources_list_url,
 )
-from bloom.util import code, maybe_continue, print_exc
+from bloom.util import code, execute_command, maybe_continue, print_exc
 
 try:
     from rosdep2.catkin_support import get_catkin_view
@@ -20,12 +37,25 @@ except ImportError:
     debug(traceback.format_exc())
     error("rosdep was not detected, please install it.", exit=True)
 
+try:
+    import em
+except ImportError:
+    debug(traceback.format_exc())
+    error("empy was not detected, please install it.", exit=True)
+
 BLOOM_GROUP = "bloom.generators"
 DEFAULT_ROS_DISTRO = "loong"
 
 # 缓存 agirosdep resolve 结果，加速重复调用
 _resolve_cache = {}
 view_cache = {}
+_template_group_hashes = {}
+# Distro independent substitutions, see memoize_base_substitutions
+_base_substitutions = {}
+# Shared between generators run in the same process, see --generators
+_conditional_contexts = {}
+_evaluated_conditions = {}
+_has_run_rosdep_update = False
 
 
 def list_generators():
@@ -55,16 +85,265 @@ def invalidate_view_cache():
     view_cache = {}
 
 
-def update_rosdep():
+def get_template_group_files(group, path):
+    """
+    Returns the contents of a template folder without placing it anywhere.
+
+    :param group: pkg_resources group holding the templates,
+        e.g. ``bloom.generators.debian``
+    :param path: template folder in the group, e.g. ``templates/ament_cmake``
+    :returns: dict of paths relative to the template folder to their contents
+    """
+    files = {}
+
+    def walk(folder):
+        for item in sorted(pkg_resources.resource_listdir(group, folder)):
+            item_path = os.path.join(folder, item)
+            if pkg_resources.resource_isdir(group, item_path):
+                walk(item_path)
+                continue
+            template = pkg_resources.resource_string(group, item_path)
+            if not isinstance(template, str):
+                template = template.decode('utf-8')
+            files[os.path.relpath(item_path, path)] = template
+    if pkg_resources.resource_isdir(group, path):
+        walk(path)
+    return files
+
+
+def get_branch_template_files(reference, path):
+    """
+    Returns the template files in a folder of a git reference.
+
+    :param reference: git reference holding placed templates, e.g. ``debian/foo``
+    :param path: folder of the templates in the reference, e.g. ``debian``
+    :returns: dict of paths relative to path to their contents, empty if
+        the reference or folder does not exist
+    """
+    files = list_tree_files(reference, path) or {}
+    templates = [name for name in files if name.endswith('.em')]
+    contents = cat_files(files[name][1] for name in templates)
+    return dict((os.path.relpath(name, path), contents[files[name][1]].decode('utf-8'))
+                for name in templates)
+
+
+def get_template_group_hash(group, path):
+    """
+    Returns a SHA-1 hash of the names and contents of a template folder.
+
+    :param group: pkg_resources group holding the templates,
+        e.g. ``bloom.generators.debian``
+    :param path: template folder in the group, e.g. ``templates/ament_cmake``
+    """
+    key = (group, path)
+    if key not in _template_group_hashes:
+        digest = hashlib.sha1()
+        for name, template in sorted(get_template_group_files(group, path).items()):
+            digest.update(name.encode('utf-8') + b'\0')
+            digest.update(template.encode('utf-8') + b'\0')
+        _template_group_hashes[key] = digest.hexdigest()
+    return _template_group_hashes[key]
+
+
+def export_package_files(package, reference, directory):
+    """
+    Writes the files substitutions are generated from into a directory.
+
+    The package.xml, CHANGELOG.rst, setup.cfg and any license files are read
+    from the given reference, so no checkout is needed.
+
+    :param package: catkin_pkg Package, which lives at the root of reference
+    :param reference: git reference to read the package files from
+    :param directory: directory to write the files to
+    :returns: a copy of package whose filename points into directory
+    """
+    paths = ['package.xml', 'CHANGELOG.rst', 'setup.cfg']
+    paths.extend(l.file for l in package.licenses if getattr(l, 'file', None))
+    contents = cat_files('{0}:{1}'.format(reference, path) for path in paths)
+    for path in paths:
+        content = contents['{0}:{1}'.format(reference, path)]
+        if content is None:
+            continue
+        file_path = os.path.join(directory, path)
+        if not os.path.isdir(os.path.dirname(file_path)):
+            os.makedirs(os.path.dirname(file_path))
+        with open(file_path, 'wb') as f:
+            f.write(content)
+    exported_package = copy.copy(package)
+    exported_package.filename = os.path.join(directory, 'package.xml')
+    return exported_package
+
+
+def expand_template_files(templates, subs, prefix, skip_empty=()):
+    """
+    Expands templates in memory, like the generators do in place.
+
+    :param templates: dict of template paths, relative to the packaging
+        folder, to their contents
+    :param subs: substitutions to expand the templates with
+    :param prefix: packaging folder, e.g. ``debian``
+    :param skip_empty: names of files which are not written if they are empty
+    :returns: dict of the resulting file paths, prefixed with prefix, to
+        their contents
+    """
+    results = {}
+    for path, template in sorted(templates.items()):
+        if not path.endswith('.em'):
+            continue
+        result = em.expand(template, **subs)
+        result_path = path[:-len('.em')]
+        if len(result) == 0 and os.path.basename(result_path) in skip_empty:
+            continue
+        results[os.path.join(prefix, result_path)] = result
+    return results
+
+
+def convert_to_unicode(obj):
+    if sys.version_info.major == 2:
+        if isinstance(obj, str):
+            return unicode(obj.decode('utf8'))
+        elif isinstance(obj, unicode):
+            return obj
+    else:
+        if isinstance(obj, bytes):
+            return str(obj.decode('utf8'))
+        elif isinstance(obj, str):
+            return obj
+    if isinstance(obj, list):
+        for i, val in enumerate(obj):
+            obj[i] = convert_to_unicode(val)
+        return obj
+    elif isinstance(obj, type(None)):
+        return None
+    elif isinstance(obj, tuple):
+        obj_tmp = list(obj)
+        for i, val in enumerate(obj_tmp):
+            obj_tmp[i] = convert_to_unicode(obj_tmp[i])
+        return tuple(obj_tmp)
+    elif isinstance(obj, int):
+        return obj
+    raise RuntimeError('need to deal with type %s' % (str(type(obj))))
+
+
+def memoize_base_substitutions(func):
+    """
+    Memoizes a function returning the distro independent substitutions of a package.
+
+    The substitutions are cached per package.xml content and arguments, and
+    callers get a deep copy, so they can add the distro specific
+    substitutions in place.  The cache only lives for one generator run,
+    see :py:func:`clear_base_substitutions`.
+
+    :param func: function taking the package and hashable arguments
+    :returns: the memoized function
+    """
+    @functools.wraps(func)
+    def wrapper(package, *args, **kwargs):
+        filename = getattr(package, 'filename', None)
+        if not filename or not os.path.isfile(filename):
+            return func(package, *args, **kwargs)
+        with open(filename, 'rb') as f:
+            package_hash = hashlib.sha1(f.read()).hexdigest()
+        key = (func, package_hash) + args + tuple(sorted(kwargs.items()))
+        if key not in _base_substitutions:
+            _base_substitutions[key] = func(package, *args, **kwargs)
+        return copy.deepcopy(_base_substitutions[key])
+    return wrapper
+
+
+def clear_base_substitutions():
+    """Clears the substitutions cached by :py:func:`memoize_base_substitutions`."""
+    _base_substitutions.clear()
+
+
+def get_generation_fingerprint(inputs):
+    """
+    Returns a SHA-1 fingerprint of the given generation inputs.
+
+    :param inputs: JSON serializable dict of everything a generated branch
+        depends on, e.g. blob hashes, resolved dependencies and increments
+    """
+    return hashlib.sha1(json.dumps(inputs, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+def get_branch_package_data(branch):
+    """
+    Returns the package data of a branch without checking it out.
+
+    The result of :py:func:`bloom.packages.get_package_data` is cached on
+    the tree of the branch, so running several generators over the same
+    release branches only parses them once.
+
+    :param branch: name of the branch to get the package data from
+    :returns: the return value of :py:func:`bloom.packages.get_package_data`
+    :raises: SystemExit if no packages could be found in the branch
+    """
+    if get_object_hash(branch) is None:
+        # Only a remote branch, let inbranch track it
+        with inbranch(branch):
+            return get_package_data(branch)
+    return get_package_data(branch, reference=branch)
+
+
+def get_generation_targets(targets, ros_distro):
+    """
+    Expands a list of 'os_name[:os_version]' targets into (os_name, os_version) pairs.
+
+    A target without a version expands to every release platform of that os
+    in the distribution file of the given rosdistro. The os versions name the
+    generated branches, so the same version cannot be used by two oses.
+
+    :param targets: list of 'os_name[:os_version]' strings
+    :param ros_distro: rosdistro whose release platforms are used
+    :returns: list of (os_name, os_version) tuples, in the given order
+    """
+    pairs = []
+    for target in targets:
+        os_name, _, os_version = target.partition(':')
+        if not os_name:
+            error("Invalid target '{0}', expected 'os_name[:os_version]'.".format(target), exit=True)
+        if os_version:
+            os_versions = [os_version]
+        else:
+            release_platforms = get_distribution_file(ros_distro).release_platforms
+            if os_name not in release_platforms:
+                error("No platforms defined for os '{0}' in release file for the '{1}' distro."
+                      .format(os_name, ros_distro), exit=True)
+            os_versions = release_platforms[os_name]
+        pairs.extend(p for p in [(os_name, v) for v in os_versions] if p not in pairs)
+    os_names = {}
+    for os_name, os_version in pairs:
+        if os_names.setdefault(os_version, os_name) != os_name:
+            error("Targets '{0}:{2}' and '{1}:{2}' would be generated into the same branches."
+                  .format(os_names[os_version], os_name, os_version), exit=True)
+    return pairs
+
+
+def update_rosdep(once=False):
+    """
+    Runs 'agirosdep update'.
+
+    :param once: if True, skip the update if it already ran in this process
+    """
+    global _has_run_rosdep_update
+    if once and _has_run_rosdep_update:
+        return
     info("Running 'agirosdep update'...")
     try:
         subprocess.check_call(["agirosdep", "update"])
     except subprocess.CalledProcessError:
         print_exc(traceback.format_exc())
         error("Failed to update agirosdep (check your sources.list.d), aborting.", exit=True)
+    _has_run_rosdep_update = True
 
 
 def package_conditional_context(ros_distro):
+    if ros_distro not in _conditional_contexts:
+        _conditional_contexts[ros_distro] = _package_conditional_context(ros_distro)
+    return dict(_conditional_contexts[ros_distro])
+
+
+def _package_conditional_context(ros_distro):
     if get_index().version < 4:
         error(
             "Bloom requires a version 4 or greater rosdistro index to support package format 3.",
@@ -100,8 +379,15 @@ def package_conditional_context(ros_distro):
 
 
 def evaluate_package_conditions(package, ros_distro):
-    if package.package_format >= 3:
-        package.evaluate_conditions(package_conditional_context(ros_distro))
+    if package.package_format < 3:
+        return
+    # Package uses __slots__, so remember evaluated packages by identity,
+    # keeping a reference to the package so its id cannot be reused
+    evaluated = _evaluated_conditions.get(id(package))
+    if evaluated is not None and evaluated[0] is package and evaluated[1] == ros_distro:
+        return
+    package.evaluate_conditions(package_conditional_context(ros_distro))
+    _evaluated_conditions[id(package)] = (package, ros_distro)
 
 
 def _guess_installer_for_os(os_name: str) -> str:
@@ -219,6 +505,41 @@ def resolve_dependencies(
     return resolved_keys
 
 
+def resolve_package_dependencies(package, os_name, os_version, ros_distro, peer_packages,
+                                 fallback_resolver=None, skip_keys=None):
+    """
+    Resolves the dependencies of a package whose conditions hold for ros_distro.
+
+    :param skip_keys: names of run, build and test dependencies to leave out
+    :returns: tuple of the depends, build_depends, test_depends, replaces and
+        conflicts lists and the dict of resolved rosdep keys
+    """
+    skip_keys = skip_keys or set()
+    evaluate_package_conditions(package, ros_distro)
+    depends = [
+        dep for dep in (package.run_depends + package.buildtool_export_depends)
+        if dep.evaluated_condition is not False and dep.name not in skip_keys]
+    build_depends = [
+        dep for dep in (package.build_depends + package.buildtool_depends)
+        if dep.evaluated_condition is not False and dep.name not in skip_keys]
+    test_depends = [
+        dep for dep in (package.test_depends)
+        if dep.evaluated_condition is not False and dep.name not in skip_keys]
+    replaces = [
+        dep for dep in package.replaces
+        if dep.evaluated_condition is not False]
+    conflicts = [
+        dep for dep in package.conflicts
+        if dep.evaluated_condition is not False]
+    unresolved_keys = depends + build_depends + test_depends + replaces + conflicts
+    # The installer key is not considered here, but it is checked when the keys are checked before this
+    resolved_deps = resolve_dependencies(unresolved_keys, os_name,
+                                         os_version, ros_distro,
+                                         peer_packages + [d.name for d in (replaces + conflicts)],
+                                         fallback_resolver)
+    return depends, build_depends, test_depends, replaces, conflicts, resolved_deps
+
+
 class GeneratorError(Exception):
     def __init__(self, msg, returncode=code.UNKNOWN):
         super(GeneratorError, self).__init__("Error running generator: " + msg)
@@ -238,6 +559,16 @@ class BloomGenerator(object):
     title = "no title"
     description = None
     help = None
+    # Generators of packaging files set these to skip distro branches whose
+    # generation inputs did not change, e.g. 'debian', 'bloom.generators.debian'
+    # and 'debian.fingerprint'.  Their distro branches are named
+    # <packaging_prefix>/<distro>/<package>.
+    packaging_prefix = None
+    template_group = None
+    fingerprint_filename = None
+    fallback_resolver = None
+    # Name of the attribute holding the increment, e.g. 'debian_inc'
+    increment_attribute = None
 
     @classmethod
     def exit(cls, msg, returncode=code.UNKNOWN):
@@ -258,6 +589,125 @@ class BloomGenerator(object):
     def pre_modify(self):
         return 0
 
+    def get_template_branches(self):
+        """Returns the branches templates are placed in, which are never skipped."""
+        return []
+
+    def get_increment(self):
+        """Returns the increment of the generated versions, or None if there is none."""
+        if self.increment_attribute is None:
+            return None
+        return getattr(self, self.increment_attribute, None)
+
+    def is_fingerprinted(self, destination):
+        """Returns True if the generation inputs of a branch can be fingerprinted."""
+        return self.fingerprint_filename is not None and self.get_increment() is not None and \
+            destination not in self.get_template_branches()
+
+    def resolve_generation_dependencies(self, package, distro):
+        peer_packages = [p.name for p in self.packages.values()]
+        return resolve_package_dependencies(
+            package, self.get_os_name(distro), distro, self.rosdistro, peer_packages,
+            self.fallback_resolver, getattr(self, 'skip_keys', None))[-1]
+
+    def get_generation_inputs(self, package, distro, source, package_source):
+        """
+        Returns everything a distro branch is generated from.
+
+        :param package: catkin_pkg Package being generated
+        :param distro: os version of the distro branch
+        :param source: branch the distro branch is branched from, holding the
+            placed templates
+        :param package_source: release branch of the package
+        """
+        templates = os.path.join('templates', package.get_build_type())
+        return {
+            'generator': self.title,
+            'bloom_version': bloom.__version__,
+            'package_tree': get_object_hash(package_source + '^{tree}'),
+            'templates': get_template_group_hash(self.template_group, templates),
+            'source_templates': get_object_hash(source, self.packaging_prefix),
+            'dependencies': self.resolve_generation_dependencies(package, distro),
+            'increment': str(self.get_increment()),
+            'install_prefix': self.install_prefix,
+            'os_name': self.get_os_name(distro),
+            'distribution': distro,
+        }
+
+    def store_generation_fingerprint(self, fingerprint, tag_name, patches_branch):
+        with inbranch(patches_branch):
+            with open(self.fingerprint_filename, 'w+') as f:
+                f.write(json.dumps({'fingerprint': fingerprint, 'tag': tag_name}))
+            execute_command('git add ' + self.fingerprint_filename)
+            if has_changes():
+                execute_command('git commit -m "Store generation fingerprint"')
+
+    def load_generation_fingerprint(self, patches_branch):
+        stored = show(patches_branch, self.fingerprint_filename)
+        if stored is None:
+            return stored
+        return json.loads(stored)
+
+    def is_branch_up_to_date(self, destination, source):
+        if not self.is_fingerprinted(destination):
+            return False
+        name = destination.split('/')[-1]
+        distro = destination.split('/')[-2]
+        package = self.packages[name]
+        inputs = self.get_generation_inputs(package, distro, source, self.package_branches[name])
+        fingerprint = get_generation_fingerprint(inputs)
+        self.fingerprints[destination] = fingerprint
+        if self.regenerate:
+            return False
+        stored = self.load_generation_fingerprint('patches/' + destination)
+        if stored is None or stored.get('fingerprint') != fingerprint:
+            return False
+        commit = get_object_hash(destination)
+        if commit is None:
+            return False
+        # Reuse the existing tag, re-pointing it if it is missing or stale
+        tag_name = stored['tag']
+        if get_object_hash(tag_name + '^{commit}') != commit:
+            info("Pointing tag '{0}' at the unchanged '{1}' branch.".format(tag_name, destination))
+            execute_command('git tag -f {0} {1}'.format(tag_name, commit))
+        return True
+
+    def plan_branch(self, destination, source):
+        """
+        Returns the files a distro branch would be generated with.
+
+        :returns: dict of file paths to their contents, empty if the branch is
+            up to date, or None if the branch is not planned
+        """
+        if not self.is_fingerprinted(destination):
+            return None
+        name = destination.split('/')[-1]
+        distro = destination.split('/')[-2]
+        package = self.packages[name]
+        # The distro branch is generated from the package files of the release branch
+        package_source = self.package_branches[name]
+        inputs = self.get_generation_inputs(package, distro, source, package_source)
+        stored = self.load_generation_fingerprint('patches/' + destination)
+        if not self.regenerate and stored is not None and \
+                stored.get('fingerprint') == get_generation_fingerprint(inputs) and \
+                get_object_hash(destination) is not None:
+            return {}
+        raw_history = show('patches/' + destination, 'releaser_history.json')
+        releaser_history = None if raw_history is None else json.loads(raw_history)
+        templates = get_branch_template_files(source, self.packaging_prefix)
+        if not templates:
+            templates = get_template_group_files(
+                self.template_group, os.path.join('templates', package.get_build_type()))
+        tmp_dir = tempfile.mkdtemp()
+        try:
+            subs = self.get_subs(export_package_files(package, package_source, tmp_dir), distro, releaser_history)
+        finally:
+            shutil.rmtree(tmp_dir)
+        return self.expand_plan_files(templates, subs)
+
+    def expand_plan_files(self, templates, subs):
+        return expand_template_files(templates, subs, self.packaging_prefix)
+
     def pre_branch(self, destination, source):
         return 0
 
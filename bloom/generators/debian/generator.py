@@ -53,12 +53,17 @@ from packaging.version import parse as parse_version
 
 from bloom.generators import BloomGenerator
 from bloom.generators import GeneratorError
-from bloom.generators import resolve_dependencies
 from bloom.generators import update_rosdep
 
+from bloom.generators.common import convert_to_unicode
 from bloom.generators.common import default_fallback_resolver
+from bloom.generators.common import get_branch_package_data
+from bloom.generators.common import get_generation_targets
 from bloom.generators.common import invalidate_view_cache
+from bloom.generators.common import memoize_base_substitutions
 from bloom.generators.common import evaluate_package_conditions
+from bloom.generators.common import expand_template_files
+from bloom.generators.common import resolve_package_dependencies
 from bloom.generators.common import resolve_rosdep_key
 
 from bloom.git import inbranch
@@ -81,7 +86,9 @@ from bloom.logging import warning
 from bloom.commands.git.patch.common import get_patch_config
 from bloom.commands.git.patch.common import set_patch_config
 
-from bloom.packages import get_package_data
+from bloom.packages import get_changelog_from_file
+
+from bloom.rosdistro_api import get_distribution_file
 
 from bloom.util import code
 from bloom.util import to_unicode
@@ -90,7 +97,6 @@ from bloom.util import get_rfc_2822_date
 from bloom.util import maybe_continue
 
 try:
-    from catkin_pkg.changelog import get_changelog_from_path
     from catkin_pkg.changelog import CHANGELOG_FILENAME
 except ImportError as err:
     debug(traceback.format_exc())
@@ -280,7 +286,7 @@ def get_changelogs(package, releaser_history=None):
     package_path = os.path.abspath(os.path.dirname(package.filename))
     changelog_path = os.path.join(package_path, CHANGELOG_FILENAME)
     if os.path.exists(changelog_path):
-        changelog = get_changelog_from_path(changelog_path)
+        changelog = get_changelog_from_file(changelog_path)
         changelogs = []
         maintainer = (package.maintainers[0].name, package.maintainers[0].email)
         for version, date, changes in changelog.foreach_version(reverse=True):
@@ -306,19 +312,18 @@ def missing_dep_resolver(key, peer_packages):
     return default_fallback_resolver(key, peer_packages)
 
 
-def generate_substitutions_from_package(
-    package,
-    os_name,
-    os_version,
-    ros_distro,
-    installation_prefix='/usr',
-    deb_inc=0,
-    peer_packages=None,
-    releaser_history=None,
-    fallback_resolver=None,
-    native=False
-):
-    peer_packages = peer_packages or []
+@memoize_base_substitutions
+def generate_base_substitutions(package, installation_prefix='/usr', deb_inc=0, native=False):
+    """
+    Returns the substitutions of a package which are the same for every distro.
+
+    The result is memoized, see
+    :py:func:`bloom.generators.common.memoize_base_substitutions`.
+
+    :param package: catkin_pkg Package, its filename locates license files
+        and setup.cfg
+    :returns: dict of substitutions, see :py:func:`generate_substitutions_from_package`
+    """
     data = {}
     # Name, Version, Description
     data['Name'] = package.name
@@ -344,44 +349,6 @@ def generate_substitutions_from_package(
     data['Package'] = sanitize_package_name(package.name)
     # Installation prefix
     data['InstallationPrefix'] = installation_prefix
-    # Resolve dependencies
-    evaluate_package_conditions(package, ros_distro)
-    depends = [
-        dep for dep in (package.run_depends + package.buildtool_export_depends)
-        if dep.evaluated_condition is not False]
-    build_depends = [
-        dep for dep in (package.build_depends + package.buildtool_depends)
-        if dep.evaluated_condition is not False]
-    test_depends = [
-        dep for dep in (package.test_depends)
-        if dep.evaluated_condition is not False]
-    replaces = [
-        dep for dep in package.replaces
-        if dep.evaluated_condition is not False]
-    conflicts = [
-        dep for dep in package.conflicts
-        if dep.evaluated_condition is not False]
-    unresolved_keys = depends + build_depends + test_depends + replaces + conflicts
-    # The installer key is not considered here, but it is checked when the keys are checked before this
-    resolved_deps = resolve_dependencies(unresolved_keys, os_name,
-                                         os_version, ros_distro,
-                                         peer_packages + [d.name for d in (replaces + conflicts)],
-                                         fallback_resolver)
-    data['Depends'] = sorted(
-        set(format_depends(depends, resolved_deps))
-    )
-    # For more information on <!nocheck>, see
-    # https://wiki.debian.org/BuildProfileSpec
-    data['BuildDepends'] = sorted(
-        set(format_depends(build_depends, resolved_deps)) |
-        set(p + ' <!nocheck>' for p in format_depends(test_depends, resolved_deps))
-    )
-    data['Replaces'] = sorted(
-        set(format_depends(replaces, resolved_deps))
-    )
-    data['Conflicts'] = sorted(
-        set(format_depends(conflicts, resolved_deps))
-    )
 
     # Build-type specific substitutions.
     build_type = package.get_build_type()
@@ -411,8 +378,6 @@ def generate_substitutions_from_package(
             "Build type '{}' is not supported by this version of bloom.".
             format(build_type), exit=True)
 
-    # Set the distribution
-    data['Distribution'] = os_version
     # Use the time stamp to set the date strings
     stamp = datetime.datetime.now(tz.tzlocal())
     data['Date'] = stamp.strftime('%a, %d %b %Y %T %z')
@@ -423,6 +388,70 @@ def generate_substitutions_from_package(
         maintainers.append(str(m))
     data['Maintainer'] = maintainers[0]
     data['Maintainers'] = ', '.join(maintainers)
+    # Copyright
+    licenses = []
+    for l in package.licenses:
+        if hasattr(l, 'file') and l.file is not None:
+            license_file = os.path.join(os.path.dirname(package.filename), l.file)
+            if not os.path.exists(license_file):
+                error("License file '{}' is not found.".
+                      format(license_file), exit=True)
+            with open(license_file, 'r') as f:
+                license_text = f.read().rstrip()
+            licenses.append((str(l), format_multiline(license_text)))
+        else:
+            licenses.append((str(l), 'See repository for full license text'))
+    data['Licenses'] = licenses
+
+    for item in data.items():
+        data[item[0]] = convert_to_unicode(item[1])
+
+    return data
+
+
+def generate_distro_substitutions(
+    base,
+    package,
+    os_name,
+    os_version,
+    ros_distro,
+    peer_packages=None,
+    releaser_history=None,
+    fallback_resolver=None
+):
+    """
+    Adds the distro specific substitutions of a package to its base substitutions.
+
+    These are the resolved dependencies, the distribution and the
+    changelogs, which depend on the releaser history of the distro branch.
+
+    :param base: substitutions from :py:func:`generate_base_substitutions`,
+        which are updated in place
+    :returns: the updated substitutions
+    """
+    peer_packages = peer_packages or []
+    data = {}
+    # Resolve dependencies
+    depends, build_depends, test_depends, replaces, conflicts, resolved_deps = \
+        resolve_package_dependencies(package, os_name, os_version, ros_distro, peer_packages, fallback_resolver)
+    data['Depends'] = sorted(
+        set(format_depends(depends, resolved_deps))
+    )
+    # For more information on <!nocheck>, see
+    # https://wiki.debian.org/BuildProfileSpec
+    data['BuildDepends'] = sorted(
+        set(format_depends(build_depends, resolved_deps)) |
+        set(p + ' <!nocheck>' for p in format_depends(test_depends, resolved_deps))
+    )
+    data['Replaces'] = sorted(
+        set(format_depends(replaces, resolved_deps))
+    )
+    data['Conflicts'] = sorted(
+        set(format_depends(conflicts, resolved_deps))
+    )
+
+    # Set the distribution
+    data['Distribution'] = os_version
     # Changelog
     changelogs = get_changelogs(package, releaser_history)
     if changelogs and package.version not in [x[0] for x in changelogs]:
@@ -466,52 +495,31 @@ def generate_substitutions_from_package(
     data['changelogs'] = changelogs
     # Use debhelper version 7 for oneric, otherwise 9
     data['debhelper_version'] = 7 if os_version in ['oneiric'] else 9
-    # Summarize dependencies
-    summarize_dependency_mapping(data, depends, build_depends, resolved_deps)
-    # Copyright
-    licenses = []
-    for l in package.licenses:
-        if hasattr(l, 'file') and l.file is not None:
-            license_file = os.path.join(os.path.dirname(package.filename), l.file)
-            if not os.path.exists(license_file):
-                error("License file '{}' is not found.".
-                      format(license_file), exit=True)
-            license_text = open(license_file, 'r').read().rstrip()
-            licenses.append((str(l), format_multiline(license_text)))
-        else:
-            licenses.append((str(l), 'See repository for full license text'))
-    data['Licenses'] = licenses
-
-    def convertToUnicode(obj):
-        if sys.version_info.major == 2:
-            if isinstance(obj, str):
-                return unicode(obj.decode('utf8'))
-            elif isinstance(obj, unicode):
-                return obj
-        else:
-            if isinstance(obj, bytes):
-                return str(obj.decode('utf8'))
-            elif isinstance(obj, str):
-                return obj
-        if isinstance(obj, list):
-            for i, val in enumerate(obj):
-                obj[i] = convertToUnicode(val)
-            return obj
-        elif isinstance(obj, type(None)):
-            return None
-        elif isinstance(obj, tuple):
-            obj_tmp = list(obj)
-            for i, val in enumerate(obj_tmp):
-                obj_tmp[i] = convertToUnicode(obj_tmp[i])
-            return tuple(obj_tmp)
-        elif isinstance(obj, int):
-            return obj
-        raise RuntimeError('need to deal with type %s' % (str(type(obj))))
 
     for item in data.items():
-        data[item[0]] = convertToUnicode(item[1])
+        data[item[0]] = convert_to_unicode(item[1])
 
-    return data
+    base.update(data)
+    # Summarize dependencies
+    summarize_dependency_mapping(base, depends, build_depends, resolved_deps)
+    return base
+
+
+def generate_substitutions_from_package(
+    package,
+    os_name,
+    os_version,
+    ros_distro,
+    installation_prefix='/usr',
+    deb_inc=0,
+    peer_packages=None,
+    releaser_history=None,
+    fallback_resolver=None,
+    native=False
+):
+    base = generate_base_substitutions(package, installation_prefix, deb_inc, native)
+    return generate_distro_substitutions(base, package, os_name, os_version, ros_distro,
+                                         peer_packages, releaser_history, fallback_resolver)
 
 
 def __process_template_folder(path, subs):
@@ -574,23 +582,21 @@ def match_branches_with_prefix(prefix, get_branches, prune=False):
     branches = list(set(branches))
     if prune:
         # Prune listed branches by packages in latest upstream
-        with inbranch('upstream'):
-            pkg_names, version, pkgs_dict = get_package_data('upstream')
-            for branch in branches:
-                if branch.split(prefix)[-1].strip('/') not in pkg_names:
-                    branches.remove(branch)
+        pkg_names, version, pkgs_dict = get_branch_package_data('upstream')
+        for branch in branches:
+            if branch.split(prefix)[-1].strip('/') not in pkg_names:
+                branches.remove(branch)
     return branches
 
 
 def get_package_from_branch(branch):
-    with inbranch(branch):
-        try:
-            package_data = get_package_data(branch)
-        except SystemExit:
-            return None
-        if type(package_data) not in [list, tuple]:
-            # It is a ret code
-            DebianGenerator.exit(package_data)
+    try:
+        package_data = get_branch_package_data(branch)
+    except SystemExit:
+        return None
+    if type(package_data) not in [list, tuple]:
+        # It is a ret code
+        DebianGenerator.exit(package_data)
     names, version, packages = package_data
     if type(names) is list and len(names) > 1:
         DebianGenerator.exit(
@@ -620,6 +626,11 @@ class DebianGenerator(BloomGenerator):
     has_run_rosdep = os.environ.get('BLOOM_SKIP_ROSDEP_UPDATE', '0').lower() not in ['0', 'f', 'false', 'n', 'no']
     default_install_prefix = '/usr'
     rosdistro = os.environ.get('ROS_DISTRO', 'indigo')
+    packaging_prefix = 'debian'
+    template_group = 'bloom.generators.debian'
+    fingerprint_filename = 'debian.fingerprint'
+    fallback_resolver = staticmethod(missing_dep_resolver)
+    increment_attribute = 'debian_inc'
 
     def prepare_arguments(self, parser):
         # Add command line arguments for this generator
@@ -637,18 +648,29 @@ class DebianGenerator(BloomGenerator):
             help="overrides the default installation prefix (/usr)")
         add('--os-name', default='ubuntu',
             help="overrides os_name, set to 'ubuntu' by default")
+        add('--targets', nargs='+', required=False, default=[], metavar='OS[:VERSION]',
+            help="A list of os_name:os_version targets to generate for, e.g. "
+                 "'ubuntu:jammy debian:bookworm', overrides --os-name and --distros, "
+                 "an os_name without a version targets all of its release platforms")
         add('--os-not-required', default=False, action="store_true",
             help="Do not error if this os is not in the platforms "
                  "list for rosdistro")
+        add('--regenerate', default=False, action="store_true",
+            help="regenerate every distro branch, even if its generation "
+                 "inputs have not changed since it was last generated")
 
     def handle_arguments(self, args):
         self.interactive = args.interactive
         self.debian_inc = args.debian_inc
+        self.regenerate = args.regenerate
         self.os_name = args.os_name
         self.distros = args.distros
+        if args.targets:
+            self.targets = get_generation_targets(args.targets, self.rosdistro)
+            self.os_name = self.targets[0][0]
+            self.distros = [os_version for _, os_version in self.targets]
         if self.distros in [None, []]:
-            index = rosdistro.get_index(rosdistro.get_index_url())
-            distribution_file = rosdistro.get_distribution_file(index, self.rosdistro)
+            distribution_file = get_distribution_file(self.rosdistro)
             if self.os_name not in distribution_file.release_platforms:
                 if args.os_not_required:
                     warning("No platforms defined for os '{0}' in release file for the "
@@ -658,6 +680,9 @@ class DebianGenerator(BloomGenerator):
                 error("No platforms defined for os '{0}' in release file for the '{1}' distro."
                       .format(self.os_name, self.rosdistro), exit=True)
             self.distros = distribution_file.release_platforms[self.os_name]
+        if not args.targets:
+            self.targets = [(self.os_name, os_version) for os_version in self.distros]
+        self.os_names = dict((os_version, os_name) for os_name, os_version in self.targets)
         self.install_prefix = args.install_prefix
         if args.install_prefix is None:
             self.install_prefix = self.default_install_prefix
@@ -669,7 +694,9 @@ class DebianGenerator(BloomGenerator):
                 exit=True
             )
         self.packages = {}
+        self.package_branches = {}
         self.tag_names = {}
+        self.fingerprints = {}
         self.names = []
         self.branch_args = []
         self.debian_branches = []
@@ -679,6 +706,7 @@ class DebianGenerator(BloomGenerator):
                 # This is an ignored package
                 continue
             self.packages[package.name] = package
+            self.package_branches[package.name] = branch
             self.names.append(package.name)
             args = self.generate_branching_arguments(package, branch)
             # First branch is debian/[<rosdistro>/]<package>
@@ -689,12 +717,20 @@ class DebianGenerator(BloomGenerator):
         info("Generating source debs for the packages: " + str(self.names))
         info("Debian Incremental Version: " + str(self.debian_inc))
         info("Debian Distributions: " + str(self.distros))
+        if len(set(self.os_names.values())) > 1:
+            info("Debian Targets: " + ', '.join('{0}:{1}'.format(*t) for t in self.targets))
 
     def get_branching_arguments(self):
         return self.branch_args
 
+    def get_os_name(self, distro):
+        return self.os_names.get(distro, self.os_name)
+
+    def get_template_branches(self):
+        return self.debian_branches
+
     def update_rosdep(self):
-        update_rosdep()
+        update_rosdep(once=True)
         self.has_run_rosdep = True
 
     def _check_all_keys_are_valid(self, peer_packages, ros_distro):
@@ -720,11 +756,10 @@ class DebianGenerator(BloomGenerator):
             for key in keys:
                 key_to_packages_which_depends_on[key].append(package.name)
 
-        os_name = self.os_name
         rosdistro = self.rosdistro
         all_keys_valid = True
         for key in sorted(set(keys_to_resolve)):
-            for os_version in self.distros:
+            for os_name, os_version in self.targets:
                 try:
                     extended_peer_packages = peer_packages + [d.name for d in keys_to_ignore]
                     rule, installer_key, default_installer_key = \
@@ -774,6 +809,10 @@ class DebianGenerator(BloomGenerator):
 
         info("All keys are " + ansi('greenf') + "OK" + ansi('reset') + "\n")
 
+    def expand_plan_files(self, templates, subs):
+        subs['release_tag'] = self.get_release_tag(subs)
+        return expand_template_files(templates, subs, 'debian', skip_empty=['copyright'])
+
     def pre_branch(self, destination, source):
         if destination in self.debian_branches:
             return
@@ -848,6 +887,9 @@ class DebianGenerator(BloomGenerator):
             else:
                 info("Creating tag: " + tag_name)
             execute_command('git tag -f ' + tag_name)
+        if destination in self.fingerprints:
+            self.store_generation_fingerprint(
+                self.fingerprints[destination], tag_name, 'patches/' + destination)
         # Report of success
         name = destination.split('/')[-1]
         package = self.packages[name]
@@ -923,7 +965,7 @@ class DebianGenerator(BloomGenerator):
     def get_subs(self, package, debian_distro, releaser_history=None):
         return generate_substitutions_from_package(
             package,
-            self.os_name,
+            self.get_os_name(debian_distro),
             debian_distro,
             self.rosdistro,
             self.install_prefix,
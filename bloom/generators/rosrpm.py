@@ -77,7 +77,7 @@ class RosRpmGenerator(RpmGenerator):
             return default_fallback_resolver(key, peer_packages)
         subs = generate_substitutions_from_package(
             package,
-            self.os_name,
+            self.get_os_name(rpm_distro),
             rpm_distro,
             self.rosdistro,
             self.install_prefix,
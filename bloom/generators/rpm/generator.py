@@ -50,12 +50,17 @@ from time import strptime
 
 from bloom.generators import BloomGenerator
 from bloom.generators import GeneratorError
-from bloom.generators import resolve_dependencies
 from bloom.generators import update_rosdep
 
+from bloom.generators.common import convert_to_unicode
 from bloom.generators.common import default_fallback_resolver
+from bloom.generators.common import get_branch_package_data
+from bloom.generators.common import get_generation_targets
 from bloom.generators.common import invalidate_view_cache
+from bloom.generators.common import memoize_base_substitutions
 from bloom.generators.common import evaluate_package_conditions
+from bloom.generators.common import expand_template_files
+from bloom.generators.common import resolve_package_dependencies
 from bloom.generators.common import resolve_rosdep_key
 
 from bloom.git import inbranch
@@ -77,7 +82,7 @@ from bloom.logging import warning
 from bloom.commands.git.patch.common import get_patch_config
 from bloom.commands.git.patch.common import set_patch_config
 
-from bloom.packages import get_package_data
+from bloom.rosdistro_api import get_distribution_file
 
 from bloom.util import code
 from bloom.util import execute_command
@@ -194,20 +199,17 @@ def missing_dep_resolver(key, peer_packages):
     return default_fallback_resolver(key, peer_packages)
 
 
-def generate_substitutions_from_package(
-    package,
-    os_name,
-    os_version,
-    ros_distro,
-    installation_prefix='/usr',
-    rpm_inc=0,
-    peer_packages=None,
-    releaser_history=None,
-    fallback_resolver=None,
-    skip_keys=None
-):
-    peer_packages = peer_packages or []
-    skip_keys = skip_keys or set()
+@memoize_base_substitutions
+def generate_base_substitutions(package, installation_prefix='/usr', rpm_inc=0):
+    """
+    Returns the substitutions of a package which are the same for every distro.
+
+    The result is memoized, see
+    :py:func:`bloom.generators.common.memoize_base_substitutions`.
+
+    :param package: catkin_pkg Package
+    :returns: dict of substitutions, see :py:func:`generate_substitutions_from_package`
+    """
     data = {}
     # Name, Version, Description
     data['Name'] = package.name
@@ -229,44 +231,6 @@ def generate_substitutions_from_package(
     data['Package'] = sanitize_package_name(package.name)
     # Installation prefix
     data['InstallationPrefix'] = installation_prefix
-    # Resolve dependencies
-    evaluate_package_conditions(package, ros_distro)
-    depends = [
-        dep for dep in (package.run_depends + package.buildtool_export_depends)
-        if dep.evaluated_condition is not False and dep.name not in skip_keys]
-    build_depends = [
-        dep for dep in (package.build_depends + package.buildtool_depends)
-        if dep.evaluated_condition is not False and dep.name not in skip_keys]
-    test_depends = [
-        dep for dep in (package.test_depends)
-        if dep.evaluated_condition is not False and dep.name not in skip_keys]
-    replaces = [
-        dep for dep in package.replaces
-        if dep.evaluated_condition is not False]
-    conflicts = [
-        dep for dep in package.conflicts
-        if dep.evaluated_condition is not False]
-    unresolved_keys = depends + build_depends + test_depends + replaces + conflicts
-    # The installer key is not considered here, but it is checked when the keys are checked before this
-    resolved_deps = resolve_dependencies(unresolved_keys, os_name,
-                                         os_version, ros_distro,
-                                         peer_packages + [d.name for d in (replaces + conflicts)],
-                                         fallback_resolver)
-    data['Depends'] = sorted(
-        set(format_depends(depends, resolved_deps))
-    )
-    data['BuildDepends'] = sorted(
-        set(format_depends(build_depends, resolved_deps))
-    )
-    data['TestDepends'] = sorted(
-        set(format_depends(test_depends, resolved_deps)).difference(data['BuildDepends'])
-    )
-    data['Replaces'] = sorted(
-        set(format_depends(replaces, resolved_deps))
-    )
-    data['Conflicts'] = sorted(
-        set(format_depends(conflicts, resolved_deps))
-    )
     data['Provides'] = []
     data['Supplements'] = []
 
@@ -287,9 +251,6 @@ def generate_substitutions_from_package(
             "Build type '{}' is not supported by this version of bloom.".
             format(build_type), exit=True)
 
-    # Set the OS and distribution
-    data['OSName'] = os_name
-    data['Distribution'] = os_version
     # Use the time stamp to set the date strings
     stamp = datetime.datetime.now(tz.tzlocal())
     data['Date'] = stamp.strftime('%a %b %d %Y')
@@ -299,6 +260,63 @@ def generate_substitutions_from_package(
         maintainers.append(str(m))
     data['Maintainer'] = maintainers[0]
     data['Maintainers'] = ', '.join(maintainers)
+    exported_tags = [e.tagname for e in package.exports]
+    data['NoArch'] = 'metapackage' in exported_tags or 'architecture_independent' in exported_tags
+
+    for item in data.items():
+        data[item[0]] = convert_to_unicode(item[1])
+
+    return data
+
+
+def generate_distro_substitutions(
+    base,
+    package,
+    os_name,
+    os_version,
+    ros_distro,
+    rpm_inc=0,
+    peer_packages=None,
+    releaser_history=None,
+    fallback_resolver=None,
+    skip_keys=None
+):
+    """
+    Adds the distro specific substitutions of a package to its base substitutions.
+
+    These are the resolved dependencies, the os and distribution and the
+    changelogs, which depend on the releaser history of the distro branch.
+
+    :param base: substitutions from :py:func:`generate_base_substitutions`,
+        which are updated in place
+    :returns: the updated substitutions
+    """
+    peer_packages = peer_packages or []
+    skip_keys = skip_keys or set()
+    data = {}
+    # Resolve dependencies
+    depends, build_depends, test_depends, replaces, conflicts, resolved_deps = \
+        resolve_package_dependencies(package, os_name, os_version, ros_distro, peer_packages,
+                                     fallback_resolver, skip_keys)
+    data['Depends'] = sorted(
+        set(format_depends(depends, resolved_deps))
+    )
+    data['BuildDepends'] = sorted(
+        set(format_depends(build_depends, resolved_deps))
+    )
+    data['TestDepends'] = sorted(
+        set(format_depends(test_depends, resolved_deps)).difference(data['BuildDepends'])
+    )
+    data['Replaces'] = sorted(
+        set(format_depends(replaces, resolved_deps))
+    )
+    data['Conflicts'] = sorted(
+        set(format_depends(conflicts, resolved_deps))
+    )
+
+    # Set the OS and distribution
+    data['OSName'] = os_name
+    data['Distribution'] = os_version
     # Changelog
     if releaser_history:
         sorted_releaser_history = sorted(releaser_history,
@@ -313,49 +331,37 @@ def generate_substitutions_from_package(
     if package.version + '-' + str(rpm_inc) not in [x[0] for x in changelogs]:
         changelogs.insert(0, (
             package.version + '-' + str(rpm_inc), (
-                data['Date'],
+                base['Date'],
                 package.maintainers[0].name,
                 package.maintainers[0].email
             )
         ))
-    exported_tags = [e.tagname for e in package.exports]
-    data['NoArch'] = 'metapackage' in exported_tags or 'architecture_independent' in exported_tags
     data['changelogs'] = changelogs
-    # Summarize dependencies
-    summarize_dependency_mapping(data, depends, build_depends, resolved_deps)
-
-    def convertToUnicode(obj):
-        if sys.version_info.major == 2:
-            if isinstance(obj, str):
-                return unicode(obj.decode('utf8'))
-            elif isinstance(obj, unicode):
-                return obj
-        else:
-            if isinstance(obj, bytes):
-                return str(obj.decode('utf8'))
-            elif isinstance(obj, str):
-                return obj
-        if isinstance(obj, list):
-            for i, val in enumerate(obj):
-                obj[i] = convertToUnicode(val)
-            return obj
-        elif isinstance(obj, type(None)):
-            return None
-        elif isinstance(obj, tuple):
-            obj_tmp = list(obj)
-            for i, val in enumerate(obj_tmp):
-                obj_tmp[i] = convertToUnicode(obj_tmp[i])
-            return tuple(obj_tmp)
-        elif isinstance(obj, int):
-            return obj
-        elif isinstance(obj, int):
-            return obj
-        raise RuntimeError('need to deal with type %s' % (str(type(obj))))
 
     for item in data.items():
-        data[item[0]] = convertToUnicode(item[1])
+        data[item[0]] = convert_to_unicode(item[1])
 
-    return data
+    base.update(data)
+    # Summarize dependencies
+    summarize_dependency_mapping(base, depends, build_depends, resolved_deps)
+    return base
+
+
+def generate_substitutions_from_package(
+    package,
+    os_name,
+    os_version,
+    ros_distro,
+    installation_prefix='/usr',
+    rpm_inc=0,
+    peer_packages=None,
+    releaser_history=None,
+    fallback_resolver=None,
+    skip_keys=None
+):
+    base = generate_base_substitutions(package, installation_prefix, rpm_inc)
+    return generate_distro_substitutions(base, package, os_name, os_version, ros_distro, rpm_inc,
+                                         peer_packages, releaser_history, fallback_resolver, skip_keys)
 
 
 def __process_template_folder(path, subs):
@@ -413,23 +419,21 @@ def match_branches_with_prefix(prefix, get_branches, prune=False):
     branches = list(set(branches))
     if prune:
         # Prune listed branches by packages in latest upstream
-        with inbranch('upstream'):
-            pkg_names, version, pkgs_dict = get_package_data('upstream')
-            for branch in branches:
-                if branch.split(prefix)[-1].strip('/') not in pkg_names:
-                    branches.remove(branch)
+        pkg_names, version, pkgs_dict = get_branch_package_data('upstream')
+        for branch in branches:
+            if branch.split(prefix)[-1].strip('/') not in pkg_names:
+                branches.remove(branch)
     return branches
 
 
 def get_package_from_branch(branch):
-    with inbranch(branch):
-        try:
-            package_data = get_package_data(branch)
-        except SystemExit:
-            return None
-        if type(package_data) not in [list, tuple]:
-            # It is a ret code
-            RpmGenerator.exit(package_data)
+    try:
+        package_data = get_branch_package_data(branch)
+    except SystemExit:
+        return None
+    if type(package_data) not in [list, tuple]:
+        # It is a ret code
+        RpmGenerator.exit(package_data)
     names, version, packages = package_data
     if type(names) is list and len(names) > 1:
         RpmGenerator.exit(
@@ -460,6 +464,11 @@ class RpmGenerator(BloomGenerator):
     has_run_rosdep = os.environ.get('BLOOM_SKIP_ROSDEP_UPDATE', '0').lower() not in ['0', 'f', 'false', 'n', 'no']
     default_install_prefix = '/usr'
     rosdistro = os.environ.get('ROS_DISTRO', 'indigo')
+    packaging_prefix = 'rpm'
+    template_group = 'bloom.generators.rpm'
+    fingerprint_filename = 'rpm.fingerprint'
+    fallback_resolver = staticmethod(missing_dep_resolver)
+    increment_attribute = 'rpm_inc'
 
     def prepare_arguments(self, parser):
         # Add command line arguments for this generator
@@ -477,25 +486,39 @@ class RpmGenerator(BloomGenerator):
             help="overrides the default installation prefix (/usr)")
         add('--os-name', default='fedora',
             help="overrides os_name, set to 'fedora' by default")
+        add('--targets', nargs='+', required=False, default=[], metavar='OS[:VERSION]',
+            help="A list of os_name:os_version targets to generate for, e.g. "
+                 "'fedora:39 rhel:9', overrides --os-name and --distros, "
+                 "an os_name without a version targets all of its release platforms")
         add('--skip-keys', nargs='+', required=False, default=[],
             help="dependency keys which should be skipped and"
                  " discluded from the RPM dependencies")
+        add('--regenerate', default=False, action="store_true",
+            help="regenerate every distro branch, even if its generation "
+                 "inputs have not changed since it was last generated")
 
     def handle_arguments(self, args):
         self.interactive = args.interactive
         self.rpm_inc = args.rpm_inc
+        self.regenerate = args.regenerate
         self.os_name = args.os_name
         self.distros = args.distros
+        if args.targets:
+            self.targets = get_generation_targets(args.targets, self.rosdistro)
+            self.os_name = self.targets[0][0]
+            self.distros = [os_version for _, os_version in self.targets]
         self.skip_keys = args.skip_keys or set()
         if self.distros in [None, []]:
-            index = rosdistro.get_index(rosdistro.get_index_url())
-            distribution_file = rosdistro.get_distribution_file(index, self.rosdistro)
+            distribution_file = get_distribution_file(self.rosdistro)
             if self.os_name not in distribution_file.release_platforms:
                 warning("No platforms defined for os '{0}' in release file for the '{1}' distro."
                         "\nNot performing RPM generation."
                         .format(self.os_name, self.rosdistro))
                 sys.exit(0)
             self.distros = distribution_file.release_platforms[self.os_name]
+        if not args.targets:
+            self.targets = [(self.os_name, os_version) for os_version in self.distros]
+        self.os_names = dict((os_version, os_name) for os_name, os_version in self.targets)
         self.install_prefix = args.install_prefix
         if args.install_prefix is None:
             self.install_prefix = self.default_install_prefix
@@ -507,7 +530,9 @@ class RpmGenerator(BloomGenerator):
                 exit=True
             )
         self.packages = {}
+        self.package_branches = {}
         self.tag_names = {}
+        self.fingerprints = {}
         self.names = []
         self.branch_args = []
         self.rpm_branches = []
@@ -517,6 +542,7 @@ class RpmGenerator(BloomGenerator):
                 # This is an ignored package
                 continue
             self.packages[package.name] = package
+            self.package_branches[package.name] = branch
             self.names.append(package.name)
             args = self.generate_branching_arguments(package, branch)
             # First branch is rpm/[<rosdistro>/]<package>
@@ -526,14 +552,21 @@ class RpmGenerator(BloomGenerator):
     def summarize(self):
         info("Generating source RPMs for the packages: " + str(self.names))
         info("RPM Incremental Version: " + str(self.rpm_inc))
-        info("RPM OS: " + str(self.os_name))
+        os_names = [os_name for os_name, _ in self.targets]
+        info("RPM OS: " + ', '.join(n for i, n in enumerate(os_names) if n not in os_names[:i]))
         info("RPM Distributions: " + str(self.distros))
 
     def get_branching_arguments(self):
         return self.branch_args
 
+    def get_os_name(self, distro):
+        return self.os_names.get(distro, self.os_name)
+
+    def get_template_branches(self):
+        return self.rpm_branches
+
     def update_rosdep(self):
-        update_rosdep()
+        update_rosdep(once=True)
         self.has_run_rosdep = True
 
     def _check_all_keys_are_valid(self, peer_packages, rosdistro):
@@ -567,11 +600,10 @@ class RpmGenerator(BloomGenerator):
             else:
                 warning("Skipping dependency key '{0}' per --skip-keys".format(skip_key))
 
-        os_name = self.os_name
         rosdistro = self.rosdistro
         all_keys_valid = True
         for key in sorted(keys_to_resolve):
-            for os_version in self.distros:
+            for os_name, os_version in self.targets:
                 try:
                     extended_peer_packages = peer_packages + [d.name for d in keys_to_ignore]
                     rule, installer_key, default_installer_key = \
@@ -626,6 +658,14 @@ class RpmGenerator(BloomGenerator):
             if not package.licenses or not package.licenses[0]:
                 error("No license set for package '{0}', aborting.".format(package.name), exit=True)
 
+    def expand_plan_files(self, templates, subs):
+        files = expand_template_files(templates, subs, 'rpm')
+        # The spec file is renamed after the package and mock needs the tar marker
+        if 'rpm/template.spec' in files:
+            files['rpm/' + subs['Package'] + '.spec'] = files.pop('rpm/template.spec')
+        files['.write_tar'] = ''
+        return files
+
     def pre_branch(self, destination, source):
         if destination in self.rpm_branches:
             return
@@ -700,6 +740,9 @@ class RpmGenerator(BloomGenerator):
             else:
                 info("Creating tag: " + tag_name)
             execute_command('git tag -f ' + tag_name)
+        if destination in self.fingerprints:
+            self.store_generation_fingerprint(
+                self.fingerprints[destination], tag_name, 'patches/' + destination)
         # Report of success
         name = destination.split('/')[-1]
         package = self.packages[name]
@@ -707,7 +750,7 @@ class RpmGenerator(BloomGenerator):
         info(ansi(color) + "####" + ansi('reset'), use_prefix=False)
         info(
             ansi(color) + "#### " + ansi('greenf') + "Successfully" +
-            ansi(color) + " generated '" + ansi('boldon') + self.os_name +
+            ansi(color) + " generated '" + ansi('boldon') + self.get_os_name(distro) +
             ' ' + distro + ansi('boldoff') + "' RPM for package"
             " '" + ansi('boldon') + package.name + ansi('boldoff') + "'" +
             " at version '" + ansi('boldon') + package.version +
@@ -771,7 +814,7 @@ class RpmGenerator(BloomGenerator):
     def get_subs(self, package, rpm_distro, releaser_history=None):
         return generate_substitutions_from_package(
             package,
-            self.os_name,
+            self.get_os_name(rpm_distro),
             rpm_distro,
             self.rosdistro,
             self.install_prefix,
@@ -783,7 +826,7 @@ class RpmGenerator(BloomGenerator):
         )
 
     def generate_rpm(self, package, rpm_distro, rpm_dir='rpm'):
-        info("Generating RPM for {0} {1}...".format(self.os_name, rpm_distro))
+        info("Generating RPM for {0} {1}...".format(self.get_os_name(rpm_distro), rpm_distro))
         # Try to retrieve the releaser_history
         releaser_history = self.get_releaser_history()
         # Generate substitution values
@@ -829,7 +872,7 @@ class RpmGenerator(BloomGenerator):
     def summarize_package(self, package, distro, color='bluef'):
         info(ansi(color) + "\n####" + ansi('reset'), use_prefix=False)
         info(
-            ansi(color) + "#### Generating '" + ansi('boldon') + self.os_name +
+            ansi(color) + "#### Generating '" + ansi('boldon') + self.get_os_name(distro) +
             ' ' + distro + ansi('boldoff') + "' RPM for package"
             " '" + ansi('boldon') + package.name + ansi('boldoff') + "'" +
             " at version '" + ansi('boldon') + package.version +
@@ -34,6 +34,7 @@
 
 from __future__ import print_function
 
+import binascii
 import os
 import functools
 import re
@@ -725,3 +726,296 @@ def get_remotes(directory=None):
     cmd = "git remote -v"
     output = check_output(cmd, shell=True, cwd=root, stderr=PIPE)
     return list(set([x.split()[0].strip() for x in output.splitlines() if x.strip()]))
+
+
+def get_refs(patterns=None, directory=None):
+    """
+    Returns a dictionary of ref names to object hashes.
+
+    Implemented with a single ``git for-each-ref`` call.
+
+    :param patterns: list of ref patterns to list, defaults to local branches
+        and tags, i.e. ``['refs/heads', 'refs/tags']``
+    :param directory: directory in which to run the command
+    :returns: dict of full ref names (``refs/heads/...``) to SHA-1 hashes
+
+    :raises: subprocess.CalledProcessError if git command fails
+    """
+    patterns = patterns or ['refs/heads', 'refs/tags']
+    cmd = ['git', 'for-each-ref', '--format=%(objectname) %(refname)'] + list(patterns)
+    output = check_output(cmd, cwd=directory)
+    refs = {}
+    for line in output.splitlines():
+        if not line.strip():
+            continue
+        sha, ref = line.split(' ', 1)
+        refs[ref] = sha
+    return refs
+
+
+def update_refs(refs, directory=None):
+    """
+    Creates or updates the given refs in one transaction.
+
+    Implemented with ``git update-ref --stdin``, so either all of the refs
+    are updated or none of them are.
+
+    :param refs: dict of full ref names to the SHA-1 hashes they should point to
+    :param directory: directory in which to run the command
+
+    :raises: subprocess.CalledProcessError if git command fails
+    """
+    if not refs:
+        return
+    updates = ''.join('update {0} {1}\n'.format(ref, sha) for ref, sha in sorted(refs.items()))
+    cmd = ['git', 'update-ref', '--stdin']
+    debug(((directory) if directory else os.getcwd()) + ":$ " + ' '.join(cmd))
+    p = subprocess.Popen(cmd, cwd=directory, stdin=PIPE, stdout=PIPE, stderr=subprocess.STDOUT)
+    out, _ = p.communicate(updates.encode('utf-8'))
+    if p.returncode != 0:
+        error("Failed to update refs: {0}".format(out.decode('utf-8', 'replace')))
+        raise CalledProcessError(p.returncode, cmd)
+
+
+def fetch_refs(source, refs, directory=None):
+    """
+    Fetches the given refs from another repository into the same ref names.
+
+    The refs are fetched with ``--atomic`` and forced, so that either all of
+    the refs are updated or none of them are.
+
+    :param source: path or url of the repository to fetch from
+    :param refs: list of full ref names to fetch, e.g. ``refs/heads/debian/foo``
+    :param directory: directory in which to run the command
+
+    :raises: subprocess.CalledProcessError if git command fails
+    """
+    if not refs:
+        return
+    refspecs = ['+{0}:{0}'.format(ref) for ref in sorted(refs)]
+    cmd = ['git', 'fetch', '--quiet', '--atomic', '--no-tags', source] + refspecs
+    execute_command(cmd, shell=False, cwd=directory)
+
+
+def clone_with_branches(origin, clone_dir):
+    """
+    Clones a local repository, making every branch of it a local branch.
+
+    The clone shares the objects of the origin, so it is cheap to create, and
+    the local branches are created with a single ref transaction.
+
+    :param origin: path of the repository to clone
+    :param clone_dir: directory to create the clone in
+
+    :raises: subprocess.CalledProcessError if any git calls fail
+    """
+    execute_command(['git', 'clone', '--quiet', '--shared', origin, clone_dir], shell=False)
+    local_refs = get_refs(directory=clone_dir)
+    remote_prefix = 'refs/remotes/origin/'
+    new_refs = {}
+    for ref, sha in get_refs([remote_prefix], directory=clone_dir).items():
+        branch_ref = 'refs/heads/' + ref[len(remote_prefix):]
+        if ref.endswith('/HEAD') or branch_ref in local_refs:
+            continue
+        new_refs[branch_ref] = sha
+    update_refs(new_refs, directory=clone_dir)
+
+
+def get_object_hash(reference, path=None, directory=None):
+    """
+    Returns the SHA-1 hash of a reference, or of a path within a reference.
+
+    Unlike :py:func:`get_commit_hash` this does not track remote branches and
+    only costs a single ``git rev-parse``.
+
+    :param reference: git reference (branch, tag, or commit)
+    :param path: optional path in the reference, e.g. ``package.xml``
+    :param directory: directory in which to run the command
+    :returns: SHA-1 hash of the commit, tree, or blob, or None if it does not exist
+    """
+    obj = reference if not path else '{0}:{1}'.format(reference, path)
+    retcode, out, err = execute_command(['git', 'rev-parse', '--verify', '--quiet', obj], shell=False,
+                                        autofail=False, silent_error=True, cwd=directory, return_io=True)
+    if retcode != 0:
+        return None
+    return out.strip()
+
+
+def list_tree_files(reference, path=None, directory=None, types=('blob',)):
+    """
+    Returns all of the files in a reference, recursively.
+
+    Implemented with a single ``git ls-tree -r``; unlike :py:func:`ls_tree`
+    this does not track remote branches first. Like ``git ls-tree``, the
+    listing is limited to, and relative to, the directory it is run in.
+
+    :param reference: git reference (branch, tag, commit, or tree)
+    :param path: optional folder in the reference to limit the listing to
+    :param directory: directory in which to run the command
+    :param types: object types to list, ``'commit'`` lists submodules
+    :returns: dict of file paths to ``(mode, SHA-1)`` tuples, or None if the
+        reference does not exist
+
+    :raises: subprocess.CalledProcessError if git command fails
+    """
+    if get_object_hash(reference, directory=directory) is None:
+        return None
+    cmd = ['git', 'ls-tree', '-r', '-z', reference]
+    if path:
+        cmd += ['--', path]
+    output = check_output(cmd, cwd=directory)
+    files = {}
+    for entry in output.split('\0'):
+        if not entry:
+            continue
+        info_, file_path = entry.split('\t', 1)
+        mode, obj_type, sha = info_.split()
+        if obj_type in types:
+            files[file_path] = (mode, sha)
+    return files
+
+
+def cat_files(objects, directory=None):
+    """
+    Reads the contents of many git objects with one ``git cat-file --batch``.
+
+    :param objects: list of object names, e.g. SHA-1 hashes or
+        ``<reference>:<path>`` expressions
+    :param directory: directory in which to run the command
+    :returns: dict of object names to their contents as bytes, or to None
+        for objects which do not exist
+
+    :raises: subprocess.CalledProcessError if git command fails
+    """
+    objects = list(objects)
+    if not objects:
+        return {}
+    cmd = ['git', 'cat-file', '--batch']
+    p = subprocess.Popen(cmd, cwd=directory, stdin=PIPE, stdout=PIPE)
+    out, _ = p.communicate(''.join(obj + '\n' for obj in objects).encode('utf-8'))
+    if p.returncode != 0:
+        raise CalledProcessError(p.returncode, cmd)
+    contents = {}
+    offset = 0
+    for obj in objects:
+        end = out.index(b'\n', offset)
+        header = out[offset:end].decode('utf-8').split()
+        offset = end + 1
+        if header[-1] == 'missing' or len(header) != 3:
+            contents[obj] = None
+            continue
+        size = int(header[2])
+        contents[obj] = out[offset:offset + size]
+        offset += size + 1
+    return contents
+
+
+def get_object_hashes(objects, directory=None):
+    """
+    Resolves many object names with one ``git cat-file --batch-check``.
+
+    :param objects: list of object names, e.g. ``<reference>:<path>``
+        expressions, relative paths are resolved against the directory
+    :param directory: directory in which to run the command
+    :returns: dict of object names to their SHA-1 hashes, or to None for
+        objects which do not exist
+
+    :raises: subprocess.CalledProcessError if git command fails
+    """
+    objects = list(objects)
+    if not objects:
+        return {}
+    cmd = ['git', 'cat-file', '--batch-check']
+    p = subprocess.Popen(cmd, cwd=directory, stdin=PIPE, stdout=PIPE, stderr=PIPE)
+    out, _ = p.communicate(''.join(obj + '\n' for obj in objects).encode('utf-8'))
+    if p.returncode != 0:
+        raise CalledProcessError(p.returncode, cmd)
+    hashes = {}
+    for obj, line in zip(objects, out.decode('utf-8').splitlines()):
+        header = line.split()
+        hashes[obj] = header[0] if len(header) == 3 and header[-1] != 'missing' else None
+    return hashes
+
+
+def parse_tree_object(data):
+    """
+    Parses the raw contents of a git tree object.
+
+    :param data: contents of the tree object as bytes, e.g. from :py:func:`cat_files`
+    :returns: dict of entry names to ``(mode, SHA-1)`` tuples, where a mode
+        starting with ``4`` is a directory
+    """
+    entries = {}
+    offset = 0
+    while offset < len(data):
+        space = data.index(b' ', offset)
+        nul = data.index(b'\0', space)
+        mode = data[offset:space].decode('utf-8')
+        name = data[space + 1:nul].decode('utf-8', 'replace')
+        sha = binascii.hexlify(data[nul + 1:nul + 21]).decode('utf-8')
+        entries[name] = (mode, sha)
+        offset = nul + 21
+    return entries
+
+
+class RepositoryInventory(object):
+    """
+    Snapshot of the branches of a repository and their top level files.
+
+    All local and ``origin`` branches are read with a single
+    ``git for-each-ref``, and the top level trees of any number of branches
+    are read with a single ``git cat-file --batch``, so that queries over
+    many branches, e.g. every ``patches/*`` branch, do not cost a few git
+    calls per branch.  Unlike :py:func:`ls_tree` this does not create local
+    tracking branches.
+
+    :param directory: directory of the repository, defaults to the current one
+    """
+    def __init__(self, directory=None):
+        self.directory = directory
+        self.branches = {}
+        self._trees = {}
+        cmd = ['git', 'for-each-ref', '--format=%(objectname) %(refname)', 'refs/heads', 'refs/remotes/origin']
+        for line in check_output(cmd, cwd=directory).splitlines():
+            sha, ref = line.split(' ', 1)
+            if ref.startswith('refs/heads/'):
+                self.branches[ref[len('refs/heads/'):]] = sha
+            elif ref != 'refs/remotes/origin/HEAD':
+                # Local branches take precedence over the remote ones
+                self.branches.setdefault(ref[len('refs/remotes/origin/'):], sha)
+
+    def get_branches(self, prefix=''):
+        """Returns the sorted names of the branches starting with the given prefix."""
+        return sorted(b for b in self.branches if b.startswith(prefix))
+
+    def get_tree_entries(self, branches):
+        """
+        Returns the top level entries of the given branches.
+
+        :param branches: list of branch names
+        :returns: dict of branch names to dicts of entry names to
+            ``(mode, SHA-1)`` tuples, see :py:func:`parse_tree_object`
+        """
+        missing = [b for b in branches if b not in self._trees and b in self.branches]
+        objects = dict((b, self.branches[b] + '^{tree}') for b in missing)
+        contents = cat_files(objects.values(), directory=self.directory)
+        for branch, obj in objects.items():
+            self._trees[branch] = parse_tree_object(contents[obj]) if contents[obj] is not None else {}
+        return dict((b, self._trees.get(b, {})) for b in branches)
+
+    def get_files(self, branch):
+        """Returns the sorted names of the files at the top level of a branch."""
+        entries = self.get_tree_entries([branch])[branch]
+        return sorted(name for name, (mode, sha) in entries.items() if not mode.startswith('4'))
+
+    def find_ignore_files(self, branch='master'):
+        """Returns the package ignore files, ``*.ignored``, of a branch."""
+        return [f for f in self.get_files(branch) if f.endswith('.ignored')]
+
+    def find_patch_branches(self):
+        """Returns the ``patches/*`` branches which contain a series of ``.patch`` files."""
+        patch_branches = self.get_branches('patches/')
+        trees = self.get_tree_entries(patch_branches)
+        return [b for b in patch_branches
+                if [name for name, (mode, sha) in trees[b].items()
+                    if name.endswith('.patch') and not mode.startswith('4')]]
@@ -40,37 +40,65 @@ from __future__ import print_function
 import base64
 import datetime
 import getpass
+import hashlib
 import json
 import os
+import re
 import socket
 import sys
+import tempfile
+import threading
+import time
 
+from concurrent.futures import ThreadPoolExecutor
+
+from bloom.logging import debug
 from bloom.logging import error
 from bloom.logging import info
 from bloom.logging import warning
 
+from bloom.util import get_cache_max_age
+from bloom.util import is_cache_eviction_due
 from bloom.util import maybe_continue
 from bloom.util import safe_input
 
 
 try:
     # Python2
+    from httplib import HTTPConnection
+    from httplib import HTTPException
+    from httplib import HTTPSConnection
+    from httplib import responses
     from urllib import urlencode
-    from urllib2 import HTTPError
-    from urllib2 import Request, urlopen
-    from urllib2 import URLError
+    from urlparse import urljoin
     from urlparse import urlparse
+    from urlparse import urlsplit
     from urlparse import urlunsplit
 except ImportError:
     # Python3
-    from urllib.error import HTTPError
-    from urllib.error import URLError
+    from http.client import HTTPConnection
+    from http.client import HTTPException
+    from http.client import HTTPSConnection
+    from http.client import responses
+    from urllib.parse import urljoin
     from urllib.parse import urlparse
+    from urllib.parse import urlsplit
     from urllib.parse import urlunsplit
-    from urllib.request import Request, urlopen
 
 import bloom
 
+GITHUB_PER_PAGE = 100
+GITHUB_PAGE_JOBS = 4
+GITHUB_TIMEOUT = 120
+GITHUB_MAX_REDIRECTS = 5
+GITHUB_MAX_RETRIES = 3
+GITHUB_MAX_RATE_LIMIT_WAIT = 300
+GITHUB_RATE_LIMIT_RESERVE = 50
+
+_local = threading.local()
+_rate_limit_lock = threading.Lock()
+_rate_limit = {}
+
 
 def auth_header_from_basic_auth(user, password):
     auth_str = '{0}:{1}'.format(user, password)
@@ -104,32 +132,298 @@ def get_bloom_headers(auth=None):
     return headers
 
 
+class GithubResponse(object):
+    """A fully read HTTP response with the interface of a ``urlopen`` response.
+
+    The body is read eagerly so the underlying connection can be reused.
+    """
+
+    def __init__(self, url, code, headers, body, extra_headers=None):
+        self.url = url
+        self.code = code
+        self.status = code
+        self.headers = headers
+        self.body = body
+        self.extra_headers = extra_headers or {}
+
+    def getcode(self):
+        return self.code
+
+    def geturl(self):
+        return self.url
+
+    def info(self):
+        return self.headers
+
+    def read(self):
+        return self.body
+
+    def getheader(self, name, default=None):
+        for key, value in self.extra_headers.items():
+            if key.lower() == name.lower():
+                return value
+        value = self.headers.get(name)
+        return default if value is None else value
+
+
+def get_github_cache_dir():
+    """
+    Returns the directory of the GitHub API ETag cache.
+
+    Responses which were not used for ``BLOOM_UPSTREAM_CACHE_MAX_AGE_DAYS``
+    (30) days are evicted, like the upstream mirrors and archives.
+
+    :returns: path of the cache directory, or None if the cache is disabled
+    """
+    if 'BLOOM_NO_GITHUB_CACHE' in os.environ:
+        return None
+    cache_dir = os.environ.get('BLOOM_GITHUB_CACHE_DIR')
+    if not cache_dir:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'bloom', 'github')
+    return cache_dir
+
+
+def _get_etag_cache_path(url, auth):
+    cache_dir = get_github_cache_dir()
+    if cache_dir is None:
+        return None
+    # Responses depend on who is asking, so the credentials are part of the key
+    key = '{0}\n{1}'.format(auth or '', url).encode('utf-8')
+    return os.path.join(cache_dir, hashlib.sha1(key).hexdigest() + '.json')
+
+
+def _read_etag_cache(cache_path):
+    if cache_path is None or not os.path.exists(cache_path):
+        return None
+    try:
+        with open(cache_path, 'r') as f:
+            cached = json.load(f)
+    except (IOError, OSError, ValueError):
+        return None
+    if 'etag' not in cached or 'body' not in cached:
+        return None
+    return cached
+
+
+def _write_etag_cache(cache_path, resp):
+    etag = resp.getheader('ETag')
+    if cache_path is None or not etag:
+        return
+    cached = {
+        'url': resp.geturl(),
+        'etag': etag,
+        'link': resp.getheader('Link'),
+        'body': base64.b64encode(resp.read()).decode('ascii'),
+    }
+    try:
+        if not os.path.isdir(os.path.dirname(cache_path)):
+            os.makedirs(os.path.dirname(cache_path))
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(cache_path), suffix='.tmp')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(cached, f)
+        os.rename(tmp_path, cache_path)
+    except (IOError, OSError) as exc:
+        # The cache is only an optimization
+        warning("Failed to write the GitHub response cache '{0}': {1}".format(cache_path, exc))
+        return
+    evict_github_cache(os.path.dirname(cache_path))
+
+
+def evict_github_cache(cache_dir, force=False):
+    """
+    Removes responses which were not used recently from the GitHub API ETag cache.
+
+    Responses unused for longer than ``BLOOM_UPSTREAM_CACHE_MAX_AGE_DAYS`` are
+    removed, as are temporary files left behind by interrupted writes.
+    Unless forced, this runs at most once a day.
+
+    :param cache_dir: the GitHub API ETag cache directory
+    :param force: if True, check the cache even if it was checked recently
+    """
+    if not is_cache_eviction_due(cache_dir, force):
+        return
+    now = time.time()
+    max_age = get_cache_max_age()
+    for entry in os.listdir(cache_dir):
+        if not entry.endswith('.json') and not entry.endswith('.tmp'):
+            continue
+        try:
+            path = os.path.join(cache_dir, entry)
+            if now - os.path.getmtime(path) > max_age:
+                os.remove(path)
+        except OSError:
+            pass
+
+
+def _get_connection(scheme, netloc):
+    connections = getattr(_local, 'connections', None)
+    if connections is None:
+        connections = _local.connections = {}
+    key = (scheme, netloc)
+    if key not in connections:
+        connection_class = HTTPConnection if scheme == 'http' else HTTPSConnection
+        connections[key] = connection_class(netloc, timeout=GITHUB_TIMEOUT)
+    return connections[key]
+
+
+def _drop_connection(scheme, netloc):
+    connection = getattr(_local, 'connections', {}).pop((scheme, netloc), None)
+    if connection is not None:
+        connection.close()
+
+
+def _send_request(method, url, body, headers):
+    """Send one request over a kept-alive connection of the current thread."""
+    parts = urlsplit(url)
+    path = urlunsplit(['', '', parts.path or '/', parts.query, ''])
+    # A kept-alive connection may have been closed by the server in the
+    # meantime, in which case the request is retried once on a new one
+    for attempt in range(2):
+        reused = (parts.scheme, parts.netloc) in getattr(_local, 'connections', {})
+        connection = _get_connection(parts.scheme, parts.netloc)
+        sent = False
+        try:
+            connection.request(method, path, body, headers)
+            sent = True
+            response = connection.getresponse()
+            data = response.read()
+        except (HTTPException, socket.error) as exc:
+            _drop_connection(parts.scheme, parts.netloc)
+            # Only requests which cannot have had an effect are resent
+            if attempt == 0 and reused and (method == 'GET' or not sent):
+                continue
+            raise GithubException(str(exc) + ' (%s)' % url)
+        if getattr(response, 'will_close', False):
+            _drop_connection(parts.scheme, parts.netloc)
+        return GithubResponse(url, response.status, response.msg, data)
+
+
+def _update_rate_limit(resp):
+    remaining = resp.getheader('X-RateLimit-Remaining')
+    reset = resp.getheader('X-RateLimit-Reset')
+    if remaining is None or reset is None:
+        return
+    with _rate_limit_lock:
+        _rate_limit['remaining'] = int(remaining)
+        _rate_limit['reset'] = int(reset)
+
+
+def _throttle():
+    """Spread the remaining requests over the rate limit window once it runs low."""
+    with _rate_limit_lock:
+        remaining = _rate_limit.get('remaining')
+        reset = _rate_limit.get('reset')
+    if remaining is None or remaining >= GITHUB_RATE_LIMIT_RESERVE:
+        return
+    delay = min(float(reset - time.time()) / (remaining + 1), GITHUB_MAX_RATE_LIMIT_WAIT)
+    if delay > 0:
+        debug("Only {0} GitHub API requests left, waiting {1:.1f} seconds".format(remaining, delay))
+        time.sleep(delay)
+
+
+def get_rate_limit_delay(code, headers, now=None):
+    """
+    Returns how long to wait before retrying a rate limited request.
+
+    :param code: HTTP status code of the response
+    :param headers: dictionary like object with the response headers
+    :param now: current time in seconds since the epoch, defaults to now
+    :returns: seconds to wait, or None if the request was not rate limited
+    """
+    if code not in [403, 429]:
+        return None
+    now = time.time() if now is None else now
+    retry_after = headers.get('Retry-After')
+    if retry_after is not None and retry_after.isdigit():
+        return int(retry_after)
+    if headers.get('X-RateLimit-Remaining') == '0' and headers.get('X-RateLimit-Reset'):
+        return max(int(headers.get('X-RateLimit-Reset')) - int(now), 0) + 1
+    return None
+
+
+def do_github_request(method, url, data=None, auth=None):
+    headers = get_bloom_headers(auth)
+    body = None
+    if data is not None:
+        body = json.dumps(data)
+        if sys.version_info[0] >= 3:
+            body = body.encode('utf-8')
+    cache_path = _get_etag_cache_path(url, auth) if method == 'GET' else None
+    cached = _read_etag_cache(cache_path)
+    if cached is not None:
+        headers['If-None-Match'] = cached['etag']
+    redirects = retries = 0
+    while True:
+        _throttle()
+        resp = _send_request(method, url, body, headers)
+        _update_rate_limit(resp)
+        location = resp.getheader('Location')
+        if resp.code in [301, 302, 303, 307, 308] and location and redirects < GITHUB_MAX_REDIRECTS:
+            redirects += 1
+            url = urljoin(url, location)
+            if resp.code == 303:
+                method, body = 'GET', None
+            continue
+        delay = get_rate_limit_delay(resp.code, resp.headers)
+        if delay is not None and delay <= GITHUB_MAX_RATE_LIMIT_WAIT and retries < GITHUB_MAX_RETRIES:
+            retries += 1
+            warning("GitHub API rate limit exceeded, retrying in {0} seconds...".format(delay))
+            time.sleep(delay)
+            continue
+        break
+    if resp.code == 304 and cached is not None:
+        # Conditional requests answered from the cache do not count against the rate limit
+        try:
+            # Mark the response as used, see evict_github_cache
+            os.utime(cache_path, None)
+        except OSError:
+            pass
+        extra_headers = {'Link': cached['link']} if cached.get('link') else {}
+        return GithubResponse(url, 200, resp.headers, base64.b64decode(cached['body']), extra_headers)
+    if resp.code >= 400:
+        msg = 'HTTP Error {0}: {1} ({2})'.format(resp.code, responses.get(resp.code, ''), url)
+        if resp.code in [401]:
+            raise GitHubAuthException(msg)
+        raise GithubException(msg)
+    if resp.code == 200:
+        _write_etag_cache(cache_path, resp)
+    return resp
+
+
 def do_github_get_req(path, auth=None, site='api.github.com'):
     return do_github_post_req(path, None, auth, site)
 
 
 def do_github_post_req(path, data=None, auth=None, site='api.github.com'):
-    headers = get_bloom_headers(auth)
     url = urlunsplit(['https', site, path, '', ''])
-    if data is None:
-        request = Request(url, headers=headers)  # GET
-    else:
-        data = json.dumps(data)
-        if sys.version_info[0] >= 3:
-            data = data.encode('utf-8')
-        request = Request(url, data=data, headers=headers)  # POST
+    return do_github_request('GET' if data is None else 'POST', url, data, auth)
 
-    try:
-        response = urlopen(request, timeout=120)
-    except HTTPError as e:
-        if e.code in [401]:
-            raise GitHubAuthException(str(e) + ' (%s)' % url)
-        else:
-            raise GithubException(str(e) + ' (%s)' % url)
-    except URLError as e:
-        raise GithubException(str(e) + ' (%s)' % url)
 
-    return response
+def parse_link_header(value):
+    """
+    Parses an RFC 5988 ``Link`` header, as used by GitHub for pagination.
+
+    :param value: the value of the ``Link`` header, or None
+    :returns: dictionary of link relations (e.g. ``next``, ``last``) to urls
+    """
+    links = {}
+    for match in re.finditer(r'<([^>]*)>([^<]*)', value or ''):
+        rel = re.search(r';\s*rel="?([^";]+)"?', match.group(2))
+        if rel is None:
+            continue
+        for name in rel.group(1).split():
+            links[name] = match.group(1)
+    return links
+
+
+def _get_page_number(url):
+    match = re.search(r'[?&]page=(\d+)', url or '')
+    return int(match.group(1)) if match else None
+
+
+def _set_page_number(url, page):
+    return re.sub(r'([?&]page=)\d+', r'\g<1>{0}'.format(page), url)
 
 
 def json_loads(resp):
@@ -138,7 +432,7 @@ def json_loads(resp):
         charset = resp.headers.getparam('charset')
         charset = 'utf8' if not charset else charset
     except AttributeError:
-        charset = resp.headers.get_content_charset()
+        charset = resp.headers.get_content_charset() or 'utf8'
 
     return json.loads(resp.read().decode(charset))
 
@@ -146,7 +440,7 @@ def json_loads(resp):
 class GithubException(Exception):
     def __init__(self, msg, resp=None):
         if resp:
-            msg = "{msg}: {resp.getcode()}".format(**locals())
+            msg = "{0}: {1}".format(msg, resp.getcode())
         else:
             msg = "{msg}: {resp}".format(**locals())
         super(GithubException, self).__init__(msg)
@@ -160,10 +454,46 @@ class GitHubAuthException(GithubException):
 
 
 class Github(object):
-    def __init__(self, username, auth, token=None):
+    def __init__(self, username, auth, token=None, jobs=GITHUB_PAGE_JOBS):
         self.username = username
         self.auth = auth
         self.token = token
+        self.jobs = jobs
+
+    def _get_page(self, url, error_msg):
+        resp = do_github_request('GET', url, auth=self.auth)
+        if '{0}'.format(resp.getcode()) not in ['200', '202']:
+            raise GithubException(error_msg.format(url=url), resp)
+        return json_loads(resp), parse_link_header(resp.getheader('Link'))
+
+    def get_all_pages(self, path, start_page=None, error_msg="Failed to list '{url}'"):
+        """
+        Returns the items of all pages of a paginated GitHub API listing.
+
+        The pages are followed through the ``Link`` header. When the last page
+        is known up front, the remaining pages are fetched concurrently.
+
+        :param path: path of the listing, without pagination parameters
+        :param start_page: first page to list, defaults to 1
+        :param error_msg: message of the raised exception, ``{url}`` is replaced
+        :returns: list of the items on all pages
+        :raises: :py:exc:`GithubException` if a page could not be fetched
+        """
+        url = urlunsplit(['https', 'api.github.com', path, '', ''])
+        url += '?per_page={0}&page={1}'.format(GITHUB_PER_PAGE, start_page or 1)
+        items, links = self._get_page(url, error_msg)
+        first_page = _get_page_number(links.get('next'))
+        last_page = _get_page_number(links.get('last'))
+        if self.jobs > 1 and first_page is not None and last_page is not None:
+            urls = [_set_page_number(links['next'], page) for page in range(first_page, last_page + 1)]
+            with ThreadPoolExecutor(max_workers=self.jobs) as executor:
+                for page_items, _ in executor.map(lambda u: self._get_page(u, error_msg), urls):
+                    items.extend(page_items)
+            return items
+        while 'next' in links:
+            page_items, links = self._get_page(links['next'], error_msg)
+            items.extend(page_items)
+        return items
 
     def check_token_validity(self, username, token, update_auth=False):
         resp = do_github_get_req('/user', self.auth)
@@ -183,19 +513,9 @@ class Github(object):
         return resp_data
 
     def list_repos(self, user, start_page=None):
-        page = start_page or 1
-        repos = []
-        while True:
-            url = '/users/{user}/repos?page={page}'.format(**locals())
-            resp = do_github_get_req(url, auth=self.auth)
-            if '{0}'.format(resp.getcode()) not in ['200']:
-                raise GithubException(
-                    "Failed to list repositories for user '{user}' using url '{url}'".format(**locals()), resp)
-            new_repos = json_loads(resp)
-            if not new_repos:
-                return repos
-            repos.extend(new_repos)
-            page += 1
+        url = '/users/{user}/repos'.format(**locals())
+        return self.get_all_pages(url, start_page,
+                                  "Failed to list repositories for user '" + user + "' using url '{url}'")
 
     def get_branch(self, owner, repo, branch):
         url = '/repos/{owner}/{repo}/branches/{branch}'.format(**locals())
@@ -207,19 +527,9 @@ class Github(object):
         return json_loads(resp)
 
     def list_branches(self, owner, repo, start_page=None):
-        page = start_page or 1
-        branches = []
-        while True:
-            url = '/repos/{owner}/{repo}/branches?page={page}&per_page=2'.format(**locals())
-            resp = do_github_get_req(url, auth=self.auth)
-            if '{0}'.format(resp.getcode()) not in ['200']:
-                raise GithubException(
-                    "Failed to list branches for '{owner}/{repo}' using url '{url}'".format(**locals()), resp)
-            new_branches = json_loads(resp)
-            if not new_branches:
-                return branches
-            branches.extend(new_branches)
-            page += 1
+        url = '/repos/{owner}/{repo}/branches'.format(**locals())
+        return self.get_all_pages(url, start_page,
+                                  "Failed to list branches for '{0}/{1}'".format(owner, repo) + " using url '{url}'")
 
     def create_fork(self, parent_org, parent_repo):
         resp = do_github_post_req('/repos/{parent_org}/{parent_repo}/forks'.format(**locals()), {}, auth=self.auth)
@@ -229,19 +539,54 @@ class Github(object):
         return json_loads(resp)
 
     def list_forks(self, org, repo, start_page=None):
-        page = start_page or 1
-        forks = []
-        while True:
-            url = '/repos/{org}/{repo}/forks?page={page}'.format(**locals())
-            resp = do_github_get_req(url, auth=self.auth)
-            if '{0}'.format(resp.getcode()) not in ['200', '202']:
-                raise GithubException(
-                    "Failed to list forks of '{org}/{repo}'".format(**locals()), resp)
-            new_forks = json_loads(resp)
-            if not new_forks:
-                return forks
-            forks.extend(new_forks)
-            page += 1
+        url = '/repos/{org}/{repo}/forks'.format(**locals())
+        return self.get_all_pages(url, start_page, "Failed to list forks of '{0}/{1}'".format(org, repo))
+
+    def get_git_commit(self, owner, repo, sha):
+        url = '/repos/{owner}/{repo}/git/commits/{sha}'.format(**locals())
+        resp = do_github_get_req(url, auth=self.auth)
+        if '{0}'.format(resp.getcode()) not in ['200']:
+            raise GithubException("Failed to get commit '{sha}' of '{owner}/{repo}'".format(**locals()), resp)
+        return json_loads(resp)
+
+    def create_blob(self, owner, repo, content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        content = base64.b64encode(content)
+        if sys.version_info >= (3, 0):
+            content = content.decode()
+        data = {'content': content, 'encoding': 'base64'}
+        resp = do_github_post_req('/repos/{owner}/{repo}/git/blobs'.format(**locals()), data, self.auth)
+        if '{0}'.format(resp.getcode()) not in ['200', '201']:
+            raise GithubException("Failed to create a blob on '{owner}/{repo}'".format(**locals()), resp)
+        return json_loads(resp)['sha']
+
+    def create_tree(self, owner, repo, base_tree, blobs):
+        """Create a tree by replacing the given ``{path: blob_sha}`` files in ``base_tree``."""
+        data = {
+            'base_tree': base_tree,
+            'tree': [{'path': path, 'mode': '100644', 'type': 'blob', 'sha': sha}
+                     for path, sha in sorted(blobs.items())],
+        }
+        resp = do_github_post_req('/repos/{owner}/{repo}/git/trees'.format(**locals()), data, self.auth)
+        if '{0}'.format(resp.getcode()) not in ['200', '201']:
+            raise GithubException("Failed to create a tree on '{owner}/{repo}'".format(**locals()), resp)
+        return json_loads(resp)['sha']
+
+    def create_commit(self, owner, repo, message, tree, parents):
+        data = {'message': message, 'tree': tree, 'parents': parents}
+        resp = do_github_post_req('/repos/{owner}/{repo}/git/commits'.format(**locals()), data, self.auth)
+        if '{0}'.format(resp.getcode()) not in ['200', '201']:
+            raise GithubException("Failed to create a commit on '{owner}/{repo}'".format(**locals()), resp)
+        return json_loads(resp)['sha']
+
+    def create_branch(self, owner, repo, branch, sha):
+        data = {'ref': 'refs/heads/' + branch, 'sha': sha}
+        resp = do_github_post_req('/repos/{owner}/{repo}/git/refs'.format(**locals()), data, self.auth)
+        if '{0}'.format(resp.getcode()) not in ['200', '201']:
+            raise GithubException(
+                "Failed to create branch '{branch}' on '{owner}/{repo}'".format(**locals()), resp)
+        return json_loads(resp)
 
     def create_pull_request(self, org, repo, branch, fork_org, fork_branch, title, body=""):
         data = {
@@ -300,7 +645,8 @@ def get_github_interface(quiet=False):
             token = config.get('oauth_token', None)
             username = config.get('github_user', None)
             if token and username:
-                return Github(username, auth=auth_header_from_token(username, token), token=token)
+                _gh = Github(username, auth=auth_header_from_token(username, token), token=token)
+                return _gh
     if not os.path.isdir(os.path.dirname(oauth_config_path)):
         os.makedirs(os.path.dirname(oauth_config_path))
     if quiet:
@@ -303,7 +303,11 @@ _summary_file = None
 def _get_summary_file_path():
     global _summary_file, _file_log_prefix, _log_id
     if _summary_file is None:
-        _summary_file = os.path.join(_file_log_prefix, _log_id + '.summary')
+        summary_id = _log_id
+        if str(os.getpid()) != _log_id:
+            # Forked workers, e.g. of a fleet release, write their own summary
+            summary_id += '-' + str(os.getpid())
+        _summary_file = os.path.join(_file_log_prefix, summary_id + '.summary')
     return _summary_file
 
 
@@ -37,10 +37,19 @@ Provides common utility functions for bloom.
 
 from __future__ import print_function
 
+import hashlib
 import os
+import re
 import sys
 import traceback
 
+from subprocess import CalledProcessError
+from xml.etree import ElementTree
+
+from bloom.git import cat_files
+from bloom.git import get_object_hash
+from bloom.git import get_object_hashes
+from bloom.git import list_tree_files
 from bloom.git import show
 
 from bloom.config import BLOOM_CONFIG_BRANCH
@@ -51,6 +60,20 @@ from bloom.logging import info
 from bloom.logging import warning
 
 try:
+    from catkin_pkg.changelog import Changelog
+    from catkin_pkg.changelog import CHANGELOG_FILENAME
+    from catkin_pkg.changelog import populate_changelog_from_rst
+    from catkin_pkg.group_dependency import GroupDependency
+    from catkin_pkg.group_membership import GroupMembership
+    from catkin_pkg.package import Dependency
+    from catkin_pkg.package import Export
+    from catkin_pkg.package import License
+    from catkin_pkg.package import Package
+    from catkin_pkg.package import parse_package_string
+    from catkin_pkg.package import PACKAGE_MANIFEST_FILENAME
+    from catkin_pkg.package import Person
+    from catkin_pkg.package import Url
+    from catkin_pkg.packages import DEFAULT_IGNORE_MARKERS
     from catkin_pkg.packages import find_packages
     from catkin_pkg.packages import verify_equal_package_versions
 except ImportError:
@@ -58,6 +81,18 @@ except ImportError:
     error("catkin_pkg was not detected, please install it.",
           file=sys.stderr, exit=True)
 
+# Parsed package data, keyed on the tree being searched and the ignore file
+_package_data_cache = {}
+# Parsed changelogs, keyed on the git blob hash of the CHANGELOG.rst
+_changelog_cache = {}
+
+_DEPEND_ATTRIBUTES = ['version_lt', 'version_lte', 'version_eq', 'version_gte', 'version_gt']
+
+
+class _UnsupportedManifest(Exception):
+    """Raised when a manifest has to be parsed by catkin_pkg instead."""
+    pass
+
 
 def get_ignored_packages(release_directory=None):
     prefix = os.environ.get('BLOOM_TRACK', 'packages')
@@ -65,13 +100,343 @@ def get_ignored_packages(release_directory=None):
     return [p.strip() for p in data.split() if p.strip()]
 
 
-def get_package_data(branch_name=None, directory=None, quiet=True, release_directory=None):
+def _escape_xml(data):
+    # Same escaping as xml.dom.minidom, which catkin_pkg serializes with
+    if not data:
+        return ''
+    return data.replace('&', '&amp;').replace('<', '&lt;').replace('"', '&quot;').replace('>', '&gt;')
+
+
+def _element_to_xml(element):
+    if element.tag is ElementTree.Comment:
+        return '<!--{0}-->'.format(element.text)
+    attributes = ''.join(' {0}="{1}"'.format(k, _escape_xml(v)) for k, v in element.attrib.items())
+    if element.text is None and len(element) == 0:
+        return '<{0}{1}/>'.format(element.tag, attributes)
+    return '<{0}{1}>{2}</{0}>'.format(element.tag, attributes, _element_content_to_xml(element))
+
+
+def _element_content_to_xml(element):
+    return _escape_xml(element.text) + ''.join(
+        _element_to_xml(child) + _escape_xml(child.tail) for child in element)
+
+
+def _element_value(element, allow_xml=False):
+    if allow_xml:
+        value = _element_content_to_xml(element)
+    else:
+        value = (element.text or '') + ''.join(child.tail or '' for child in element)
+    return value.strip(' \n\r\t')
+
+
+def _element_text(element):
+    value = re.sub(r'\s+', ' ', element.text or '')
+    for child in element:
+        if child.tag == 'br':
+            value += '\n'
+        elif child.tag is not ElementTree.Comment:
+            value += _element_text(child)
+        value += re.sub(r'\s+', ' ', child.tail or '')
+    return value
+
+
+def _parse_package_fast(data, filename):
+    """
+    Parses a package.xml with a single expat pass into a ``Package``.
+
+    Mirrors catkin_pkg's parse_package_string for valid manifests, without
+    validating the result.
+
+    :raises: _UnsupportedManifest if catkin_pkg has to parse the manifest,
+        e.g. because it is invalid or uses XML features not handled here
+    """
+    root_start = data.find('<package')
+    if root_start == -1 or 'xmlns' in data or '<![CDATA[' in data or \
+            '<!DOCTYPE' in data or data.find('<?', root_start) != -1:
+        raise _UnsupportedManifest()
+    try:
+        parser = ElementTree.XMLParser(target=ElementTree.TreeBuilder(insert_comments=True))
+        parser.feed(data)
+        root = parser.close()
+    except ElementTree.ParseError:
+        raise _UnsupportedManifest()
+    if root.tag != 'package' or set(root.attrib) - set(['format']):
+        raise _UnsupportedManifest()
+    package_format = int(root.get('format', 1))
+    if package_format not in (1, 2, 3):
+        raise _UnsupportedManifest()
+
+    children = [child for child in root if child.tag is not ElementTree.Comment]
+    depend_attributes = _DEPEND_ATTRIBUTES + (['condition'] if package_format > 2 else [])
+    known = {
+        'name': [], 'version': ['compatibility'], 'description': [], 'maintainer': ['email'],
+        'license': ['file'] if package_format > 2 else [], 'url': ['type'], 'author': ['email'],
+        'build_depend': depend_attributes, 'buildtool_depend': depend_attributes,
+        'test_depend': depend_attributes, 'conflict': depend_attributes,
+        'replace': depend_attributes, 'export': [],
+    }
+    if package_format == 1:
+        known['run_depend'] = depend_attributes
+    else:
+        for tag in ['build_export_depend', 'buildtool_export_depend', 'depend', 'exec_depend', 'doc_depend']:
+            known[tag] = depend_attributes
+    if package_format > 2:
+        known['group_depend'] = ['condition']
+        known['member_of_group'] = ['condition']
+    for child in children:
+        if child.tag not in known or set(child.attrib) - set(known[child.tag]):
+            raise _UnsupportedManifest()
+        if child.tag not in ['description', 'export'] and \
+                any(c.tag is not ElementTree.Comment for c in child):
+            raise _UnsupportedManifest()
+
+    by_tag = {}
+    for child in children:
+        by_tag.setdefault(child.tag, []).append(child)
+
+    def elements(tag):
+        return by_tag.get(tag, [])
+
+    def element(tag, optional=False):
+        found = elements(tag)
+        if len(found) > 1 or (not found and not optional):
+            raise _UnsupportedManifest()
+        return found[0] if found else None
+
+    def dependencies(tag):
+        depends = []
+        for node in elements(tag):
+            depend = Dependency(str(_element_value(node)))
+            for attr in _DEPEND_ATTRIBUTES + ['condition']:
+                setattr(depend, attr, node.get(attr))
+            depends.append(depend)
+        return depends
+
+    def copy_dependency(depend):
+        # Cheaper than copy.deepcopy, the attributes are all strings
+        copied = Dependency(depend.name)
+        for attr in _DEPEND_ATTRIBUTES + ['condition']:
+            setattr(copied, attr, getattr(depend, attr))
+        return copied
+
+    pkg = Package(filename)
+    pkg.package_format = package_format
+    pkg.name = str(_element_value(element('name')))
+    version = element('version')
+    pkg.version = str(_element_value(version))
+    pkg.version_compatibility = version.get('compatibility')
+    description = element('description')
+    pkg.description = _element_value(description, allow_xml=True)
+    pkg.plaintext_description = re.sub(
+        ' +(\n+) +', r'\1', _element_text(description).strip(), flags=re.MULTILINE)
+    for node in elements('maintainer'):
+        if node.get('email') is None:
+            raise _UnsupportedManifest()
+        pkg.maintainers.append(Person(_element_value(node), node.get('email')))
+    for node in elements('url'):
+        pkg.urls.append(Url(str(_element_value(node)), node.get('type', 'website')))
+    for node in elements('author'):
+        pkg.authors.append(Person(_element_value(node), node.get('email')))
+    for node in elements('license'):
+        pkg.licenses.append(License(_element_value(node), node.get('file')))
+
+    pkg.build_depends = dependencies('build_depend')
+    pkg.buildtool_depends = dependencies('buildtool_depend')
+    if package_format == 1:
+        for depend in dependencies('run_depend'):
+            pkg.build_export_depends.append(copy_dependency(depend))
+            pkg.exec_depends.append(copy_dependency(depend))
+    else:
+        pkg.build_export_depends = dependencies('build_export_depend')
+        pkg.buildtool_export_depends = dependencies('buildtool_export_depend')
+        pkg.exec_depends = dependencies('exec_depend')
+        for depend in dependencies('depend'):
+            # catkin_pkg reports redundant generic dependencies as errors
+            if depend in pkg.build_depends or depend in pkg.build_export_depends or depend in pkg.exec_depends:
+                raise _UnsupportedManifest()
+            pkg.build_depends.append(copy_dependency(depend))
+            pkg.build_export_depends.append(copy_dependency(depend))
+            pkg.exec_depends.append(copy_dependency(depend))
+        pkg.doc_depends = dependencies('doc_depend')
+    pkg.test_depends = dependencies('test_depend')
+    pkg.conflicts = dependencies('conflict')
+    pkg.replaces = dependencies('replace')
+    pkg.group_depends = [GroupDependency(str(_element_value(node)), condition=node.get('condition'))
+                         for node in elements('group_depend')]
+    pkg.member_of_groups = [GroupMembership(str(_element_value(node)), condition=node.get('condition'))
+                            for node in elements('member_of_group')]
+    if package_format == 1:
+        run_depends = pkg.run_depends
+        if any(d in pkg.build_depends or d in run_depends for d in pkg.test_depends):
+            raise _UnsupportedManifest()
+
+    export = element('export', optional=True)
+    if export is not None:
+        for node in export:
+            if node.tag is ElementTree.Comment:
+                continue
+            exported = Export(str(node.tag), _element_value(node, allow_xml=True))
+            for key, value in node.attrib.items():
+                exported.attributes[str(key)] = str(value)
+            pkg.exports.append(exported)
+    return pkg
+
+
+def parse_packages(manifests, warnings=None):
+    """
+    Parses many package.xml manifests in one call.
+
+    Each manifest is read in a single expat pass through ElementTree
+    instead of catkin_pkg's minidom based parser, producing the same
+    ``Package`` objects. Manifests the fast path does not handle, e.g.
+    invalid ones or ones using XML namespaces or CDATA, are parsed by
+    catkin_pkg so errors are reported exactly as before.
+
+    :param manifests: dict of package.xml filenames to their contents, as
+        str or UTF-8 encoded bytes
+    :param warnings: print warnings if None or return them in the given list
+    :returns: dict of the filenames to ``Package`` objects
+    :raises: catkin_pkg.package.InvalidPackage if a manifest is invalid
+    """
+    packages = {}
+    for filename, data in manifests.items():
+        if isinstance(data, bytes):
+            data = data.decode('utf-8')
+        try:
+            package = _parse_package_fast(data, filename)
+        except (_UnsupportedManifest, ValueError):
+            packages[filename] = parse_package_string(data, filename=filename, warnings=warnings)
+            continue
+        package.validate(warnings=warnings)
+        packages[filename] = package
+    return packages
+
+
+def find_package_paths_in_tree(files, ignore_markers=DEFAULT_IGNORE_MARKERS):
+    """
+    Finds the package folders in a list of files, like catkin_pkg's find_package_paths.
+
+    The same rules apply: folders containing an ignore marker file are
+    skipped, packages are not searched for inside of other packages and
+    hidden folders are skipped.
+
+    :param files: list of '/' separated file paths, e.g. from ``git ls-tree``
+    :param ignore_markers: names of files that indicate that a folder should be ignored
+    :returns: sorted list of package folders, '.' for the top level folder
+    """
+    ignored = set()
+    manifests = set()
+    for path in files:
+        parts = path.split('/')
+        # Only files are markers, a folder of that name does not ignore its parent
+        if parts[-1] in ignore_markers:
+            ignored.add('/'.join(parts[:-1]))
+        if parts[-1] == PACKAGE_MANIFEST_FILENAME:
+            manifests.add('/'.join(parts[:-1]))
+    paths = []
+    for manifest_dir in manifests:
+        parts = manifest_dir.split('/') if manifest_dir else []
+        ancestors = ['/'.join(parts[:index]) for index in range(len(parts) + 1)]
+        if any(part.startswith('.') for part in parts) or \
+                any(ancestor in ignored for ancestor in ancestors) or \
+                any(ancestor in manifests for ancestor in ancestors[:-1]):
+            continue
+        paths.append(manifest_dir or '.')
+    return sorted(paths)
+
+
+def find_packages_in_tree(directory=None, reference='HEAD', warnings=None):
+    """
+    Finds and parses the packages in a git tree, like catkin_pkg's find_packages.
+
+    Manifest paths come from a single ``git ls-tree -r`` and only the
+    manifest blobs are read, so nothing else in the tree is touched and no
+    checkout of the reference is needed.
+
+    :param directory: folder of a git repository to search in, cwd by default
+    :param reference: git reference whose tree is searched
+    :param warnings: print warnings if None or return them in the given list
+    :returns: dict of relative paths to ``Package`` objects, or None if the
+        folder is not in a git repository, the reference does not exist or
+        it has submodules which may contain packages
+    :raises: RuntimeError if multiple packages have the same name
+    """
+    basepath = directory or os.getcwd()
+    try:
+        files = list_tree_files(reference, directory=basepath, types=('blob', 'commit'))
+    except (CalledProcessError, OSError):
+        return None
+    if files is None or any(mode == '160000' for mode, _ in files.values()):
+        return None
+    paths = find_package_paths_in_tree(files)
+    manifests = {}
+    for path in paths:
+        manifest = PACKAGE_MANIFEST_FILENAME if path == '.' else path + '/' + PACKAGE_MANIFEST_FILENAME
+        manifests[path] = files[manifest][1]
+    contents = cat_files(set(manifests.values()), directory=basepath)
+    filenames = dict((path, os.path.join(basepath, path, PACKAGE_MANIFEST_FILENAME)) for path in paths)
+    parsed = parse_packages(dict((filenames[path], contents[sha]) for path, sha in manifests.items()),
+                            warnings=warnings)
+    packages = {}
+    paths_by_name = {}
+    for path in paths:
+        packages[path] = parsed[filenames[path]]
+        paths_by_name.setdefault(packages[path].name, []).append(path)
+    duplicates = sorted(name for name, names in paths_by_name.items() if len(names) > 1)
+    if duplicates:
+        raise RuntimeError('\n'.join(
+            'Multiple packages found with the same name "{0}":{1}'
+            .format(name, ''.join('\n- ' + p for p in sorted(paths_by_name[name]))) for name in duplicates))
+    return packages
+
+
+def get_package_data_key(directory=None, release_directory=None, reference=None):
+    """
+    Returns the key package data of a directory is cached with, or None.
+
+    The key is made of the git tree hash of the directory and the blob hash
+    of the ignored packages file, both resolved with a single git call when
+    the ignore file lives in the same repository. The tree hash describes
+    the committed state, which matches the working tree in the clean
+    clones bloom operates in.
+
+    :param directory: directory being searched for packages, cwd by default
+    :param release_directory: repository holding the ignored packages file
+    :param reference: git reference searched instead of HEAD
+    :returns: hashable key, or None if the directory is not a git tree
+    """
+    repo_dir = os.path.realpath(directory or os.getcwd())
+    track = os.environ.get('BLOOM_TRACK', 'packages')
+    ignore_file = '{0}:{1}.ignored'.format(BLOOM_CONFIG_BRANCH, track)
+    tree = '{0}:./'.format(reference or 'HEAD')
+    objects = [tree]
+    if release_directory is None or os.path.realpath(release_directory) == repo_dir:
+        objects.append(ignore_file)
+    try:
+        hashes = get_object_hashes(objects, directory=repo_dir)
+        if ignore_file not in hashes:
+            hashes.update(get_object_hashes([ignore_file], directory=release_directory))
+    except (CalledProcessError, OSError):
+        return None
+    if hashes[tree] is None:
+        return None
+    return (repo_dir, hashes[tree], track, hashes[ignore_file])
+
+
+def get_package_data(branch_name=None, directory=None, quiet=True, release_directory=None, reference=None):
     """
     Gets package data about the package(s) in the current branch.
 
     It also ignores the packages in the `packages.ignore` file in the master branch.
 
+    Package manifests are located from the git tree rather than by walking
+    the filesystem, see :py:func:`find_packages_in_tree`. Results are cached
+    on the tree hash of the directory and the hash of the ignore file, see
+    :py:func:`get_package_data_key`.
+
     :param branch_name: name of the branch you are searching on (log use only)
+    :param reference: git reference to read the packages from without
+        checking it out, by default the packages in HEAD are used
     """
     log = debug if quiet else info
     repo_dir = directory or os.getcwd()
@@ -79,8 +444,24 @@ def get_package_data(branch_name=None, directory=None, quiet=True, release_direc
         log("Looking for packages in '{0}' branch... ".format(branch_name), end='')
     else:
         log("Looking for packages in '{0}'... ".format(directory or os.getcwd()), end='')
+    key = get_package_data_key(repo_dir, release_directory, reference)
+    if key is not None and key in _package_data_cache:
+        names, version, packages = _package_data_cache[key]
+        log("found " + str(len(names)) + " packages (cached).", use_prefix=False)
+        return list(names), version, dict(packages)
+    package_data = _get_package_data(repo_dir, log, release_directory, reference)
+    if key is not None:
+        _package_data_cache[key] = package_data
+    names, version, packages = package_data
+    return list(names), version, dict(packages)
+
+
+def _get_package_data(repo_dir, log, release_directory, reference):
     # Check for package.xml(s)
-    packages = find_packages(repo_dir)
+    packages = find_packages_in_tree(repo_dir, reference or 'HEAD')
+    if not packages and reference is None:
+        # Not a git tree, or the packages are not committed
+        packages = find_packages(repo_dir)
     if type(packages) == dict and packages != {}:
         if len(packages) > 1:
             log("found " + str(len(packages)) + " packages.",
@@ -111,3 +492,66 @@ def get_package_data(branch_name=None, directory=None, quiet=True, release_direc
     log("failed.", use_prefix=False)
     error("No package.xml(s) found, and '--package-name' not given, aborting.",
           use_prefix=False, exit=True)
+
+
+def get_blob_hash(data):
+    """
+    Returns the git blob hash of the given contents, without calling git.
+
+    :param data: file contents as bytes
+    """
+    return hashlib.sha1(b'blob ' + str(len(data)).encode('ascii') + b'\0' + data).hexdigest()
+
+
+def parse_changelog(data, blob_hash=None):
+    """
+    Parses the contents of a CHANGELOG.rst, cached on its git blob hash.
+
+    The returned Changelog is shared between callers and must not be modified.
+
+    :param data: CHANGELOG.rst contents as bytes
+    :param blob_hash: git blob hash of the contents, computed if not given
+    :returns: catkin_pkg ``Changelog``
+    """
+    blob_hash = blob_hash or get_blob_hash(data)
+    if blob_hash not in _changelog_cache:
+        _changelog_cache[blob_hash] = populate_changelog_from_rst(Changelog(), data.decode('utf-8'))
+    return _changelog_cache[blob_hash]
+
+
+def get_changelog_from_file(path):
+    """
+    Returns the parsed changelog of a package folder, like catkin_pkg's get_changelog_from_path.
+
+    :param path: path of the CHANGELOG.rst or of the folder containing it
+    :returns: catkin_pkg ``Changelog``, or None if there is no changelog
+    """
+    if os.path.isdir(path):
+        path = os.path.join(path, CHANGELOG_FILENAME)
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except IOError:
+        return None
+    return parse_changelog(data)
+
+
+def get_changelog_from_reference(reference, path=None, directory=None):
+    """
+    Returns the parsed changelog of a package in a git reference, without checking it out.
+
+    Only the blob hash is looked up when the changelog was already parsed,
+    e.g. while generating the same package for another distro.
+
+    :param reference: git reference, e.g. a release branch
+    :param path: folder of the package in the reference, the top level by default
+    :param directory: directory of the git repository
+    :returns: catkin_pkg ``Changelog``, or None if there is no changelog
+    """
+    changelog_path = CHANGELOG_FILENAME if path in [None, '', '.'] else path + '/' + CHANGELOG_FILENAME
+    blob_hash = get_object_hash(reference, changelog_path, directory=directory)
+    if blob_hash is None:
+        return None
+    if blob_hash not in _changelog_cache:
+        return parse_changelog(cat_files([blob_hash], directory=directory)[blob_hash], blob_hash)
+    return _changelog_cache[blob_hash]
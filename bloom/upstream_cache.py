@@ -0,0 +1,397 @@
+# Software License Agreement (BSD License)
+#
+# Copyright (c) 2013, Open Source Robotics Foundation, Inc.
+# All rights reserved.
+#
+# Redistribution and use in source and binary forms, with or without
+# modification, are permitted provided that the following conditions
+# are met:
+#
+#  * Redistributions of source code must retain the above copyright
+#    notice, this list of conditions and the following disclaimer.
+#  * Redistributions in binary form must reproduce the above
+#    copyright notice, this list of conditions and the following
+#    disclaimer in the documentation and/or other materials provided
+#    with the distribution.
+#  * Neither the name of Open Source Robotics Foundation, Inc. nor
+#    the names of its contributors may be used to endorse or promote
+#    products derived from this software without specific prior
+#    written permission.
+#
+# THIS SOFTWARE IS PROVIDED BY THE COPYRIGHT HOLDERS AND CONTRIBUTORS
+# "AS IS" AND ANY EXPRESS OR IMPLIED WARRANTIES, INCLUDING, BUT NOT
+# LIMITED TO, THE IMPLIED WARRANTIES OF MERCHANTABILITY AND FITNESS
+# FOR A PARTICULAR PURPOSE ARE DISCLAIMED. IN NO EVENT SHALL THE
+# COPYRIGHT OWNER OR CONTRIBUTORS BE LIABLE FOR ANY DIRECT, INDIRECT,
+# INCIDENTAL, SPECIAL, EXEMPLARY, OR CONSEQUENTIAL DAMAGES (INCLUDING,
+# BUT NOT LIMITED TO, PROCUREMENT OF SUBSTITUTE GOODS OR SERVICES;
+# LOSS OF USE, DATA, OR PROFITS; OR BUSINESS INTERRUPTION) HOWEVER
+# CAUSED AND ON ANY THEORY OF LIABILITY, WHETHER IN CONTRACT, STRICT
+# LIABILITY, OR TORT (INCLUDING NEGLIGENCE OR OTHERWISE) ARISING IN
+# ANY WAY OUT OF THE USE OF THIS SOFTWARE, EVEN IF ADVISED OF THE
+# POSSIBILITY OF SUCH DAMAGE.
+
+"""Implements a persistent cache of bare mirrors of upstream git repositories.
+
+Releasing the same upstream again only has to fetch what changed since the
+last release, and the clones made from a mirror are local clones.  Exported
+archives are cached as well, keyed on the commit they were made of, so
+re-releasing a tag does not export and checksum it again.
+
+The cache is kept in ``$BLOOM_UPSTREAM_CACHE_DIR``, by default in
+``$XDG_CACHE_HOME/bloom/upstream``, and can be disabled by setting
+``BLOOM_NO_UPSTREAM_CACHE``.  Mirrors which were not used for
+``BLOOM_UPSTREAM_CACHE_MAX_AGE_DAYS`` (30) days are evicted, as are the least
+recently used mirrors when the cache grows over
+``BLOOM_UPSTREAM_CACHE_MAX_SIZE_MB`` (20480) megabytes.  Archives are kept
+in ``$BLOOM_ARCHIVE_CACHE_DIR``, by default ``$XDG_CACHE_HOME/bloom/archives``,
+unless ``BLOOM_NO_ARCHIVE_CACHE`` is set.
+"""
+
+from __future__ import print_function
+
+import hashlib
+import json
+import os
+import re
+import shutil
+import subprocess
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # Not available on Windows, the cache is disabled there
+    fcntl = None
+
+from bloom.archive import split_archive_path
+
+from bloom.git import get_object_hash
+
+from bloom.logging import debug
+from bloom.logging import info
+from bloom.logging import warning
+
+from bloom.util import check_output
+from bloom.util import execute_command
+from bloom.util import get_cache_max_age
+from bloom.util import is_cache_eviction_due
+
+
+def _get_cache_dir(name, disable_env, dir_env):
+    if disable_env in os.environ or fcntl is None:
+        return None
+    cache_dir = os.environ.get(dir_env)
+    if not cache_dir:
+        cache_home = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'bloom', name)
+    return cache_dir
+
+
+def get_upstream_cache_dir():
+    """
+    Returns the directory of the upstream mirror cache.
+
+    :returns: path of the cache directory, or None if the cache is disabled
+    """
+    return _get_cache_dir('upstream', 'BLOOM_NO_UPSTREAM_CACHE', 'BLOOM_UPSTREAM_CACHE_DIR')
+
+
+def get_archive_cache_dir():
+    """
+    Returns the directory of the upstream archive cache.
+
+    :returns: path of the cache directory, or None if the cache is disabled
+    """
+    return _get_cache_dir('archives', 'BLOOM_NO_ARCHIVE_CACHE', 'BLOOM_ARCHIVE_CACHE_DIR')
+
+
+def get_mirror_name(uri):
+    """
+    Returns the name of the mirror of an upstream repository in the cache.
+
+    :param uri: uri of the upstream repository
+    :returns: the last component of the uri followed by a hash of the uri,
+        e.g. ``ros_comm-0123456789ab``
+    """
+    base = uri.rstrip('/').split('/')[-1].split(':')[-1]
+    if base.endswith('.git'):
+        base = base[:-len('.git')]
+    base = re.sub(r'[^A-Za-z0-9_.-]', '_', base) or 'upstream'
+    return '{0}-{1}'.format(base, hashlib.sha1(uri.encode('utf-8')).hexdigest()[:12])
+
+
+def update_mirror(uri, path):
+    """
+    Creates or incrementally updates a bare mirror of the branches and tags
+    of an upstream repository.
+
+    :param uri: uri of the upstream repository
+    :param path: path of the bare mirror
+    :returns: True if the mirror is up to date, False otherwise
+    """
+    created = not os.path.exists(path)
+    try:
+        if created:
+            info("Creating a mirror of '{0}' in the upstream cache".format(uri))
+            execute_command(['git', 'init', '--quiet', '--bare', path], shell=False)
+            execute_command(['git', 'remote', 'add', 'origin', uri], shell=False, cwd=path)
+            execute_command(['git', 'config', '--replace-all', 'remote.origin.fetch',
+                             '+refs/heads/*:refs/heads/*'], shell=False, cwd=path)
+            execute_command(['git', 'config', '--add', 'remote.origin.fetch',
+                             '+refs/tags/*:refs/tags/*'], shell=False, cwd=path)
+        else:
+            info("Updating the mirror of '{0}' in the upstream cache".format(uri))
+        execute_command(['git', 'fetch', '--quiet', '--prune', 'origin'], shell=False, cwd=path)
+        if created:
+            # Clones of the mirror should default to the upstream's default branch
+            output = check_output(['git', 'ls-remote', '--symref', 'origin', 'HEAD'], cwd=path)
+            for line in output.splitlines():
+                if line.startswith('ref: refs/heads/') and line.endswith('\tHEAD'):
+                    execute_command(['git', 'symbolic-ref', 'HEAD', line[len('ref: '):-len('\tHEAD')]],
+                                    shell=False, cwd=path)
+    except (subprocess.CalledProcessError, OSError) as exc:
+        warning("Could not update the mirror of '{0}', not using the upstream cache: {1}".format(uri, exc))
+        if created and os.path.exists(path):
+            shutil.rmtree(path)
+        return False
+    return True
+
+
+def mirror_has_submodules(path, reference):
+    """
+    Returns True if the given reference of a mirror uses git submodules.
+
+    Clones of a mirror resolve relative submodule urls against the mirror,
+    so those repositories should be cloned from the upstream instead.
+
+    :param path: path of the bare mirror
+    :param reference: branch or tag to check, None for the default branch
+    """
+    return get_object_hash(reference or 'HEAD', '.gitmodules', directory=path) is not None
+
+
+class upstream_mirror(object):
+    """
+    Context manager which provides an up to date mirror of an upstream.
+
+    The mirror is locked while the context is active, so concurrent releases
+    of the same upstream do not update it at the same time.  The context
+    value is the path of the bare mirror, or None if the cache is disabled,
+    the upstream is not a git repository, or the mirror could not be updated;
+    callers should then use the upstream uri directly.
+
+    :param uri: uri of the upstream repository
+    :param vcs_type: vcs type of the upstream repository
+    """
+    def __init__(self, uri, vcs_type='git'):
+        self.uri = uri
+        self.vcs_type = vcs_type
+        self.cache_dir = None
+        self.lock_file = None
+
+    def __enter__(self):
+        if self.vcs_type != 'git':
+            return None
+        self.cache_dir = get_upstream_cache_dir()
+        if self.cache_dir is None:
+            return None
+        name = get_mirror_name(self.uri)
+        try:
+            if not os.path.isdir(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            self.lock_file = open(os.path.join(self.cache_dir, name + '.lock'), 'a')
+            fcntl.flock(self.lock_file, fcntl.LOCK_EX)
+        except (IOError, OSError) as exc:
+            warning("Could not lock the upstream cache in '{0}', not using it: {1}".format(self.cache_dir, exc))
+            self.cache_dir = None
+            return None
+        path = os.path.join(self.cache_dir, name + '.git')
+        return path if update_mirror(self.uri, path) else None
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self.lock_file is not None:
+            # The modification time of the lock file records the last use
+            os.utime(self.lock_file.name, None)
+            fcntl.flock(self.lock_file, fcntl.LOCK_UN)
+            self.lock_file.close()
+            self.lock_file = None
+        if self.cache_dir is not None:
+            evict_upstream_cache(self.cache_dir)
+
+
+def _get_directory_size(path):
+    size = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            try:
+                size += os.lstat(os.path.join(root, name)).st_size
+            except OSError:
+                pass
+    return size
+
+
+def evict_upstream_cache(cache_dir, force=False):
+    """
+    Removes mirrors which were not used recently from the upstream cache.
+
+    Mirrors unused for longer than ``BLOOM_UPSTREAM_CACHE_MAX_AGE_DAYS`` are
+    removed first, then the least recently used mirrors until the cache is
+    smaller than ``BLOOM_UPSTREAM_CACHE_MAX_SIZE_MB``.  Mirrors which are in
+    use are skipped.  Unless forced, this runs at most once a day.
+
+    :param cache_dir: the upstream cache directory
+    :param force: if True, check the cache even if it was checked recently
+    """
+    if not is_cache_eviction_due(cache_dir, force):
+        return
+    now = time.time()
+    max_age = get_cache_max_age()
+    max_size = float(os.environ.get('BLOOM_UPSTREAM_CACHE_MAX_SIZE_MB', 20480)) * 1024 * 1024
+    mirrors = []
+    for entry in os.listdir(cache_dir):
+        if not entry.endswith('.git'):
+            continue
+        path = os.path.join(cache_dir, entry)
+        lock_path = path[:-len('.git')] + '.lock'
+        last_used = os.path.getmtime(lock_path if os.path.exists(lock_path) else path)
+        mirrors.append((last_used, path, lock_path, _get_directory_size(path)))
+    total_size = sum(m[3] for m in mirrors)
+    for last_used, path, lock_path, size in sorted(mirrors):
+        if now - last_used <= max_age and total_size <= max_size:
+            break
+        # The lock files are kept, so that every user locks the same file
+        with open(lock_path, 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                debug("Not evicting '{0}' from the upstream cache, it is in use".format(path))
+                continue
+            try:
+                info("Evicting '{0}' from the upstream cache".format(os.path.basename(path)))
+                shutil.rmtree(path)
+                total_size -= size
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+
+def get_archive_commit(vcs_type, reference, directory):
+    """
+    Returns the commit an upstream archive of the given reference is made of.
+
+    :param vcs_type: vcs type of the upstream repository
+    :param reference: branch or tag being exported, None for the default branch
+    :param directory: path of a clone or mirror of the upstream repository
+    :returns: SHA-1 hash of the commit, or None if it cannot be determined
+    """
+    if vcs_type != 'git':
+        return None
+    return get_object_hash((reference or 'HEAD') + '^{commit}', directory=directory)
+
+
+def _get_archive_cache_paths(commit, name, path, compression_level=None):
+    cache_dir = get_archive_cache_dir()
+    archive_format = split_archive_path(path)[1]
+    if cache_dir is None or commit is None or archive_format is None:
+        return None, None
+    # Archives compressed at another level are different files
+    level = '' if compression_level is None else '-level{0}'.format(compression_level)
+    archive_path = os.path.join(cache_dir, '{0}-{1}{2}.{3}'.format(name, commit, level, archive_format))
+    return archive_path, archive_path + '.json'
+
+
+def restore_cached_archive(commit, name, path, compression_level=None):
+    """
+    Places the cached archive of a commit at the given path.
+
+    :param commit: SHA-1 hash of the exported commit
+    :param name: prefix of the archive, e.g. ``upstream-1.2.3``
+    :param path: destination path of the archive, its extension selects the
+        archive format
+    :param compression_level: compression level the archive was made with,
+        or None for the default level
+    :returns: md5 checksum of the archive, or None if it is not in the cache
+    """
+    archive_path, manifest_path = _get_archive_cache_paths(commit, name, path, compression_level)
+    if archive_path is None:
+        return None
+    try:
+        with open(manifest_path, 'r') as f:
+            manifest = json.load(f)
+        if os.path.getsize(archive_path) != manifest['size']:
+            warning("Ignoring the cached archive '{0}', its size does not match".format(archive_path))
+            return None
+        if os.path.exists(path):
+            os.remove(path)
+        try:
+            os.link(archive_path, path)
+        except OSError:
+            shutil.copyfile(archive_path, path)
+        # The modification time of the manifest records the last use
+        os.utime(manifest_path, None)
+    except (IOError, OSError, ValueError, KeyError) as exc:
+        debug("Archive of commit '{0}' is not in the cache: {1}".format(commit, exc))
+        return None
+    info("Reusing the cached archive of commit '{0}'".format(commit))
+    return manifest['md5']
+
+
+def store_cached_archive(commit, name, path, md5, compression_level=None):
+    """
+    Adds an exported archive of a commit to the archive cache.
+
+    :param commit: SHA-1 hash of the exported commit
+    :param name: prefix of the archive, e.g. ``upstream-1.2.3``
+    :param path: path of the exported archive
+    :param md5: md5 checksum of the archive
+    :param compression_level: compression level the archive was made with,
+        or None for the default level
+    """
+    archive_path, manifest_path = _get_archive_cache_paths(commit, name, path, compression_level)
+    if archive_path is None:
+        return
+    cache_dir = os.path.dirname(archive_path)
+    try:
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # Write to temporary files and rename, so readers never see partial files
+        tmp_suffix = '.tmp-{0}'.format(os.getpid())
+        shutil.copyfile(path, archive_path + tmp_suffix)
+        os.rename(archive_path + tmp_suffix, archive_path)
+        manifest = {'commit': commit, 'name': name, 'md5': md5, 'size': os.path.getsize(archive_path),
+                    'compression_level': compression_level}
+        with open(manifest_path + tmp_suffix, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.rename(manifest_path + tmp_suffix, manifest_path)
+    except (IOError, OSError) as exc:
+        warning("Could not add the archive to the cache in '{0}': {1}".format(cache_dir, exc))
+        return
+    evict_archive_cache(cache_dir)
+
+
+def evict_archive_cache(cache_dir, force=False):
+    """
+    Removes archives which were not used recently from the archive cache.
+
+    Archives unused for longer than ``BLOOM_UPSTREAM_CACHE_MAX_AGE_DAYS`` are
+    removed.  Unless forced, this runs at most once a day.
+
+    :param cache_dir: the archive cache directory
+    :param force: if True, check the cache even if it was checked recently
+    """
+    if not is_cache_eviction_due(cache_dir, force):
+        return
+    now = time.time()
+    max_age = get_cache_max_age()
+    for entry in os.listdir(cache_dir):
+        if not entry.endswith('.json'):
+            continue
+        manifest_path = os.path.join(cache_dir, entry)
+        try:
+            if now - os.path.getmtime(manifest_path) <= max_age:
+                continue
+            # Remove the manifest first, so the archive is never used without it
+            os.remove(manifest_path)
+            os.remove(manifest_path[:-len('.json')])
+        except OSError:
+            pass
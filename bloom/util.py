@@ -85,6 +85,8 @@ except NameError:
 
 
 def flush_stdin():
+    if not sys.stdin.isatty():
+        return
     try:
         from termios import tcflush, TCIFLUSH
         tcflush(sys.stdin, TCIFLUSH)
@@ -373,6 +375,38 @@ def create_temporary_directory(prefix_dir=None):
     return mkdtemp(prefix='bloom_', dir=prefix_dir)
 
 
+# Cache eviction is checked at most this often, in seconds
+CACHE_EVICTION_INTERVAL = 24 * 60 * 60
+
+
+def is_cache_eviction_due(cache_dir, force=False):
+    """
+    Checks if a cache directory is due for eviction, and marks it as checked.
+
+    The time of the last check is kept in a ``.last-eviction`` stamp file in
+    the cache directory.
+
+    :param cache_dir: the cache directory
+    :param force: if True, the cache is due even if it was checked recently
+    :returns: True if the cache should be checked for entries to evict
+    """
+    stamp = os.path.join(cache_dir, '.last-eviction')
+    if not force and os.path.exists(stamp) and time.time() - os.path.getmtime(stamp) < CACHE_EVICTION_INTERVAL:
+        return False
+    with open(stamp, 'a'):
+        os.utime(stamp, None)
+    return True
+
+
+def get_cache_max_age():
+    """
+    Returns how long cache entries may go unused before they are evicted.
+
+    :returns: ``BLOOM_UPSTREAM_CACHE_MAX_AGE_DAYS`` (30) days, in seconds
+    """
+    return float(os.environ.get('BLOOM_UPSTREAM_CACHE_MAX_AGE_DAYS', 30)) * 24 * 60 * 60
+
+
 def maybe_continue(default='y', msg='Continue'):
     """Prompts the user for continuation"""
     default = default.lower()
@@ -0,0 +1,90 @@
+import os
+import shutil
+import tarfile
+import tempfile
+import zipfile
+
+from bloom.archive import convert_tarball
+from bloom.archive import extract_archive
+from bloom.archive import iter_zip_members
+from bloom.archive import split_archive_path
+
+
+def test_split_archive_path():
+    assert split_archive_path('foo-1.2.3.tar.zst') == ('foo-1.2.3', 'tar.zst')
+    assert split_archive_path('/tmp/foo-1.2.3.zip') == ('/tmp/foo-1.2.3', 'zip')
+    assert split_archive_path('foo-1.2.3.tar.bz2') == ('foo-1.2.3.tar.bz2', None)
+
+
+def test_convert_tarball_to_zip():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp_dir, 'src')
+        os.makedirs(os.path.join(src, 'foo'))
+        with open(os.path.join(src, 'foo', 'run.sh'), 'w') as f:
+            f.write('#!/bin/sh\n')
+        os.chmod(os.path.join(src, 'foo', 'run.sh'), 0o755)
+        os.symlink('foo/run.sh', os.path.join(src, 'link'))
+        tarball = os.path.join(tmp_dir, 'upstream.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            tar.add(os.path.join(src, 'foo'), 'foo')
+            tar.add(os.path.join(src, 'link'), 'link')
+        convert_tarball(tarball, os.path.join(tmp_dir, 'upstream.zip'), 'zip')
+        with zipfile.ZipFile(os.path.join(tmp_dir, 'upstream.zip')) as z:
+            members = dict((m.name, (m, open_member)) for m, open_member in iter_zip_members(z))
+            assert sorted(members) == ['foo', 'foo/run.sh', 'link']
+            assert members['foo'][0].isdir()
+            assert members['link'][0].issym() and members['link'][0].linkname == 'foo/run.sh'
+            run_sh, open_run_sh = members['foo/run.sh']
+            assert run_sh.isfile() and run_sh.mode & 0o100
+            assert open_run_sh().read() == b'#!/bin/sh\n'
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_extract_archive_rejects_unsafe_paths():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        target = os.path.join(tmp_dir, 'a', 'b')
+        os.makedirs(target)
+        evil_zips = {
+            'parent.zip': [('../escaped.txt', 0o100644, b'evil')],
+            'absolute.zip': [('/tmp/escaped.txt', 0o100644, b'evil')],
+            'symlink.zip': [('foo/link', 0o120777, b'../../escaped.txt')],
+        }
+        for name, entries in evil_zips.items():
+            path = os.path.join(tmp_dir, name)
+            with zipfile.ZipFile(path, 'w') as z:
+                for entry_name, mode, data in entries:
+                    entry = zipfile.ZipInfo(entry_name)
+                    entry.external_attr = mode << 16
+                    z.writestr(entry, data)
+            try:
+                extract_archive(path, target)
+            except RuntimeError:
+                pass
+            else:
+                assert False, name + ' was extracted'
+        tarball = os.path.join(tmp_dir, 'parent.tar.gz')
+        with tarfile.open(tarball, 'w:gz') as tar:
+            member = tarfile.TarInfo('../escaped.txt')
+            tar.addfile(member)
+        try:
+            extract_archive(tarball, target)
+        except RuntimeError:
+            pass
+        else:
+            assert False, 'parent.tar.gz was extracted'
+        assert not os.path.exists(os.path.join(tmp_dir, 'a', 'escaped.txt'))
+        assert os.listdir(target) == []
+        # Links which stay inside of the archive are extracted
+        safe = os.path.join(tmp_dir, 'safe.zip')
+        with zipfile.ZipFile(safe, 'w') as z:
+            z.writestr('foo/run.sh', b'#!/bin/sh\n')
+            entry = zipfile.ZipInfo('foo/bar/link')
+            entry.external_attr = 0o120777 << 16
+            z.writestr(entry, b'../run.sh')
+        extract_archive(safe, target)
+        assert os.readlink(os.path.join(target, 'foo', 'bar', 'link')) == '../run.sh'
+    finally:
+        shutil.rmtree(tmp_dir)
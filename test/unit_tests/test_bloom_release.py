@@ -0,0 +1,57 @@
+import os
+import tempfile
+
+from bloom.commands.release import get_fleet_repositories
+from bloom.commands.release import push_distribution_file_via_api
+
+
+def test_get_fleet_repositories_from_file():
+    fd, path = tempfile.mkstemp()
+    try:
+        with os.fdopen(fd, 'w') as f:
+            f.write("# repositories to sync\nros_comm\n\nrviz  # visualization\nros_comm\n")
+        assert get_fleet_repositories('loong', path) == ['ros_comm', 'rviz']
+    finally:
+        os.remove(path)
+
+
+class FakeGithub(object):
+    def __init__(self):
+        self.calls = []
+
+    def get_branch(self, owner, repo, branch):
+        self.calls.append(('get_branch', owner, repo, branch))
+        return {'commit': {'sha': 'base'}}
+
+    def get_git_commit(self, owner, repo, sha):
+        self.calls.append(('get_git_commit', owner, repo, sha))
+        return {'tree': {'sha': 'base-tree'}}
+
+    def create_blob(self, owner, repo, content):
+        self.calls.append(('create_blob', owner, repo, content))
+        return 'blob'
+
+    def create_tree(self, owner, repo, base_tree, blobs):
+        self.calls.append(('create_tree', owner, repo, base_tree, blobs))
+        return 'tree'
+
+    def create_commit(self, owner, repo, message, tree, parents):
+        self.calls.append(('create_commit', owner, repo, message, tree, parents))
+        return 'commit'
+
+    def create_branch(self, owner, repo, branch, sha):
+        self.calls.append(('create_branch', owner, repo, branch, sha))
+
+
+def test_push_distribution_file_via_api():
+    gh = FakeGithub()
+    base_info = {'org': 'ros', 'repo': 'rosdistro', 'branch': 'master', 'path': 'loong/distribution.yaml'}
+    push_distribution_file_via_api(gh, base_info, 'user', 'rosdistro', 'bloom-foo-0', 'foo: 1.0.0', 'yaml')
+    assert gh.calls == [
+        ('get_branch', 'ros', 'rosdistro', 'master'),
+        ('get_git_commit', 'user', 'rosdistro', 'base'),
+        ('create_blob', 'user', 'rosdistro', 'yaml'),
+        ('create_tree', 'user', 'rosdistro', 'base-tree', {'loong/distribution.yaml': 'blob'}),
+        ('create_commit', 'user', 'rosdistro', 'foo: 1.0.0', 'tree', ['base']),
+        ('create_branch', 'user', 'rosdistro', 'bloom-foo-0', 'commit'),
+    ]
@@ -0,0 +1,268 @@
+import argparse
+import os
+import sys
+import tempfile
+
+from ..utils.common import change_environ
+from ..utils.common import in_temporary_directory
+from ..utils.common import redirected_stdio
+
+import bloom.commands.git.generate
+
+from bloom.commands.git.generate import CommandFailed
+from bloom.commands.git.generate import get_branching_parents
+from bloom.commands.git.generate import plan_branch
+from bloom.commands.git.generate import run_branching_dag
+from bloom.commands.git.generate import run_generators
+from bloom.commands.git.generate import split_generators_argument
+
+from bloom.generators.common import BloomGenerator
+from bloom.generators.common import em
+
+from bloom.util import execute_command
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b')
+
+
+def test_get_branching_parents():
+    branching_args = [
+        ('debian/foo', 'release/foo', False),
+        ('debian/jammy/foo', 'debian/foo', False),
+        ('debian/noble/foo', 'debian/foo', False),
+        ('debian/bar', 'release/bar', False),
+        ('debian/jammy/bar', 'debian/bar', False),
+    ]
+    assert get_branching_parents(branching_args) == [None, 0, 0, None, 3]
+
+
+def test_get_branching_parents_independent():
+    branching_args = [
+        ('release/foo', 'upstream', False),
+        ('release/bar', 'upstream', False),
+    ]
+    assert get_branching_parents(branching_args) == [None, None]
+
+
+def test_split_generators_argument():
+    assert split_generators_argument(['-y', 'debian', '-i', '1']) == (None, ['-y', 'debian', '-i', '1'], [])
+    assert split_generators_argument(['-y', '--generators', 'debian,rpm', '--prefix', 'release']) == \
+        (['debian', 'rpm'], ['-y'], ['--prefix', 'release'])
+    assert split_generators_argument(['--generators=rpm, debian,,rpm', '-i', '1']) == \
+        (['rpm', 'debian'], [], ['-i', '1'])
+    # A trailing option without a value is left to the parser
+    assert split_generators_argument(['-y', '--generators']) == (None, ['-y', '--generators'], [])
+
+
+class ExitingGenerator(BloomGenerator):
+    def __init__(self, title, exit_code, ran):
+        self.title = title
+        self.exit_code = exit_code
+        self.ran = ran
+
+    def pre_modify(self):
+        self.ran.append(self.title)
+        if self.exit_code is not None:
+            sys.exit(self.exit_code)
+        return 0
+
+
+def test_run_generators():
+    args = argparse.Namespace(interactive=False, jobs=1)
+    ran = []
+    runs = [(ExitingGenerator(title, exit_code, ran), args)
+            for title, exit_code in [('nothing', 0), ('ok', None), ('failing', 1), ('later', None)]]
+    with redirected_stdio():
+        # Nothing to do does not stop the other generators, a failure does
+        try:
+            run_generators(runs)
+        except SystemExit as exc:
+            assert exc.code == 1
+        else:
+            assert False, "expected the failing generator to stop the run"
+        assert ran == ['nothing', 'ok', 'failing']
+        # A single generator with nothing to do still exits
+        try:
+            run_generators(runs[:1])
+        except SystemExit as exc:
+            assert exc.code == 0
+        else:
+            assert False, "expected the generator to exit"
+
+
+def _logging_branch_node(job):
+    """Stands in for the worker, logging the order the nodes are run in"""
+    index, (destination, source, interactive), origin = job
+    with open(os.path.join(origin, 'order.log'), 'a') as f:
+        f.write(destination + '\n')
+    if destination == 'b':
+        raise RuntimeError("worker died")
+    tmp_dir = tempfile.mkdtemp()
+    return index, 2 if destination == 'c' else 0, {}, os.path.join(tmp_dir, 'clone'), tmp_dir, 0.0
+
+
+@in_temporary_directory
+def test_run_branching_dag():
+    branching_args = [
+        ('a', 'upstream', False),
+        ('a/x', 'a', False),
+        ('b', 'upstream', False),
+        ('b/x', 'b', False),
+        ('b/x/y', 'b/x', False),
+        ('c', 'upstream', False),
+        ('c/x', 'c', False),
+    ]
+    run_branch_node = bloom.commands.git.generate._run_branch_node
+    bloom.commands.git.generate._run_branch_node = _logging_branch_node
+    try:
+        with change_environ(GIT_ENV), redirected_stdio() as (out, err):
+            execute_command('git init -q .')
+            execute_command('git commit -q --allow-empty -m init')
+            try:
+                run_branching_dag(None, branching_args, 2)
+            except CommandFailed:
+                pass
+            else:
+                assert False, "expected the failed nodes to be reported"
+    finally:
+        bloom.commands.git.generate._run_branch_node = run_branch_node
+    with open('order.log') as f:
+        order = f.read().split()
+    # Children only run after their parent succeeded
+    assert sorted(order) == ['a', 'a/x', 'b', 'c']
+    assert order.index('a') < order.index('a/x')
+    output = out.getvalue() + err.getvalue()
+    assert "b <- upstream: failed (1)" in output
+    assert "b/x <- b: skipped, b failed" in output
+    assert "b/x/y <- b/x: skipped, b/x failed" in output
+    assert "c <- upstream: failed (2)" in output
+    assert "c/x <- c: skipped, c failed" in output
+    assert "a/x <- a: ok" in output
+
+
+class CommitGenerator(BloomGenerator):
+    title = 'test'
+
+    def post_branch(self, destination, source):
+        with open('generated.txt', 'w') as f:
+            f.write(destination + '\n')
+        execute_command('git add generated.txt')
+        execute_command('git commit -q -m ' + destination)
+
+
+@in_temporary_directory
+def test_run_branching_dag_jobs():
+    # Two chains, each parent branch feeding its child branch
+    branching_args = [
+        ('release/foo', 'upstream', False),
+        ('debian/foo', 'release/foo', False),
+        ('release/bar', 'upstream', False),
+        ('debian/bar', 'release/bar', False),
+    ]
+    with change_environ(GIT_ENV), redirected_stdio():
+        execute_command('git init -q .')
+        execute_command('git checkout -q -b master')
+        with open('README', 'w') as f:
+            f.write('upstream\n')
+        execute_command('git add README')
+        execute_command('git commit -q -m init')
+        execute_command('git branch upstream')
+        run_branching_dag(CommitGenerator(), branching_args, 2)
+        for destination, source, interactive in branching_args:
+            # Each branch was generated on top of its source
+            assert execute_command('git show {0}:generated.txt'.format(destination),
+                                   return_io=True)[1] == destination + '\n'
+            assert execute_command('git merge-base --is-ancestor {0} {1}'.format(source, destination),
+                                   autofail=False, return_io=True)[0] == 0
+            assert execute_command('git rev-parse --verify -q patches/' + destination,
+                                   autofail=False, return_io=True)[0] == 0
+        # The current branch and working copy were left alone
+        assert execute_command('git rev-parse --abbrev-ref HEAD', return_io=True)[1].strip() == 'master'
+        assert execute_command('git status --porcelain', return_io=True)[1] == ''
+
+
+class FakePackage(object):
+    name = 'foo'
+    licenses = []
+
+    def get_build_type(self):
+        return 'catkin'
+
+
+class PlanGenerator(BloomGenerator):
+    title = 'test'
+    packaging_prefix = 'debian'
+    template_group = 'bloom.generators.debian'
+    fingerprint_filename = 'debian.fingerprint'
+    install_prefix = '/usr'
+
+    def __init__(self):
+        self.packages = {'foo': FakePackage()}
+        self.package_branches = {'foo': 'release/foo'}
+        self.fingerprints = {}
+        self.regenerate = False
+
+    def get_branching_arguments(self):
+        return [['debian/foo', 'release/foo'],
+                ['debian/jammy/foo', 'debian/foo'],
+                ['debian/noble/foo', 'debian/foo']]
+
+    def get_template_branches(self):
+        return ['debian/foo']
+
+    def get_os_name(self, distro):
+        return 'ubuntu'
+
+    def get_increment(self):
+        return 1
+
+    def resolve_generation_dependencies(self, package, distro):
+        return {}
+
+    def get_subs(self, package, distro, releaser_history):
+        return {'Name': package.name, 'Distribution': distro}
+
+
+def _commit_files(branch, files):
+    execute_command('git checkout -q ' + branch)
+    for path, content in files.items():
+        if not os.path.isdir(os.path.dirname(path) or '.'):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(content)
+        execute_command('git add ' + path)
+    execute_command('git commit -q -m ' + branch)
+    execute_command('git checkout -q master')
+
+
+@in_temporary_directory
+def test_plan_generator():
+    with change_environ(GIT_ENV):
+        with redirected_stdio():
+            execute_command('git init -q .')
+            execute_command('git checkout -q -b master')
+            execute_command('git commit -q --allow-empty -m init')
+            for branch in ['release/foo', 'debian/foo', 'debian/jammy/foo', 'patches/debian/jammy/foo']:
+                execute_command('git branch ' + branch)
+            _commit_files('release/foo', {'package.xml': '<package/>'})
+            _commit_files('debian/foo', {'debian/control.em': 'Source: @(Name)\n',
+                                         'debian/rules.em': 'Distribution: @(Distribution)\n'})
+            _commit_files('debian/jammy/foo', {'debian/control': 'Source: old\n',
+                                               'debian/rules': 'Distribution: jammy\n'})
+            refs = execute_command('git for-each-ref', return_io=True)[1]
+        gen = PlanGenerator()
+        try:
+            with redirected_stdio():
+                summaries = [plan_branch(gen, destination, source)
+                             for destination, source in gen.get_branching_arguments()]
+        finally:
+            # empy remembers the sys.stdout it installed its proxy on, let
+            # later tests install theirs on their own redirected stdout
+            em.Interpreter._wasProxyInstalled = False
+        assert summaries == ["not planned, branched from 'release/foo'",
+                             "would change: debian/control",
+                             "new branch with 2 generated files"]
+        # Planning never moves a ref or touches the working copy
+        with redirected_stdio():
+            assert execute_command('git for-each-ref', return_io=True)[1] == refs
+            assert execute_command('git status --porcelain', return_io=True)[1] == ''
@@ -0,0 +1,192 @@
+import os
+
+from ...utils.common import change_environ
+from ...utils.common import in_temporary_directory
+from ...utils.common import redirected_stdio
+
+from catkin_pkg.package import parse_package
+
+from bloom.generators.common import BloomGenerator
+from bloom.generators.common import clear_base_substitutions
+from bloom.generators.common import get_generation_targets
+
+from bloom.generators.debian import generator as debian_generator
+from bloom.generators.rpm import generator as rpm_generator
+
+from bloom.git import get_object_hash
+
+from bloom.util import execute_command
+
+GIT_ENV = dict(os.environ, GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+               GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b')
+
+
+def test_get_generation_targets():
+    targets = ['ubuntu:jammy', 'debian:bookworm', 'ubuntu:jammy', 'openeuler:24.03']
+    assert get_generation_targets(targets, 'loong') == [
+        ('ubuntu', 'jammy'), ('debian', 'bookworm'), ('openeuler', '24.03')]
+
+
+def test_get_generation_targets_conflict():
+    with redirected_stdio():
+        try:
+            get_generation_targets(['ubuntu:jammy', 'debian:jammy'], 'loong')
+        except SystemExit:
+            pass
+        else:
+            assert False, "expected conflicting targets to be rejected"
+
+
+PACKAGE_XML = """\
+<?xml version="1.0"?>
+<package format="2">
+  <name>foo</name>
+  <version>0.1.0</version>
+  <description>The foo package. It does things.</description>
+  <maintainer email="foo@example.com">Foo</maintainer>
+  <license>BSD</license>
+  <url type="website">http://example.com/foo</url>
+  <export><build_type>cmake</build_type></export>
+</package>
+"""
+
+CHANGELOG_RST = """\
+^^^^^^^^^^^^^^^^^^^^^^^^^
+Changelog for package foo
+^^^^^^^^^^^^^^^^^^^^^^^^^
+
+0.1.0 (2020-01-01)
+------------------
+* Initial release
+"""
+
+
+@in_temporary_directory
+def test_base_substitutions():
+    with open('package.xml', 'w') as f:
+        f.write(PACKAGE_XML)
+    with open('CHANGELOG.rst', 'w') as f:
+        f.write(CHANGELOG_RST)
+    package = parse_package('package.xml')
+    # Unlike deb_inc, the rpm_inc is used by the distro substitutions too
+    for generator, os_name, os_version, distro_args in [(debian_generator, 'ubuntu', 'jammy', ()),
+                                                        (rpm_generator, 'fedora', '39', (1,))]:
+        with redirected_stdio():
+            subs = generator.generate_substitutions_from_package(
+                package, os_name, os_version, 'loong', '/usr', 1)
+            split = generator.generate_distro_substitutions(
+                generator.generate_base_substitutions(package, '/usr', 1), package, os_name, os_version, 'loong',
+                *distro_args)
+            clear_base_substitutions()
+            uncached = generator.generate_substitutions_from_package(
+                package, os_name, os_version, 'loong', '/usr', 1)
+            # Changing the substitutions of one distro does not leak into the next
+            subs['Name'] = 'bar'
+            other = generator.generate_substitutions_from_package(
+                package, os_name, 'other', 'loong', '/usr', 1)
+        # The date is the time of generation
+        for d in [subs, split, uncached, other]:
+            d.pop('Date')
+        subs['Name'] = 'foo'
+        assert subs == split == uncached
+        assert other['Name'] == 'foo' and other['Distribution'] == 'other'
+        assert dict(other, Distribution=os_version) == subs
+    # The cache is keyed on the package.xml, not on the package object
+    with open('package.xml', 'w') as f:
+        f.write(PACKAGE_XML.replace('0.1.0', '0.2.0'))
+    with redirected_stdio():
+        changed = debian_generator.generate_base_substitutions(parse_package('package.xml'), '/usr', 1)
+    assert changed['Version'] == '0.2.0'
+    clear_base_substitutions()
+
+
+class FakePackage(object):
+    name = 'foo'
+
+    def get_build_type(self):
+        return 'catkin'
+
+
+class FingerprintGenerator(BloomGenerator):
+    title = 'test'
+    packaging_prefix = 'debian'
+    template_group = 'bloom.generators.debian'
+    fingerprint_filename = 'debian.fingerprint'
+    install_prefix = '/usr'
+
+    def __init__(self, regenerate=False):
+        self.packages = {'foo': FakePackage()}
+        self.package_branches = {'foo': 'release/foo'}
+        self.fingerprints = {}
+        self.regenerate = regenerate
+
+    def get_template_branches(self):
+        return ['debian/foo']
+
+    def get_os_name(self, distro):
+        return 'ubuntu'
+
+    def get_increment(self):
+        return 1
+
+    def resolve_generation_dependencies(self, package, distro):
+        return {}
+
+
+class NoIncrementGenerator(FingerprintGenerator):
+    get_increment = BloomGenerator.get_increment
+
+
+def test_is_branch_up_to_date_without_increment():
+    # Without an increment the inputs are incomplete, so the branch is stale
+    gen = NoIncrementGenerator()
+    assert gen.get_increment() is None
+    assert not gen.is_branch_up_to_date('debian/jammy/foo', 'debian/foo')
+    assert gen.plan_branch('debian/jammy/foo', 'debian/foo') is None
+    gen.increment_attribute = 'debian_inc'
+    gen.debian_inc = 2
+    assert gen.get_increment() == 2
+
+
+def _commit_file(branch, path, content):
+    execute_command('git checkout -q ' + branch)
+    if not os.path.isdir(os.path.dirname(path) or '.'):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'w') as f:
+        f.write(content)
+    execute_command('git add ' + path)
+    execute_command('git commit -q -m ' + path)
+    execute_command('git checkout -q master')
+
+
+@in_temporary_directory
+def test_is_branch_up_to_date():
+    destination, source, tag = 'debian/jammy/foo', 'debian/foo', 'debian/foo_1_jammy'
+    with change_environ(GIT_ENV), redirected_stdio():
+        execute_command('git init -q .')
+        execute_command('git checkout -q -b master')
+        execute_command('git commit -q --allow-empty -m init')
+        for branch in ['release/foo', source, destination, 'patches/' + destination]:
+            execute_command('git branch ' + branch)
+        _commit_file('release/foo', 'package.xml', '<package/>')
+        _commit_file(source, 'debian/control.em', 'Source: foo')
+        _commit_file(destination, 'debian/control', 'Source: foo')
+        # Nothing was stored yet, and template branches are never skipped
+        gen = FingerprintGenerator()
+        assert not gen.is_branch_up_to_date(destination, source)
+        assert not gen.is_branch_up_to_date(source, 'release/foo')
+        gen.store_generation_fingerprint(gen.fingerprints[destination], tag, 'patches/' + destination)
+        # Unchanged inputs skip the branch and create the missing tag
+        assert FingerprintGenerator().is_branch_up_to_date(destination, source)
+        assert get_object_hash(tag + '^{commit}') == get_object_hash(destination)
+        # A stale tag is pointed back at the branch
+        execute_command('git tag -f {0} master'.format(tag))
+        assert FingerprintGenerator().is_branch_up_to_date(destination, source)
+        assert get_object_hash(tag + '^{commit}') == get_object_hash(destination)
+        # --regenerate never skips, but still computes the fingerprint to store
+        gen = FingerprintGenerator(regenerate=True)
+        assert not gen.is_branch_up_to_date(destination, source)
+        assert destination in gen.fingerprints
+        # Any change to the upstream files is a change of the inputs
+        _commit_file('release/foo', 'src/foo.cpp', 'int main() {}')
+        assert not FingerprintGenerator().is_branch_up_to_date(destination, source)
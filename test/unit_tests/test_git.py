@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+
+from bloom.git import RepositoryInventory
+from bloom.git import fetch_refs
+from bloom.git import get_refs
+from bloom.git import update_refs
+
+from bloom.util import change_directory
+from bloom.util import execute_command
+
+
+def _commit_files(branch, files):
+    execute_command('git checkout -q --orphan ' + branch)
+    execute_command('git rm -rqf --ignore-unmatch .')
+    for name in files:
+        if os.path.dirname(name) and not os.path.isdir(os.path.dirname(name)):
+            os.makedirs(os.path.dirname(name))
+        with open(name, 'w') as f:
+            f.write(name)
+    execute_command('git add -A')
+    execute_command('git -c user.name=a -c user.email=a@b commit -q --allow-empty -m ' + branch.replace('/', '_'))
+
+
+def test_repository_inventory():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        with change_directory(tmp_dir):
+            execute_command('git init -q .')
+            _commit_files('master', ['tracks.yaml', 'melodic.ignored', 'dir.ignored/file'])
+            _commit_files('patches/release/melodic/foo', ['0001-fix.patch', 'patches.conf'])
+            _commit_files('patches/release/melodic/bar', ['patches.conf'])
+            _commit_files('patches/release/melodic/baz', ['series.patch/0001-fix'])
+            inventory = RepositoryInventory()
+            assert len(inventory.get_branches('patches/')) == 3
+            assert inventory.find_ignore_files('master') == ['melodic.ignored']
+            assert inventory.find_patch_branches() == ['patches/release/melodic/foo']
+            assert inventory.get_files('missing') == []
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def test_update_and_fetch_refs():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        origin = os.path.join(tmp_dir, 'origin')
+        clone = os.path.join(tmp_dir, 'clone')
+        os.makedirs(origin)
+        with change_directory(origin):
+            execute_command('git init -q .')
+            _commit_files('master', ['README'])
+            _commit_files('upstream', ['foo.cpp'])
+        execute_command('git clone -q {0} {1}'.format(origin, clone))
+        refs = get_refs(directory=origin)
+        master, upstream = refs['refs/heads/master'], refs['refs/heads/upstream']
+        # Several refs are created or moved in one transaction
+        update_refs({'refs/heads/release/foo': upstream, 'refs/tags/release/foo/0.1.0-1': upstream,
+                     'refs/heads/master': upstream}, directory=clone)
+        clone_refs = get_refs(directory=clone)
+        assert clone_refs['refs/heads/release/foo'] == upstream
+        assert clone_refs['refs/tags/release/foo/0.1.0-1'] == upstream
+        assert get_refs(['refs/tags'], directory=clone) == {'refs/tags/release/foo/0.1.0-1': upstream}
+        # Only the requested refs are fetched back, the moved master is not
+        fetch_refs(clone, ['refs/heads/release/foo', 'refs/tags/release/foo/0.1.0-1'], directory=origin)
+        refs = get_refs(directory=origin)
+        assert refs['refs/heads/release/foo'] == upstream
+        assert refs['refs/tags/release/foo/0.1.0-1'] == upstream
+        assert refs['refs/heads/master'] == master
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,47 @@
+import os
+import shutil
+import tempfile
+import time
+
+from bloom.github import evict_github_cache
+from bloom.github import get_rate_limit_delay
+from bloom.github import parse_link_header
+
+
+def test_parse_link_header():
+    value = ('<https://api.github.com/repositories/1/forks?per_page=100&page=2>; rel="next", '
+             '<https://api.github.com/repositories/1/forks?per_page=100&page=34>; rel="last"')
+    assert parse_link_header(value) == {
+        'next': 'https://api.github.com/repositories/1/forks?per_page=100&page=2',
+        'last': 'https://api.github.com/repositories/1/forks?per_page=100&page=34',
+    }
+    assert parse_link_header('<https://example.com/a>; rel="prev first"') == {
+        'prev': 'https://example.com/a', 'first': 'https://example.com/a'}
+    assert parse_link_header(None) == {}
+    assert parse_link_header('') == {}
+
+
+def test_get_rate_limit_delay():
+    assert get_rate_limit_delay(200, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '110'}, 100) is None
+    assert get_rate_limit_delay(403, {'X-RateLimit-Remaining': '0', 'X-RateLimit-Reset': '110'}, 100) == 11
+    assert get_rate_limit_delay(429, {'Retry-After': '5'}, 100) == 5
+    assert get_rate_limit_delay(403, {'X-RateLimit-Remaining': '12', 'X-RateLimit-Reset': '110'}, 100) is None
+
+
+def test_evict_github_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for name, age_days in [('old.json', 40), ('new.json', 1), ('partial.tmp', 40), ('README', 40)]:
+            path = os.path.join(cache_dir, name)
+            open(path, 'w').close()
+            last_used = time.time() - age_days * 24 * 60 * 60
+            os.utime(path, (last_used, last_used))
+        evict_github_cache(cache_dir, force=True)
+        assert sorted(os.listdir(cache_dir)) == ['.last-eviction', 'README', 'new.json']
+        # Without force, the cache is checked at most once a day
+        last_used = time.time() - 40 * 24 * 60 * 60
+        os.utime(os.path.join(cache_dir, 'new.json'), (last_used, last_used))
+        evict_github_cache(cache_dir)
+        assert 'new.json' in os.listdir(cache_dir)
+    finally:
+        shutil.rmtree(cache_dir)
@@ -0,0 +1,89 @@
+import os
+import shutil
+import tarfile
+import tempfile
+
+from bloom.commands.git.import_upstream import fast_import_tarball
+from bloom.commands.git.import_upstream import overlay_patches
+
+from bloom.git import ls_tree
+from bloom.git import show
+
+from bloom.util import change_directory
+from bloom.util import execute_command
+
+
+def test_fast_import_tarball():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        src = os.path.join(tmp_dir, 'upstream-0.1.0')
+        os.makedirs(os.path.join(src, 'foo'))
+        for path in ['foo/package.xml', 'README', '.gitignore']:
+            with open(os.path.join(src, path), 'w') as f:
+                f.write(path)
+        tarball = src + '.tar.gz'
+        with tarfile.open(tarball, 'w:gz') as tar:
+            tar.add(src, 'upstream-0.1.0')
+        repo = os.path.join(tmp_dir, 'repo')
+        os.makedirs(repo)
+        with change_directory(repo):
+            execute_command('git init -q .')
+            execute_command('git -c user.name=a -c user.email=a@b commit -q --allow-empty -m init')
+            execute_command('git branch upstream')
+            os.environ.update(GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+                              GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b')
+            assert fast_import_tarball(tarball, 'upstream', '0.1.0', 'upstream')
+            assert ls_tree('upstream') == {'README': 'file', 'foo': 'directory'}
+            head = execute_command('git rev-parse upstream', return_io=True)[1]
+            # Importing the same tree again does not create a commit
+            assert fast_import_tarball(tarball, 'upstream', '0.1.0', 'upstream')
+            assert execute_command('git rev-parse upstream', return_io=True)[1] == head
+            # Unsafe paths abort the import instead of falling back to extracting
+            evil = os.path.join(tmp_dir, 'evil-0.1.0.tar.gz')
+            with tarfile.open(evil, 'w:gz') as tar:
+                tar.addfile(tarfile.TarInfo('../escaped.txt'))
+            try:
+                fast_import_tarball(evil, 'upstream', '0.1.0', 'upstream')
+            except SystemExit:
+                pass
+            else:
+                assert False, 'the unsafe archive was imported'
+            assert execute_command('git rev-parse upstream', return_io=True)[1] == head
+            # The checked out branch is not imported into
+            assert not fast_import_tarball(tarball, execute_command(
+                'git rev-parse --abbrev-ref HEAD', return_io=True)[1].strip(), '0.1.0', 'upstream')
+    finally:
+        for key in ['GIT_AUTHOR_NAME', 'GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_NAME', 'GIT_COMMITTER_EMAIL']:
+            os.environ.pop(key, None)
+        shutil.rmtree(tmp_dir)
+
+
+def test_overlay_patches():
+    tmp_dir = tempfile.mkdtemp()
+    os.environ.update(GIT_AUTHOR_NAME='a', GIT_AUTHOR_EMAIL='a@b',
+                      GIT_COMMITTER_NAME='a', GIT_COMMITTER_EMAIL='a@b')
+    try:
+        with change_directory(tmp_dir):
+            execute_command('git init -q .')
+            execute_command('git checkout -q -b master')
+            os.makedirs(os.path.join('patches', 'foo'))
+            with open(os.path.join('patches', 'foo', 'package.xml'), 'w') as f:
+                f.write('<version>:{version}</version>')
+            with open(os.path.join('patches', 'README'), 'w') as f:
+                f.write('README')
+            execute_command('git add patches')
+            execute_command('git commit -q -m patches')
+            execute_command('git branch upstream')
+            execute_command('git branch root')
+            assert overlay_patches('patches', 'upstream', '1.2.3')
+            assert show('upstream', 'foo/package.xml') == '<version>1.2.3</version>'
+            assert show('upstream', 'README') == 'README'
+            # The worktree of the checked out branch is not modified
+            assert not os.path.exists('README')
+            # A root patches path keeps the full paths of the overlaid files
+            assert overlay_patches('/', 'root', '1.2.3')
+            assert show('root', 'patches/foo/package.xml') == '<version>1.2.3</version>'
+    finally:
+        for key in ['GIT_AUTHOR_NAME', 'GIT_AUTHOR_EMAIL', 'GIT_COMMITTER_NAME', 'GIT_COMMITTER_EMAIL']:
+            os.environ.pop(key, None)
+        shutil.rmtree(tmp_dir)
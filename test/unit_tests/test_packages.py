@@ -5,7 +5,13 @@ from ..utils.common import in_temporary_directory
 from ..utils.common import redirected_stdio
 from ..utils.common import user
 
+from bloom.packages import find_package_paths_in_tree
+from bloom.packages import get_changelog_from_file
+from bloom.packages import get_changelog_from_reference
 from bloom.packages import get_package_data
+from bloom.packages import parse_packages
+
+from catkin_pkg.package import parse_package_string
 
 test_data_dir = os.path.join(os.path.dirname(__file__), 'test_packages_data')
 
@@ -17,3 +23,155 @@ def test_get_package_data_fails_on_uppercase():
     with AssertRaisesContext(SystemExit, "Invalid package names, aborting."):
         with redirected_stdio():
             get_package_data(directory=test_data_dir)
+
+
+@in_temporary_directory
+def test_get_package_data_is_cached_on_tree_hash():
+    package_xml = """\
+<?xml version="1.0"?>
+<package format="2">
+  <name>foo</name><version>{0}</version><description>foo</description>
+  <maintainer email="foo@example.com">foo</maintainer><license>BSD</license>
+</package>
+"""
+    user('git init .')
+    with open('package.xml', 'w') as f:
+        f.write(package_xml.format('0.1.0'))
+    user('git add package.xml')
+    user('git commit -m "0.1.0"')
+    with redirected_stdio():
+        names, version, packages = get_package_data()
+        assert (names, version) == (['foo'], '0.1.0')
+        # Mutating the result must not leak into the cache
+        packages.clear()
+        assert get_package_data()[2] != {}
+        with open('package.xml', 'w') as f:
+            f.write(package_xml.format('0.2.0'))
+        user('git commit -am "0.2.0"')
+        assert get_package_data()[1] == '0.2.0'
+
+
+def test_find_package_paths_in_tree():
+    files = [
+        'package.xml',
+        'CMakeLists.txt',
+    ]
+    assert find_package_paths_in_tree(files) == ['.']
+    files = [
+        'foo/package.xml',
+        'foo/nested/package.xml',
+        'bar/package.xml',
+        'bar/CATKIN_IGNORE',
+        'baz/COLCON_IGNORE/file',
+        'baz/package.xml',
+        '.hidden/package.xml',
+        'deep/er/qux/package.xml',
+        'deep/AMENT_IGNORE_NOT/x',
+    ]
+    # A folder named like a marker does not ignore its parent
+    assert find_package_paths_in_tree(files) == ['baz', 'deep/er/qux', 'foo']
+    files = [
+        'qux/package.xml',
+        'qux/AMENT_IGNORE',
+        'quux/package.xml',
+        'quux/src/CATKIN_IGNORE',
+        'corge/CATKIN_IGNORE/package.xml',
+    ]
+    assert find_package_paths_in_tree(files) == ['corge/CATKIN_IGNORE', 'quux']
+
+
+def _as_data(obj):
+    if isinstance(obj, list):
+        return [_as_data(o) for o in obj]
+    if isinstance(obj, dict):
+        return dict((k, _as_data(v)) for k, v in obj.items())
+    slots = getattr(type(obj), '__slots__', None)
+    if slots is not None:
+        return (type(obj).__name__, dict((s, _as_data(getattr(obj, s, None))) for s in slots))
+    if hasattr(obj, '__dict__'):
+        return (type(obj).__name__, str(obj), _as_data(vars(obj)))
+    return (type(obj).__name__, obj)
+
+
+def test_parse_packages_matches_catkin_pkg():
+    manifests = {
+        'format3': """\
+<?xml version="1.0"?>
+<?xml-model href="http://download.ros.org/schema/package_format3.xsd" schematypens="http://www.w3.org/2001/XMLSchema"?>
+<package format="3">
+  <name>foo</name>
+  <version compatibility="1.0.0">1.2.3</version>
+  <description>
+    The <b>foo</b> package, &amp; friends.<br/>
+    <!-- a comment -->  Second   line.
+  </description>
+  <maintainer email="foo@example.com">Foo &lt;Bar&gt;</maintainer>
+  <license file="LICENSE">Apache-2.0</license>
+  <license>BSD</license>
+  <url type="repository">https://example.com/foo</url>
+  <url>https://example.com</url>
+  <author>Someone</author>
+  <buildtool_depend>ament_cmake</buildtool_depend>
+  <depend version_gte="1.0">rclcpp</depend>
+  <build_depend condition="$ROS_VERSION == 2">baz</build_depend>
+  <exec_depend condition="$ROS_PYTHON_VERSION == 3">python3-yaml</exec_depend>
+  <test_depend>ament_lint_auto</test_depend>
+  <doc_depend>doxygen</doc_depend>
+  <conflict>old_foo</conflict>
+  <replace>older_foo</replace>
+  <group_depend condition="$ROS_VERSION == 2">rosidl_interface_packages</group_depend>
+  <member_of_group>foo_group</member_of_group>
+  <export>
+    <build_type>ament_cmake</build_type>
+    <foo_plugin plugin="${prefix}/plugins.xml"/>
+    <architecture_independent/>
+  </export>
+</package>
+""",
+        'format1': """\
+<package>
+  <name>bar</name>
+  <version>0.0.1</version>
+  <description>Bar</description>
+  <maintainer email="bar@example.com">Bar</maintainer>
+  <license>BSD</license>
+  <buildtool_depend>catkin</buildtool_depend>
+  <build_depend>roscpp</build_depend>
+  <run_depend>roscpp</run_depend>
+  <export><metapackage/></export>
+</package>
+""",
+    }
+    for name in ['bad_changelog_pkg']:
+        path = os.path.join(os.path.dirname(__file__), 'test_generators', 'test_debian',
+                            'test_generator_data', name, 'package.xml')
+        with open(path) as f:
+            manifests[path] = f.read()
+    with redirected_stdio():
+        parsed = parse_packages(dict((k, v.encode('utf-8')) for k, v in manifests.items()))
+        for filename, data in manifests.items():
+            expected = parse_package_string(data, filename=filename)
+            assert _as_data(parsed[filename]) == _as_data(expected), filename
+
+
+@in_temporary_directory
+def test_changelog_is_shared_between_files_and_references():
+    user('git init .')
+    with open('CHANGELOG.rst', 'w') as f:
+        f.write("""\
+^^^^^^^^^^^^^^^^^^^^^^^^^
+Changelog for package foo
+^^^^^^^^^^^^^^^^^^^^^^^^^
+
+0.1.0 (2024-01-01)
+------------------
+* Initial release
+""")
+    user('git add CHANGELOG.rst')
+    user('git commit -m "changelog"')
+    with redirected_stdio():
+        from_file = get_changelog_from_file(os.getcwd())
+        from_reference = get_changelog_from_reference('HEAD')
+    assert from_file is from_reference
+    assert [v for v, _, _ in from_reference.foreach_version()] == ['0.1.0']
+    assert get_changelog_from_reference('HEAD', 'missing') is None
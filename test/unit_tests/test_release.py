@@ -0,0 +1,166 @@
+import argparse
+import os
+import shutil
+import sys
+import tempfile
+import types
+
+import bloom.util
+
+from bloom.util import change_directory
+from bloom.util import execute_command
+
+from ..utils.common import redirected_stdio
+
+from bloom.commands.git import release
+from bloom.commands.git.release import checkout_upstream_manifests
+from bloom.commands.git.release import get_changed_refs
+from bloom.commands.git.release import get_concurrent_action_groups
+from bloom.commands.git.release import get_streamed_upstream_import
+from bloom.commands.git.release import run_action_in_process
+
+
+def test_get_concurrent_action_groups():
+    actions = [
+        'bloom-export-upstream /tmp/upstream git --tag 0.1.0',
+        'git-bloom-import-upstream /tmp/upstream-0.1.0.tar.gz --replace',
+        'git-bloom-generate -y rosrelease loong --source upstream -i 1',
+        'git-bloom-generate -y agirosdebian --prefix release/loong loong -i 1',
+        'git-bloom-generate -y agirosrpm --prefix release/loong loong -i 1',
+        'git-bloom-generate -y rosdebian --prefix release/loong loong -i 1 --os-name debian',
+    ]
+    templated_actions = [(a, a) for a in actions]
+    groups = get_concurrent_action_groups(templated_actions, 4)
+    assert [len(g) for g in groups] == [1, 1, 1, 2, 1]
+    assert [t for a, t in groups[3]] == actions[3:5]
+    assert len(get_concurrent_action_groups(templated_actions, 1)) == len(actions)
+
+
+def test_get_concurrent_action_groups_interactive():
+    actions = [
+        'git-bloom-generate debian --prefix release -i 1',
+        'git-bloom-generate rpm --prefix release -i 1',
+    ]
+    groups = get_concurrent_action_groups([(a, a) for a in actions], 2)
+    assert [len(g) for g in groups] == [1, 1]
+
+
+def test_get_changed_refs():
+    before = {'refs/heads/a': '1', 'refs/heads/b': '2', 'refs/tags/c': '3'}
+    after = {'refs/heads/a': '1', 'refs/heads/b': '4', 'refs/heads/d': '5'}
+    assert get_changed_refs(before, after) == {
+        'refs/heads/b': '4', 'refs/heads/d': '5', 'refs/tags/c': None}
+
+
+def test_get_streamed_upstream_import():
+    export_action = ('bloom-export-upstream /tmp/up git --tag 0.1.0 --display-uri /tmp/up'
+                     ' --name foo --output-dir /tmp/archives').split()
+    import_action = 'git-bloom-import-upstream /tmp/archives/foo-0.1.0.tar.gz --release-version 0.1.0 --replace'
+    export_args, import_args = get_streamed_upstream_import(export_action, import_action.split())
+    assert export_args.tag == '0.1.0' and import_args.replace
+    assert get_streamed_upstream_import(export_action, import_action.replace('foo-', 'bar-').split()) is None
+    assert get_streamed_upstream_import(export_action, ['git-bloom-generate', '-y', 'rpm']) is None
+    # A later action using the archive needs it written
+    later_actions = [['git-bloom-generate', '-y', 'rpm'], ['cp', '/tmp/archives/foo-0.1.0.tar.gz', '/tmp/keep']]
+    assert get_streamed_upstream_import(export_action, import_action.split(), later_actions[:1]) is not None
+    assert get_streamed_upstream_import(export_action, import_action.split(), later_actions) is None
+
+
+def _state_changing_main(args):
+    """Main of a fake action changing the global state like real actions do"""
+    parser = bloom.util.add_global_arguments(argparse.ArgumentParser())
+    os.environ['BLOOM_UNSAFE_QUIET'] = '1'
+    bloom.util.handle_global_arguments(parser.parse_args(args))
+    os.chdir(os.path.dirname(os.getcwd()))
+    _state_changing_main.seen = (bloom.util._quiet, bloom.util._disable_git_clone,
+                                 bloom.util._disable_git_clone_quiet, os.environ.get('BLOOM_UNSAFE'))
+    sys.exit(3)
+
+
+def test_run_action_in_process_restores_state():
+    module = types.ModuleType('bloom_test_action')
+    module.main = _state_changing_main
+    sys.modules[module.__name__] = module
+    release._in_process_actions['bloom-test-action'] = module.__name__
+    cwd = os.getcwd()
+    environ = dict(os.environ)
+    flags = (bloom.util._quiet, bloom.util._disable_git_clone, bloom.util._disable_git_clone_quiet)
+    try:
+        with redirected_stdio():
+            ret = run_action_in_process(['bloom-test-action', '--quiet', '--unsafe'])
+    finally:
+        del release._in_process_actions['bloom-test-action']
+        del sys.modules[module.__name__]
+    assert ret == 3
+    # The action did change the quiet and git clone flags...
+    assert _state_changing_main.seen == (True, True, True, '1')
+    # ...but they, the environment and the working directory are restored
+    assert (bloom.util._quiet, bloom.util._disable_git_clone, bloom.util._disable_git_clone_quiet) == flags
+    assert os.getcwd() == cwd
+    assert dict(os.environ) == environ
+
+
+PACKAGE_XML = """\
+<?xml version="1.0"?>
+<package format="2">
+  <name>{0}</name><version>{1}</version><description>{0}</description>
+  <maintainer email="{0}@example.com">{0}</maintainer><license>BSD</license>
+</package>
+"""
+
+
+def _commit_packages(version, files):
+    for path in files:
+        if os.path.dirname(path) and not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            if os.path.basename(path) == 'package.xml':
+                f.write(PACKAGE_XML.format(os.path.basename(os.path.dirname(path)), version))
+            else:
+                f.write(path)
+    execute_command('git add -A')
+    execute_command('git -c user.name=a -c user.email=a@b commit -q -m ' + version)
+
+
+def _list_checkout(directory):
+    files = []
+    for dirpath, dirnames, filenames in os.walk(directory):
+        if '.git' in dirnames:
+            dirnames.remove('.git')
+        files.extend(os.path.relpath(os.path.join(dirpath, f), directory) for f in filenames)
+    return sorted(files)
+
+
+def test_checkout_upstream_manifests():
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        upstream = os.path.join(tmp_dir, 'upstream')
+        os.makedirs(upstream)
+        with change_directory(upstream):
+            execute_command('git init -q .')
+            execute_command('git checkout -q -b main')
+            _commit_packages('0.1.0', ['foo/package.xml', 'foo/src/foo.cpp', 'bar/package.xml',
+                                       'ignored/package.xml', 'ignored/CATKIN_IGNORE', 'README'])
+            execute_command('git tag 0.1.0')
+            execute_command('git checkout -q -b devel')
+            _commit_packages('0.2.0', ['foo/package.xml', 'bar/package.xml'])
+            execute_command('git checkout -q main')
+        uri = 'file://' + upstream
+        with redirected_stdio():
+            # The default branch, with only the manifests of the packages checked out
+            directory = os.path.join(tmp_dir, 'default')
+            assert checkout_upstream_manifests(uri, None, directory)
+            assert _list_checkout(directory) == ['bar/package.xml', 'foo/package.xml']
+            with open(os.path.join(directory, 'foo', 'package.xml')) as f:
+                assert '<version>0.1.0</version>' in f.read()
+            # A named branch
+            directory = os.path.join(tmp_dir, 'devel')
+            assert checkout_upstream_manifests(uri, 'devel', directory)
+            assert _list_checkout(directory) == ['bar/package.xml', 'foo/package.xml']
+            with open(os.path.join(directory, 'foo', 'package.xml')) as f:
+                assert '<version>0.2.0</version>' in f.read()
+            # A tag is not a branch, so the full clone is used
+            assert not checkout_upstream_manifests(uri, '0.1.0', os.path.join(tmp_dir, 'tag'))
+            assert not os.path.exists(os.path.join(tmp_dir, 'tag'))
+    finally:
+        shutil.rmtree(tmp_dir)
@@ -0,0 +1,56 @@
+import os
+import shutil
+import tempfile
+import time
+
+from bloom.upstream_cache import evict_upstream_cache
+from bloom.upstream_cache import get_mirror_name
+from bloom.upstream_cache import restore_cached_archive
+from bloom.upstream_cache import store_cached_archive
+
+
+def test_get_mirror_name():
+    name = get_mirror_name('https://github.com/ros/ros_comm.git')
+    assert name.startswith('ros_comm-')
+    assert name != get_mirror_name('https://github.com/other/ros_comm.git')
+    assert get_mirror_name('git@github.com:ros/catkin').startswith('catkin-')
+
+
+def test_evict_upstream_cache():
+    cache_dir = tempfile.mkdtemp()
+    try:
+        for name, age_days in [('old', 40), ('new', 1)]:
+            os.makedirs(os.path.join(cache_dir, name + '.git'))
+            lock_path = os.path.join(cache_dir, name + '.lock')
+            open(lock_path, 'w').close()
+            last_used = time.time() - age_days * 24 * 60 * 60
+            os.utime(lock_path, (last_used, last_used))
+        evict_upstream_cache(cache_dir, force=True)
+        assert sorted(os.listdir(cache_dir)) == ['.last-eviction', 'new.git', 'new.lock', 'old.lock']
+    finally:
+        shutil.rmtree(cache_dir)
+
+
+def test_cached_archive():
+    tmp_dir = tempfile.mkdtemp()
+    os.environ['BLOOM_ARCHIVE_CACHE_DIR'] = os.path.join(tmp_dir, 'cache')
+    try:
+        archive = os.path.join(tmp_dir, 'upstream-0.1.0.tar.gz')
+        with open(archive, 'w') as f:
+            f.write('archive')
+        commit = '0' * 40
+        assert restore_cached_archive(commit, 'upstream-0.1.0', archive) is None
+        store_cached_archive(commit, 'upstream-0.1.0', archive, 'md5sum')
+        os.remove(archive)
+        assert restore_cached_archive(commit, 'upstream-0.1.0', archive) == 'md5sum'
+        with open(archive, 'r') as f:
+            assert f.read() == 'archive'
+        assert restore_cached_archive('1' * 40, 'upstream-0.1.0', archive) is None
+        # Archives made at another compression level are not reused
+        assert restore_cached_archive(commit, 'upstream-0.1.0', archive, 9) is None
+        store_cached_archive(commit, 'upstream-0.1.0', archive, 'md5sum9', 9)
+        assert restore_cached_archive(commit, 'upstream-0.1.0', archive, 9) == 'md5sum9'
+        assert restore_cached_archive(commit, 'upstream-0.1.0', archive) == 'md5sum'
+    finally:
+        del os.environ['BLOOM_ARCHIVE_CACHE_DIR']
+        shutil.rmtree(tmp_dir)